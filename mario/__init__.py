@@ -1 +1,6 @@
-__all__ = ['core', 'parser', 'tests']
+__all__ = ['batch', 'bench', 'check', 'core', 'daemon', 'downloads',
+           'fastparser', 'index', 'mimemagic', 'net', 'optimizer', 'parser',
+           'payload', 'replay', 'rulescache', 'startup', 'stats', 'tests',
+           'typecache']
+
+__version__ = '0.1'
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Batch mode: plumb every message of a stream in one process, with the rules
+# loaded and the type cache opened once, printing one JSON line per message.
+
+import argparse
+import json
+import logging as log
+import sys
+import time
+
+from mario import net, replay
+from mario.core import (Kind, guess_kind, handle_rules, load_rules,
+                        make_message)
+from mario.typecache import open_type_cache
+from mario.util import Scope
+
+
+CHUNK_SIZE = 64 * 1024
+
+SEPARATORS = {
+    'lines': b'\n',
+    'nul': b'\0',
+    'ndjson': b'\n',
+}
+
+
+def split_records(f, separator):
+    # read1 returns whatever is available, so records coming down a pipe are
+    # plumbed as they arrive instead of when a whole chunk has filled up
+    read = getattr(f, 'read1', f.read)
+    pending = b''
+
+    while True:
+        chunk = read(CHUNK_SIZE)
+
+        if not chunk:
+            break
+
+        records = (pending + chunk).split(separator)
+        pending = records.pop()
+
+        yield from records
+
+    if pending:
+        yield pending
+
+
+def read_records(f, fmt):
+    for record in split_records(f, SEPARATORS[fmt]):
+        if fmt != 'nul':
+            record = record.rstrip(b'\r')
+
+        if record:
+            yield record
+
+
+def decode_record(record, fmt):
+    """Return the data, kind and id of a record. Only NDJSON records can
+    carry a kind and an id, they're None otherwise."""
+    if fmt != 'ndjson':
+        try:
+            return record.decode('utf-8'), None, None
+        except UnicodeDecodeError:
+            return record, None, None
+
+    obj = json.loads(record.decode('utf-8'))
+
+    if not isinstance(obj, dict) or not isinstance(obj.get('data'), str):
+        raise ValueError('expected an object with a "data" string')
+
+    kind = obj.get('kind')
+
+    if kind is not None:
+        try:
+            kind = Kind[kind]
+        except (KeyError, TypeError):
+            raise ValueError('unknown kind: {!r}'.format(kind))
+
+    return obj['data'], kind, obj.get('id')
+
+
+def plumb_record(record, args, rules, store):
+    data, kind, id_ = decode_record(record, args.batch_format)
+    msg_args = argparse.Namespace(msg=data, kind=kind or args.kind,
+                                  guess=False)
+
+    if msg_args.kind is None:
+        guess_kind(msg_args)
+
+    msg = make_message(msg_args)
+    start = time.perf_counter()
+    rule, ok = handle_rules(Scope(msg), rules, store)
+
+    if replay.recorder is not None:
+        replay.record(data, msg, (rule, ok),
+                      {'handle': time.perf_counter() - start})
+
+    result = {'kind': msg_args.kind.name, 'rule': rule,
+              'status': replay.status(rule, ok)}
+
+    if id_ is not None:
+        result['id'] = id_
+
+    return result
+
+
+def plumb_batch(args, config, rules=None, out=sys.stdout, store=None,
+                infile=None):
+    """Plumb every message in args.batch (or infile, if given) and write a
+    JSON result line for each to out. Return the exit status."""
+    net.configure(config)
+
+    if rules is None:
+        rules = load_rules(args, config)
+
+    if not rules:
+        log.info('Syntax error in rules file. Quitting...')
+        return 1
+
+    if store is None:
+        store = open_type_cache(config)
+
+    opened = None
+
+    if infile is None:
+        if args.batch == '-':
+            infile = sys.stdin.buffer
+        else:
+            try:
+                infile = opened = open(args.batch, 'rb')
+            except OSError as e:
+                log.error('Can\'t read messages: {}'.format(e))
+                return 1
+
+    count = 0
+
+    try:
+        for count, record in enumerate(read_records(infile,
+                                                    args.batch_format), 1):
+            try:
+                result = plumb_record(record, args, rules, store)
+            except ValueError as e:
+                result = {'status': 'error', 'error': str(e)}
+            except Exception as e:
+                log.exception('Error while handling message {}'.format(count))
+                result = {'status': 'error', 'error': str(e)}
+
+            out.write(json.dumps(dict({'message': count}, **result)) + '\n')
+            out.flush()
+    finally:
+        if opened is not None:
+            opened.close()
+
+    log.info('Plumbed {} messages.'.format(count))
+
+    return 0
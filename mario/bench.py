@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Benchmarks of parsing, matching and plumbing on synthetic rules files and
+# messages. Run them with
+#
+#     python -m mario.bench [benchmark ...]
+#
+# --output saves the results as JSON and --compare checks them against
+# results saved earlier, failing if anything got slower than allowed.
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+from functools import partial
+
+import mario
+from mario import fastparser
+from mario.core import (STUB_ACTIONS, Kind, compile_rules, detect_mimetype,
+                        handle_rules, make_message)
+from mario.index import RuleIndex
+from mario.optimizer import optimize_rules
+from mario.util import ElasticDict, Scope
+
+
+MESSAGE = {
+    'data': 'http://www.example.com/papers/plumbing.pdf',
+    'kind': 'url',
+    'netloc': 'www.example.com',
+    'netpath': '/papers/plumbing.pdf',
+}
+
+TEMPLATE = '{netloc}{netpath}'
+
+# Sizes of the generated rules files
+SIZES = {
+    '10': 10,
+    '1k': 1000,
+    '100k': 100000,
+}
+
+DEFAULT_SIZES = ['10', '1k']
+
+# What raw blobs start with and what libmagic makes of them
+BLOB_HEADERS = {
+    'application/pdf': b'%PDF-1.4\n',
+    'image/png': b'\x89PNG\r\n\x1a\n',
+    'application/gzip': b'\x1f\x8b\x08\x00',
+}
+
+# Messages in a corpus
+CORPUS_SIZE = 1000
+
+# Slowdown over the baseline that counts as a regression
+THRESHOLD = 0.1
+
+
+def generate_rules(count, seed=0):
+    """Return the text of a rules file with count rules, a mix of ones
+    matching URLs by host or path, text and raw blobs by type."""
+    rng = random.Random(seed)
+    blocks = []
+
+    for i in range(count):
+        shape = i % 4
+
+        if shape == 0:
+            blocks.append('[url-host-{0}]\n'
+                          'kind is url\n'
+                          'arg is {{netloc}} host{0}.example.com\n'
+                          'plumb run true {{data}}'.format(i))
+        elif shape == 1:
+            blocks.append('[url-path-{0}]\n'
+                          'kind is url\n'
+                          'arg matches {{netpath}} ^/docs/{0}/(.+)\\.pdf$\n'
+                          'plumb run true {{0}}'.format(i))
+        elif shape == 2:
+            blocks.append('[text-{0}]\n'
+                          'kind is text\n'
+                          'data matches ^note\\s{0}:\\s(.*)$\n'
+                          '             ^todo\\s{0}:\\s(.*)$\n'
+                          'plumb run true {{0}}'.format(i))
+        else:
+            blocks.append('[raw-{0}]\n'
+                          'kind is raw\n'
+                          'data istype ^{1}$\n'
+                          'data matches blob\\s{0}\\n\n'
+                          'plumb run true {{datafile}}'.format(
+                              i, rng.choice(sorted(BLOB_HEADERS))))
+
+    return '\n\n'.join(blocks)
+
+
+def generate_messages(kind, count, rules, seed=0):
+    """Return count messages of kind, about half of which are meant to
+    match one of the rules generate_rules(rules) returns."""
+    rng = random.Random(seed)
+    messages = []
+
+    for _ in range(count):
+        i = rng.randrange(2 * rules)
+
+        if kind == Kind.url:
+            data = 'http://host{}.example.com/docs/{}/paper.pdf'.format(
+                i, rng.randrange(2 * rules))
+        elif kind == Kind.text:
+            data = 'note {}: buy more pipes'.format(i)
+        else:
+            header = BLOB_HEADERS[rng.choice(sorted(BLOB_HEADERS))]
+            data = header + 'blob {}\n'.format(i).encode() + \
+                   rng.randbytes(4096)
+
+        messages.append(make_message(argparse.Namespace(msg=data,
+                                                        kind=kind)))
+
+    return messages
+
+
+# SCOPE
+
+def message_elasticdict():
+    msg = ElasticDict(MESSAGE)
+
+    def run():
+        msg['\\0'] = 'plumbing'
+        msg['\\1'] = 'pdf'
+        TEMPLATE.format(**msg)
+        msg['data']
+        msg.reverse()
+
+    return run
+
+
+def message_scope():
+    msg = Scope(MESSAGE)
+
+    def run():
+        savepoint = msg.savepoint()
+        msg['\\0'] = 'plumbing'
+        msg['\\1'] = 'pdf'
+        TEMPLATE.format_map(msg)
+        msg['data']
+        msg.rollback(savepoint)
+
+    return run
+
+
+def format_elasticdict():
+    msg = ElasticDict(MESSAGE)
+    msg['\\0'] = 'plumbing'
+
+    return lambda: TEMPLATE.format(**msg)
+
+
+def format_scope():
+    msg = Scope(MESSAGE)
+    msg['\\0'] = 'plumbing'
+
+    return lambda: TEMPLATE.format_map(msg)
+
+
+def lookup_elasticdict():
+    msg = ElasticDict(MESSAGE)
+
+    return lambda: msg['data']
+
+
+def lookup_scope():
+    msg = Scope(MESSAGE)
+
+    return lambda: msg['data']
+
+
+# PARSING
+
+def build_parser():
+    from mario.parser import make_parser
+
+    return make_parser
+
+
+def parse_pyparsing(count):
+    from mario.parser import (make_parser, parse_rules_file_exc,
+                              extract_plain_parse_result)
+
+    parser = make_parser()
+    text = generate_rules(count)
+
+    return lambda: parse_rules_file_exc(parser, io.StringIO(text),
+                                        extract_plain_parse_result)
+
+
+def parse_fast(count):
+    text = generate_rules(count)
+
+    return lambda: fastparser.parse_rules_file_exc(io.StringIO(text))
+
+
+# MATCHING
+
+def match(kind, count):
+    """Handle messages one after another against the generated rules, with
+    the actions doing nothing."""
+    rules = fastparser.parse_rules_string_exc(generate_rules(count))
+    index = RuleIndex(optimize_rules(compile_rules(rules, STUB_ACTIONS)))
+    messages = itertools.cycle(generate_messages(kind, CORPUS_SIZE, count))
+
+    return lambda: handle_rules(Scope(next(messages)), index)
+
+
+def mimetype(kind):
+    messages = itertools.cycle(generate_messages(kind, CORPUS_SIZE, 10))
+
+    return lambda: detect_mimetype(kind, next(messages)['data'])
+
+
+# COMMAND LINE
+
+def cli(count):
+    """Plumb a message by running mario, rules cache and all."""
+    # removed along with the returned function
+    tmp = tempfile.TemporaryDirectory(prefix='mario-bench-')
+
+    rules = os.path.join(tmp.name, 'mario.plumb')
+    config = os.path.join(tmp.name, 'config')
+
+    with open(rules, 'w') as f:
+        f.write(generate_rules(count))
+
+    with open(config, 'w') as f:
+        f.write('[mario]\n'
+                'parser = fast\n'
+                'type cache =\n'
+                'download cache =\n')
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(mario.__file__)))
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp.name, 'cache'),
+               PYTHONPATH=os.pathsep.join(
+                   filter(None, [root, os.environ.get('PYTHONPATH')])))
+    command = [sys.executable, '-c', 'from mario.core import main; main()',
+               '--config', config, '--rules', rules, 'note 2: plunger',
+               'text']
+
+    def run():
+        tmp.name    # keep the directory around
+        subprocess.run(command, env=env, check=True)
+
+    # the first run fills the rules cache
+    run()
+
+    return run
+
+
+def benchmarks(sizes=DEFAULT_SIZES):
+    """Return the benchmarks as a dict mapping their names to functions
+    setting up the function to time."""
+    suite = {
+        'scope/message/elasticdict': message_elasticdict,
+        'scope/message/scope': message_scope,
+        'scope/format/elasticdict': format_elasticdict,
+        'scope/format/scope': format_scope,
+        'scope/lookup/elasticdict': lookup_elasticdict,
+        'scope/lookup/scope': lookup_scope,
+        'parse/make_parser': build_parser,
+    }
+
+    for size in sizes:
+        suite['parse/pyparsing/' + size] = partial(parse_pyparsing,
+                                                   SIZES[size])
+        suite['parse/fast/' + size] = partial(parse_fast, SIZES[size])
+
+    for kind in Kind:
+        for size in sizes:
+            suite['match/{}/{}'.format(kind.name, size)] = partial(
+                match, kind, SIZES[size])
+
+    suite['mimetype/raw'] = partial(mimetype, Kind.raw)
+    suite['mimetype/text'] = partial(mimetype, Kind.text)
+
+    for size in sizes:
+        suite['cli/' + size] = partial(cli, SIZES[size])
+
+    return suite
+
+
+def measure(setup, repeat=5):
+    """Return the best time of a single call of the function setup
+    returns, in seconds."""
+    timer = timeit.Timer(setup())
+    number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat, number)) / number
+
+
+def selected(suite, names):
+    if not names:
+        return list(suite)
+
+    return [name for name in suite
+            if any(name == n or name.startswith(n + '/') for n in names)]
+
+
+def compare(results, baseline, threshold=THRESHOLD, out=sys.stdout):
+    """Print how results compare to baseline and return the names of the
+    benchmarks that got slower by more than threshold."""
+    regressions = []
+
+    print('{:28} {:>12} {:>12}'.format('benchmark', 'baseline', 'current'),
+          file=out)
+
+    for name, seconds in results.items():
+        before = baseline.get(name)
+
+        if before is None:
+            print('{:28} {:>12} {:12.1f} us  new'.format(
+                name, '', seconds * 1e6), file=out)
+            continue
+
+        change = seconds / before - 1
+
+        if change > threshold:
+            regressions.append(name)
+
+        print('{:28} {:12.1f} {:12.1f} us  {:+6.1%}{}'.format(
+            name, before * 1e6, seconds * 1e6, change,
+            '  REGRESSION' if change > threshold else ''), file=out)
+
+    return regressions
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mario.bench')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks or groups of them to run '
+                        '(default: all)')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=DEFAULT_SIZES,
+                        help='rules file sizes to run the sized benchmarks '
+                        'with (default: 10 1k)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the best of this many runs')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks and exit')
+    parser.add_argument('--output',
+                        help='save the results as JSON to this file')
+    parser.add_argument('--compare', type=argparse.FileType('r'),
+                        help='compare the results to ones saved with '
+                        '--output and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown counting as a regression '
+                        '(default: 0.1, i.e. 10%%)')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None, out=sys.stdout):
+    args = parse_arguments(argv)
+    suite = benchmarks(args.sizes)
+    names = selected(suite, args.benchmarks)
+
+    if not names:
+        print('No such benchmark.', file=sys.stderr)
+        return 1
+
+    if args.list:
+        print('\n'.join(names), file=out)
+        return 0
+
+    baseline = None
+
+    if args.compare:
+        baseline = json.load(args.compare)['results']
+        args.compare.close()
+
+    results = {}
+
+    for name in names:
+        results[name] = measure(suite[name], args.repeat)
+
+        if baseline is None:
+            print('{:28} {:12.1f} us'.format(name, results[name] * 1e6),
+                  file=out)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'mario': mario.__version__,
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold, out)
+
+        if regressions:
+            print('{} benchmarks regressed.'.format(len(regressions)),
+                  file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
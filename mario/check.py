@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Static checks of compiled rules: patterns that don't compile and rules
+# that can never match. The first rule to match a message wins, so a rule
+# is dead if an earlier one matches whenever it would, which is the case if
+# every clause of the earlier rule is one of its own clauses. That only
+# holds while the clauses don't depend on what other clauses did, so rules
+# rewriting variables or using match groups are only compared clause for
+# clause.
+
+import itertools
+import re
+import sys
+
+
+# Rules with more match clauses than this are only checked for duplicates,
+# looking for subsets of their clauses takes 2**n lookups
+MAX_SUBSET_CLAUSES = 10
+
+
+class Problem:
+    """Something wrong with the rule named rule, the position-th one. dead
+    is set if the rule can never match."""
+
+    def __init__(self, rule, position, message, error=False, dead=False):
+        self.rule = rule
+        self.position = position
+        self.message = message
+        self.error = error
+        self.dead = dead
+
+    def __str__(self):
+        return '[{}] {}'.format(self.rule, self.message)
+
+    def __repr__(self):
+        return 'Problem({!r}, {!r})'.format(self.rule, self.message)
+
+
+def pattern_error(pattern):
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        return str(e)
+
+    return None
+
+
+def pattern_problems(rules):
+    """Return a Problem for every pattern of rules that didn't compile."""
+    problems = []
+
+    for position, rule in enumerate(rules):
+        for clause in rule.match_clauses:
+            if clause.name not in ('arg matches', 'arg istype'):
+                continue
+
+            for pattern in clause.arguments[1]:
+                # compile_pattern leaves the patterns it can't compile be
+                if isinstance(pattern, str):
+                    problems.append(Problem(
+                        rule.name, position, '{} {} {}: {}'.format(
+                            clause.name, clause.arguments[0], pattern,
+                            pattern_error(pattern)), error=True))
+
+    return problems
+
+
+def parsed_pattern_problems(rules):
+    """Return a Problem for every pattern of the parsed, not yet compiled,
+    rules that doesn't compile."""
+    problems = []
+
+    for position, (name, (match_lines, _)) in enumerate(rules):
+        for line in match_lines:
+            if line[1] not in ('matches', 'istype'):
+                continue
+
+            obj, verb, arg, patterns = line
+
+            for pattern in patterns:
+                error = pattern_error(pattern)
+
+                if error is not None:
+                    problems.append(Problem(
+                        name, position, '{} {} {} {}: {}'.format(
+                            obj, verb, arg, pattern, error), error=True))
+
+    return problems
+
+
+def clause_key(clause):
+    """What decides which messages clause matches."""
+    if clause.name == 'kind is':
+        # only the first kind is ever compared
+        return (clause.name, clause.arguments[0])
+
+    arg, patterns = clause.arguments[:2]
+
+    if clause.name == 'arg is':
+        return (clause.name, arg.text, patterns)
+
+    if clause.name == 'arg rewrite':
+        return (clause.name, arg.text, tuple(patterns))
+
+    # any of the patterns matching will do, in whatever order
+    return (clause.name, arg.text,
+            frozenset(getattr(p, 'pattern', p) for p in patterns))
+
+
+def independent(rule):
+    """Whether the clauses of rule match what they do no matter which other
+    clauses are evaluated before them."""
+    for clause in rule.match_clauses:
+        if clause.name == 'arg rewrite':
+            return False
+
+        if any(v.lstrip('\\').isdigit() for v in clause.variables):
+            return False
+
+    return True
+
+
+def reachability_problems(rules):
+    """Return a Problem for every rule that can never match, because an
+    earlier rule has the same clauses or matches whenever it would."""
+    problems = []
+    # clause keys in file order -> first rule with them
+    sequences = {}
+    # sets of clause keys -> first independent rule with them
+    sets = {}
+
+    for position, rule in enumerate(rules):
+        keys = [clause_key(c) for c in rule.match_clauses]
+        sequence = tuple(keys)
+        found = sequences.get(sequence)
+
+        if found is not None:
+            problems.append(Problem(rule.name, position,
+                                    'has the same clauses as [{}], which '
+                                    'comes first'.format(found), dead=True))
+            continue
+
+        sequences[sequence] = rule.name
+        clauses = frozenset(keys)
+
+        if independent(rule):
+            found = shadowing_rule(clauses, sets)
+
+            if found is not None:
+                problems.append(Problem(
+                    rule.name, position, 'can never match: [{}] comes first '
+                    'and matches whenever it would'.format(found), dead=True))
+                continue
+
+            sets.setdefault(clauses, rule.name)
+
+    return problems
+
+
+def shadowing_rule(clauses, sets):
+    """Return the name of the rule in sets whose clauses are a subset of
+    clauses, if any."""
+    if len(clauses) > MAX_SUBSET_CLAUSES:
+        return sets.get(clauses)
+
+    for size in range(len(clauses) + 1):
+        for subset in itertools.combinations(clauses, size):
+            found = sets.get(frozenset(subset))
+
+            if found is not None:
+                return found
+
+    return None
+
+
+def check_rules(rules):
+    """Return all the problems with rules, in the order of the rules."""
+    problems = pattern_problems(rules) + reachability_problems(rules)
+
+    return sorted(problems, key=lambda p: p.position)
+
+
+def prune(rules, problems):
+    """Return rules without the ones problems show can never match."""
+    dead = {p.position for p in problems if p.dead}
+
+    return [rule for i, rule in enumerate(rules) if i not in dead]
+
+
+def run(args, config, out=sys.stdout):
+    """Check the rules files for --check and return the exit status."""
+    from mario.core import compile_rules, parse_rules
+
+    # the patterns are checked along with everything else below
+    rules = parse_rules(args, config, check_patterns=False)
+
+    if rules is None:
+        return 1
+
+    problems = check_rules(compile_rules(rules))
+
+    for problem in problems:
+        print('{}: {}'.format('error' if problem.error else 'warning',
+                              problem), file=out)
+
+    if not problems:
+        print('No problems found in {} rules.'.format(len(rules)), file=out)
+        return 0
+
+    return 1
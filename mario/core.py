@@ -6,24 +6,36 @@
 import mimetypes
 import os
 import re
+import string
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 
 from enum import Enum
-from functools import reduce
+from functools import lru_cache, partial, reduce
 from urllib.parse import urlparse
 
+try:
+    from re import _parser as sre_parse
+except ImportError:     # before Python 3.11
+    import sre_parse
+
 import argparse
-import configparser
 import logging as log
-import magic
-import notify2
-import requests
 from xdg import BaseDirectory
 
-from mario.parser import make_parser, parse_rules_file
-from mario.util import ElasticDict
+from mario import check, mimemagic, net, replay, rulescache, startup, stats
+from mario.downloads import (DownloadError, download_to_temp,
+                             open_download_cache)
+from mario.downloads import default_path as default_download_path
+from mario.index import RuleIndex
+from mario.optimizer import AdaptiveOrder, optimize_rules
+from mario.payload import (PREFIX_SIZE, DataFile, Lazy, Payload,
+                           read_payload)
+from mario.typecache import (LazyTypeCache, buffer_key, cached_lookup,
+                             default_path, open_type_cache, url_key)
+from mario.util import Scope, boolean, print_parse_error
 
 
 class Kind(Enum):
@@ -33,13 +45,16 @@ class Kind(Enum):
 
 
 def lookup_content_type(url):
-    headers = {'User-agent': 'Mozilla/5.0 (Windows NT 6.3; rv:36.0) '
-                             'Gecko/20100101 Firefox/36.0'}
+    import requests
+
+    stats.count('network lookups')
 
     try:
-        request = requests.head(url, headers=headers)
+        request = net.head(url)
         response = request.headers['content-type']
-    except (requests.RequestException, KeyError):
+    except (requests.RequestException, net.Unavailable, KeyError) as e:
+        if isinstance(e, net.Unavailable):
+            log.info('Not looking up the Content-Type: {}'.format(e))
         return None, None
 
     if ';' in response:
@@ -65,6 +80,64 @@ def get_var_references(s):
             return
 
 
+def field_variable(field_name):
+    # {data.attr} and {data[0]} refer to data
+    return re.split(r'[.[]', field_name, maxsplit=1)[0]
+
+
+def compile_template(text):
+    """Return the variables text refers to, the variable if that's all
+    there is to it, and a function rendering it with a message."""
+    try:
+        fields = list(string.Formatter().parse(text))
+    except ValueError:
+        # a malformed template fails the same way when it's rendered
+        variables = unique(v.strip('{}') for v in get_var_references(text))
+        return tuple(variables), None, text.format_map
+
+    variables = tuple(unique(field_variable(name)
+                             for _, name, _, _ in fields if name is not None))
+
+    if not variables:
+        constant = ''.join(literal for literal, _, _, _ in fields)
+        return variables, None, lambda msg: constant
+
+    if len(fields) == 1 and fields[0] == ('', variables[0], '', None):
+        variable = variables[0]
+        return variables, variable, lambda msg: format(msg[variable])
+
+    return variables, None, text.format_map
+
+
+class Template:
+    """A format string compiled once into a renderer, with the variables it
+    refers to worked out up front.
+
+    Stands in for a plain string wherever a clause or action formats one
+    with the message.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.variables, self.variable, self.render = compile_template(text)
+
+    def format(self, **msg):
+        return self.render(msg)
+
+    def format_map(self, msg):
+        return self.render(msg)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return 'Template({!r})'.format(self.text)
+
+
+def unique(iterable):
+    return list(dict.fromkeys(iterable))
+
+
 def kind_is_func(msg, arguments, cache):
     try:
         return msg['kind'] == Kind[arguments[0]], msg, cache
@@ -75,13 +148,165 @@ def kind_is_func(msg, arguments, cache):
 def arg_is_func(msg, arguments, cache):
     arg, checks = arguments
 
-    ret = arg.format(**msg) in checks
+    ret = arg.format_map(msg) in checks
     return ret, msg, cache
 
 
+def bytes_value(msg, template):
+    """Return the value of the variable the template consists of if it's
+    binary, without copying it, or None otherwise."""
+    if not isinstance(template, Template) or template.variable is None:
+        return None
+
+    value = msg.get(template.variable)
+
+    if isinstance(value, Lazy):
+        payload = value.payload
+
+        if payload is not None and not payload.decode:
+            return payload.buffer()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+
+    return None
+
+
+# in a bytes pattern \d, \s and \w only match ASCII characters, which is
+# what they're taken to mean against binary data
+ASCII_CATEGORIES = (sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_SPACE,
+                    sre_parse.CATEGORY_WORD)
+
+
+def byte_safe(items):
+    r"""Whether the parsed regex items match bytes just like they match the
+    same bytes decoded with surrogateescape, taking \d, \s and \w to match
+    ASCII characters only: only ASCII literals, sets and those classes,
+    nothing matching any character, a negated class or a word boundary,
+    which all depend on what the non-ASCII characters are."""
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            if av >= 128:
+                return False
+        elif op == sre_parse.IN:
+            for set_op, set_av in av:
+                if set_op == sre_parse.LITERAL and set_av < 128:
+                    continue
+                if set_op == sre_parse.RANGE and set_av[1] < 128:
+                    continue
+                if set_op == sre_parse.CATEGORY \
+                        and set_av in ASCII_CATEGORIES:
+                    continue
+                return False
+        elif op == sre_parse.AT:
+            if av in (sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY):
+                return False
+        elif op == sre_parse.SUBPATTERN:
+            _, add_flags, _, p = av
+
+            if add_flags & re.IGNORECASE or not byte_safe(p):
+                return False
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                    getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+            if not byte_safe(av[2]):
+                return False
+        elif op == sre_parse.BRANCH:
+            if not all(byte_safe(p) for p in av[1]):
+                return False
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            if not byte_safe(av):
+                return False
+        elif op == sre_parse.ASSERT:
+            if not byte_safe(av[1]):
+                return False
+        elif op == sre_parse.GROUPREF_EXISTS:
+            _, yes, no = av
+
+            if not byte_safe(yes) or (no is not None and not byte_safe(no)):
+                return False
+        elif op != sre_parse.GROUPREF:
+            return False
+
+    return True
+
+
+@lru_cache(maxsize=None)
+def bytes_pattern(pattern):
+    """Return the pattern compiled to match bytes in place, or None if it
+    only matches the way it should against text."""
+    if isinstance(pattern, str):
+        try:
+            pattern = re.compile(pattern)
+        except re.error:
+            return None
+
+    try:
+        items = sre_parse.parse(pattern.pattern, pattern.flags)
+
+        if items.state.flags & re.IGNORECASE or not byte_safe(items):
+            return None
+
+        return re.compile(pattern.pattern.encode('ascii'),
+                          pattern.flags & ~re.UNICODE)
+    except (re.error, UnicodeEncodeError):
+        return None
+
+
+def decoded_text(buf, cache):
+    """The binary data buf as text, decoded once per message."""
+    decoded = cache.get('decoded')
+
+    if decoded is None or decoded[0] is not buf:
+        decoded = cache['decoded'] = (buf, str(buf, 'utf-8',
+                                               'surrogateescape'))
+
+    return decoded[1]
+
+
+def decode_group(m, i):
+    group = m.group(i)
+
+    if group is None:
+        return None
+
+    # surrogateescape gets the original bytes back when handed to a program
+    return group.decode('utf-8', 'surrogateescape')
+
+
 def arg_matches_func(msg, arguments, cache):
-    arg, patterns = arguments
-    arg = arg.format(**msg)
+    arg, patterns = arguments[:2]
+    buf = bytes_value(msg, arg)
+
+    if buf is not None:
+        if len(arguments) > 2:
+            bytes_patterns = arguments[2]
+        else:
+            bytes_patterns = [bytes_pattern(p) for p in patterns]
+
+        for pattern, compiled in zip(patterns, bytes_patterns):
+            if compiled is None:
+                m = re.search(pattern, decoded_text(buf, cache))
+
+                if m:
+                    msg.update({"\\{}".format(i): e
+                                for i, e in enumerate(m.groups())})
+                    return True, msg, cache
+
+                continue
+
+            # match the bytes in place and decode only the groups that get
+            # used
+            m = compiled.search(buf)
+
+            if m:
+                matches = {"\\{}".format(i): Lazy(partial(decode_group, m,
+                                                           i + 1))
+                           for i in range(m.re.groups)}
+                msg.update(matches)
+                return True, msg, cache
+
+        return False, msg, cache
+
+    arg = arg.format_map(msg)
 
     for pattern in patterns:
         m = re.search(pattern, arg)
@@ -95,60 +320,114 @@ def arg_matches_func(msg, arguments, cache):
         return False, msg, cache
 
 
+def split_rewrite_pattern(pattern):
+    return tuple(pattern.split(',', 2))
+
+
 def arg_rewrite_func(msg, arguments, cache):
     arg, patterns = arguments
 
     # Escape regex match group references in the argument, if any
-    arg = escape_match_group_references(arg)
+    if not isinstance(arg, Template):
+        arg = Template(escape_match_group_references(arg))
 
-    tmp = arg.format(**msg)
-    arg = arg.strip('{}')
+    value = msg.get(arg.variable) if arg.variable else None
+
+    if isinstance(value, Lazy) and value.payload is not None:
+        value = value.value
+
+    if isinstance(value, (str, bytes)):
+        # a variable on its own needn't be formatted into a copy
+        tmp = value
+    else:
+        tmp = arg.format_map(msg)
+
+    arg = str(arg).strip('{}')
 
     def split(acc, pattern):
-        return acc.replace(*pattern.split(',', 2))
+        if isinstance(pattern, str):
+            pattern = split_rewrite_pattern(pattern)
+        if isinstance(acc, bytes):
+            pattern = tuple(p.encode('utf-8') for p in pattern[:2]) + \
+                      pattern[2:]
+        return acc.replace(*pattern)
     tmp = reduce(split, patterns, tmp)
 
-    msg[arg] = tmp
+    # replace() hands back the very same object if there was nothing to
+    # replace, then there's nothing to record either
+    if tmp is not value:
+        msg[arg] = tmp
 
     return True, msg, cache
 
 
 def mime_from_buffer(buf):
-    try:
-        t = magic.from_buffer(buf, mime=True)
-    except AttributeError:
-        try:
-            m = magic.open(magic.MIME)
-            m.load()
-            t, _ = m.buffer(buf.encode('utf-8')).split(';')
-        except AttributeError:
-            log.error('Your \'magic\' module is unsupported. '
-                      'Install either https://github.com/ahupp/python-magic '
-                      'or https://github.com/file/file/tree/master/python '
-                      '(official \'file\' python bindings, available as the '
-                      'python-magic package on many distros)')
-
-            raise SystemExit
+    return mimemagic.detector.from_buffer(buf)
 
-    return t
+
+def url_content_type(url, store=None):
+    return cached_lookup(store, url_key(url),
+                         lambda: lookup_content_type(url)[0])
+
+
+def guess_url_type(url):
+    """Guess the mimetype of url from the url itself, unless strict content
+    lookup is on and only the Content-Type counts."""
+    if net.settings['strict content lookup']:
+        return None
+
+    return mimetypes.guess_type(url)[0]
+
+
+def prefetch_mimetype(url, cache):
+    """Start looking up the Content-Type of url in the background if its
+    mimetype can't be guessed from the url itself."""
+    if url in cache['pending'] or guess_url_type(url):
+        return
+
+    future = net.in_background(url_content_type, url, cache.get('store'))
+
+    if future is not None:
+        log.debug('Prefetching Content-Type of %s', url)
+        cache['pending'][url] = future
 
 
-def detect_mimetype(kind, var):
+def detect_mimetype(kind, var, store=None, pending=None):
+    if isinstance(var, Payload) and kind == Kind.url:
+        var = var.value()
+
     if kind == Kind.url:
-        t, _ = mimetypes.guess_type(var)
+        t = guess_url_type(var)
 
         if not t:
             log.debug('Failed mimetype guessing... '
                       'Trying Content-Type header.')
-            t, _ = lookup_content_type(var)
+
+            if pending and var in pending:
+                log.debug('Waiting for the prefetched Content-Type.')
+                t = pending.pop(var).result()
+            else:
+                t = url_content_type(var, store)
 
             if t:
                 log.debug('Content-Type: %s', t)
+            elif net.settings['content lookup failure'] == 'guess':
+                # the widest guess there is, including common non-standard
+                # types
+                t, _ = mimetypes.guess_type(var, strict=False)
+                log.debug('Failed fetching Content-Type, guessed %s.', t)
             else:
                 log.debug('Failed fetching Content-Type.')
 
     elif kind == Kind.raw:
-        t = mime_from_buffer(var)
+        if isinstance(var, Payload):
+            # libmagic looks no further than the prefix anyway
+            var = var.prefix
+        else:
+            var = var[:PREFIX_SIZE]
+
+        t = cached_lookup(store, buffer_key(var),
+                          lambda: mime_from_buffer(var))
     elif kind == Kind.text:
         t = 'text/plain'
     else:
@@ -159,14 +438,23 @@ def detect_mimetype(kind, var):
 
 def arg_istype_func(msg, arguments, cache):
     arg, patterns = arguments
-    arg = arg.format(**msg)
+    value = msg.get(arg.variable) if arg.variable else None
+
+    if isinstance(value, Lazy) and value.payload is not None:
+        # sniff the payload without reading all of it
+        arg = value.payload
+    elif isinstance(value, bytes):
+        arg = value
+    else:
+        arg = arg.format_map(msg)
 
     type_cache = cache['type']
 
-    if arg in type_cache.keys():
+    if arg in type_cache:
         t = type_cache[arg]
     else:
-        t = detect_mimetype(msg['kind'], arg)
+        t = detect_mimetype(msg['kind'], arg, cache.get('store'),
+                            cache.get('pending'))
 
     if t:
         type_cache[arg] = t
@@ -191,27 +479,52 @@ def arg_istype_func(msg, arguments, cache):
         return False, msg, cache
 
 
+def has_variables(msg, clause):
+    for var in clause.variables:
+        if var not in msg:
+            log.info('\t\tNo such variable: {{{var}}}'.format(
+                var=var.lstrip('\\')))
+            return False
+
+    return True
+
+
 def log_var_references(msg, action):
-    vs = get_var_references(action)
-    for v in vs:
-        var_name = v.strip('{}')
+    # formatting a value may mean reading all of the message data
+    if not log.getLogger().isEnabledFor(log.INFO):
+        return
 
+    for var_name in action.variables:
         log.info('\t\t{{{var}}} = {value}'.format(
             var=var_name.lstrip('\\'),
-            value=msg[var_name]))
+            value=msg.get(var_name)))
 
 
-def plumb_run_func(msg, argument_string):
+def format_run_arguments(msg, argument_templates):
+    for template in argument_templates:
+        log_var_references(msg, template)
+
     try:
-        log_var_references(msg, argument_string)
+        return [arg.format_map(msg) for arg in argument_templates]
     except KeyError as e:
-        log.info('\t\tNo such variable: {{{var}}}'.format(var=e.args[0]))
-        return False, msg
+        log.info('\t\tNo such variable: {{{var}}}'.format(
+            var=e.args[0].lstrip('\\')))
+        return None
+
+
+# Extra subprocess arguments for the programs actions launch. The daemon
+# points them at the environment and terminal of the client it's handling.
+launch_options = {}
 
-    arguments = [arg.format(**msg) for arg in argument_string.split()]
+
+def plumb_run_func(msg, argument_templates):
+    arguments = format_run_arguments(msg, argument_templates)
+
+    if arguments is None:
+        return False, msg
 
     try:
-        ret = subprocess.call(arguments)
+        ret = subprocess.call(arguments, **launch_options)
         if ret == 0:
             return True, msg
         else:
@@ -220,47 +533,108 @@ def plumb_run_func(msg, argument_string):
             return False, msg
     except FileNotFoundError as e:
         log.info("\t\tRule failed because there is no program named '%s' on "
-                 "the PATH.", format(e.strerror.split("'")[1]))
+                 "the PATH.", e.filename)
         return False, msg
 
 
-def plumb_notify_func(msg, arguments):
-    message = arguments.format(**msg)
-    n = notify2.Notification(msg['rule_name'], message)
-    n.show()
+def reap(proc):
+    ret = proc.wait()
+    log.info('Launched program %s (pid %d) exited with exit code %d.',
+             proc.args[0], proc.pid, ret)
 
-    return True, msg
 
+def keep_datafile(msg):
+    """Leave the {datafile} of msg, if it was written, to a launched program
+    that outlives the message."""
+    datafile = msg.get('datafile')
+
+    if isinstance(datafile, DataFile) and datafile.computed:
+        datafile.owner.keep()
+
+
+def plumb_spawn_func(msg, argument_templates, window=0.2):
+    """Launch the program in a session of its own and return without
+    waiting for it to finish.
+
+    The action fails only if the program can't be started or exits with a
+    non-zero exit code within the launch window (in seconds). A program still
+    running after it is reaped by a background thread.
+    """
+    arguments = format_run_arguments(msg, argument_templates)
+
+    if arguments is None:
+        return False, msg
 
-def plumb_download_func(msg, arguments):
     try:
-        log_var_references(msg, arguments)
-    except KeyError as e:
-        log.info('\t\tNo such variable: {{{var}}}'.format(var=e.args[0]))
+        proc = subprocess.Popen(arguments, stdin=subprocess.DEVNULL,
+                                start_new_session=True, **launch_options)
+    except FileNotFoundError as e:
+        log.info("\t\tRule failed because there is no program named '%s' on "
+                 "the PATH.", e.filename)
+        return False, msg
+    except OSError as e:
+        log.info('\t\tCouldn\'t launch %s: %s', arguments[0], e.strerror)
+        return False, msg
+
+    try:
+        ret = proc.wait(timeout=window)
+    except subprocess.TimeoutExpired:
+        log.info('\t\tLaunched %s (pid %d).', arguments[0], proc.pid)
+        keep_datafile(msg)
+        threading.Thread(target=reap, args=(proc,), daemon=True).start()
+        return True, msg
+
+    if ret == 0:
+        return True, msg
+    else:
+        log.info('\t\tLaunched program exited with non-zero exit code'
+                 ' (%s)', format(ret))
         return False, msg
 
-    headers = {'User-agent': 'Mozilla/5.0 (Windows NT 6.3; rv:36.0) '
-               'Gecko/20100101 Firefox/36.0'}
 
-    tmp_dir = tempfile.gettempdir()
+def notifications():
+    """Return the notify2 module, connected to D-Bus on first use."""
+    import notify2
 
-    url = arguments.format(**msg)
+    if not notify2.is_initted():
+        with startup.step('initialize notifications'):
+            notify2.init('mario')
 
-    request = requests.get(url, headers=headers, stream=True)
+    return notify2
+
+
+def plumb_notify_func(msg, arguments):
+    notify2 = notifications()
+    message = arguments.format_map(msg)
+    n = notify2.Notification(msg['rule_name'], message)
+    n.show()
+
+    return True, msg
+
+
+def plumb_download_func(msg, arguments, downloads=None):
+    """Download the URL to the download cache, or to a temporary file if
+    there's none, and point {filename} at it."""
+    log_var_references(msg, arguments)
 
     try:
-        with tempfile.NamedTemporaryFile(prefix='plumber-', dir=tmp_dir, delete=False) as f:
-            for chunk in request.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
+        url = arguments.format_map(msg)
+    except KeyError as e:
+        log.info('\t\tNo such variable: {{{var}}}'.format(
+            var=e.args[0].lstrip('\\')))
+        return False, msg
 
-            msg['filename'] = f.name
-            return True, msg
-    except OSError as e:
+    try:
+        if downloads is not None:
+            msg['filename'] = downloads.fetch(url)
+        else:
+            msg['filename'] = download_to_temp(url)
+    except (OSError, DownloadError) as e:
         log.info('Error downloading file: ' + str(e))
         return False, msg
 
+    return True, msg
+
 
 match_clauses = {
     'kind is': kind_is_func,
@@ -272,30 +646,214 @@ match_clauses = {
 
 action_clauses = {
     'plumb run': plumb_run_func,
+    'plumb spawn': plumb_spawn_func,
     'plumb notify': plumb_notify_func,
     'plumb download': plumb_download_func,
 }
 
 
-def handle_rules(msg, rules):
+def stub_action(msg, arguments):
+    return True, msg
+
+
+# Actions that do nothing, for benchmarking and replaying messages
+STUB_ACTIONS = {name: stub_action for name in action_clauses}
+
+
+class Clause:
+    """A clause of a rule resolved to its function, with the arguments
+    prepared so nothing has to be parsed or compiled per message."""
+
+    def __init__(self, name, func, arguments, text=None, variables=()):
+        self.name = name
+        self.func = func
+        self.arguments = arguments
+        self.text = text
+        # the clause fails without being evaluated if one of these is missing
+        self.variables = variables
+
+        # filled in once the clause is timed
+        self.calls = self.passes = 0
+        self.seconds = 0.0
+        self.timed = False
+
+    def time(self):
+        """Count the calls and passes of the clause and the time they take.
+        The adaptive clause order and the stats share the one timer, so
+        timing a clause twice changes nothing."""
+        if self.timed:
+            return
+
+        func = self.func
+
+        # match and action clauses take different arguments, both return
+        # whether they passed first
+        def timed(*args):
+            start = time.perf_counter()
+            result = func(*args)
+
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+            self.passes += bool(result[0])
+
+            return result
+
+        self.func = timed
+        self.timed = True
+
+
+class Rule:
+    def __init__(self, name, match_clauses, action_clauses):
+        self.name = name
+        self.match_clauses = match_clauses
+        self.action_clauses = action_clauses
+
+        # whether the mimetype of the message data is worth prefetching
+        self.checks_data_type = any(
+            clause.name == 'arg istype' and
+            str(clause.arguments[0]) == '{data}'
+            for clause in match_clauses)
+
+
+def compile_pattern(pattern):
+    try:
+        return re.compile(pattern)
+    except re.error:
+        # parse_rules() leaves out files with bad patterns, so only rules
+        # parsed some other way get here; they fail when the clause is
+        # evaluated
+        return pattern
+
+
+def compile_match_clause(line):
+    obj, verb = line[0:2]
+    name = obj + ' ' + verb
+    arguments = line[2:]
+
+    if name == 'kind is':
+        arguments = tuple(arguments)
+    else:
+        arg, patterns = arguments
+
+        if name == 'arg is':
+            arguments = (Template(arg), frozenset(patterns))
+        elif name == 'arg rewrite':
+            arguments = (Template(escape_match_group_references(arg)),
+                         [split_rewrite_pattern(p) for p in patterns])
+        elif name == 'arg matches':
+            # binary data is matched as it is by the patterns that match
+            # bytes the way they match text
+            patterns = [compile_pattern(p) for p in patterns]
+            arguments = (Template(arg), patterns,
+                         [bytes_pattern(p) for p in patterns])
+        else:
+            arguments = (Template(arg),
+                         [compile_pattern(p) for p in patterns])
+
+    variables = arguments[0].variables if name != 'kind is' else ()
+
+    return Clause(name, match_clauses[name], arguments,
+                  variables=variables)
+
+
+def compile_action_clause(line, actions):
+    obj, verb, action = line
+    name = obj + ' ' + verb
+
+    # regex match group references (i.e. number variables, e.g. {0}) get
+    # prepended with a backslash (e.g. {\0}) so they can be referred by name
+    # in python's format() instead of being interpreted as positional
+    # arguments
+    escaped = escape_match_group_references(action)
+
+    if name in ('plumb run', 'plumb spawn'):
+        arguments = [Template(arg) for arg in escaped.split()]
+        variables = tuple(unique(v for t in arguments for v in t.variables))
+    else:
+        arguments = Template(escaped)
+        variables = arguments.variables
+
+    return Clause(name, actions[name], arguments, action, variables)
+
+
+def configured_actions(config):
+    """Return the action clauses as set up by the [mario] section."""
+    spawn = partial(plumb_spawn_func,
+                    window=float(config.get('launch window', 0.2)))
+    download = partial(plumb_download_func,
+                       downloads=open_download_cache(config))
+    actions = dict(action_clauses, **{'plumb spawn': spawn,
+                                      'plumb download': download})
+
+    if config.get('run mode', 'wait') == 'detach':
+        actions['plumb run'] = spawn
+
+    return actions
+
+
+def compile_rules(rules, actions=action_clauses):
+    """Turn parsed rules into Rule plans ready to be matched against."""
+    compiled = []
+
+    for rule_name, (match_lines, action_lines) in rules:
+        compiled += [Rule(rule_name,
+                          [compile_match_clause(l) for l in match_lines],
+                          [compile_action_clause(l, actions)
+                           for l in action_lines])]
+
+    return compiled
+
+
+def handle_rules(msg, rules, store=None):
+    """Run the actions of the first rule matching msg. Return the name of
+    that rule and whether all of its actions succeeded, or (None, False) if
+    no rule matched.
+
+    The network requests made on the way all have to be done by the message
+    deadline."""
+    collector = stats.collector
+
+    with net.Deadline():
+        if collector is None:
+            return match_rules(msg, rules, store, {})
+
+        start = time.perf_counter()
+        result = match_rules(msg, rules, store, collector.type_memo())
+
+    collector.message_handled(result[0], time.perf_counter() - start)
+
+    return result
+
+
+def match_rules(msg, rules, store, type_cache):
     log.info('Matching message against rules.')
 
+    if rules.adaptive is not None:
+        rules.adaptive.message_handled(rules)
+
     cache = {
-        'type': {},
+        'type': type_cache,
+        'store': store,
+        'pending': {},
     }
 
-    for rule in rules:
-        rule_name, rule_lines = rule
+    candidates = rules.candidates(msg)
 
-        match_lines, action_lines = rule_lines
-        log.debug('Matching against rule [%s]', rule_name)
+    # the cheap clauses of the rules can be evaluated while the HEAD request
+    # is in flight
+    if (msg['kind'] == Kind.url and
+            any(rule.checks_data_type for rule in candidates)):
+        prefetch_mimetype(format(msg['data']), cache)
 
-        for line in match_lines:
-            obj, verb = line[0:2]
-            arguments = line[2:]
+    for rule in candidates:
+        log.debug('Matching against rule [%s]', rule.name)
+        savepoint = msg.savepoint()
 
-            f = match_clauses[obj + ' ' + verb]
-            res, msg, cache = f(msg, arguments, cache)
+        for clause in rule.match_clauses:
+            if clause.variables and not has_variables(msg, clause):
+                res = False
+            else:
+                res, msg, cache = clause.func(msg, clause.arguments, cache)
 
             if not res:
                 rule_matched = False
@@ -304,38 +862,40 @@ def handle_rules(msg, rules):
             rule_matched = True
 
         if rule_matched:
-            log.info('Rule [%s] matched.', rule_name)
-            msg['rule_name'] = rule_name
+            log.info('Rule [%s] matched.', rule.name)
+            msg['rule_name'] = rule.name
+            stats.rule_matched(rule)
 
-            for line in action_lines:
-                obj, verb, action = line
+            for clause in rule.action_clauses:
                 log.info('\tExecuting action "%s = %s" for rule [%s].',
-                         obj + ' ' + verb, action, rule_name)
+                         clause.name, clause.text, rule.name)
 
-                # regex match group references (i.e. number variables, e.g.
-                # {0}) get prepended with a backslash (e.g. {\0}) so they can
-                # be referred by name in python's format() instead of being
-                # interpreted as positional arguments
-                action = escape_match_group_references(action)
+                if clause.variables and not has_variables(msg, clause):
+                    res = False
+                else:
+                    res, msg = clause.func(msg, clause.arguments)
 
-                f = action_clauses[obj + ' ' + verb]
-                res, msg = f(msg, action)
                 if not res:
                     break
-            break
+            else:
+                res = True
+
+            return rule.name, res
         else:
-            msg.reverse()   # reset all changes to the message made in this rule
+            msg.rollback(savepoint)     # undo what this rule changed
     else:
         log.info('No rule matched.')
 
+    return None, False
+
 
-def parse_arguments():
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='count',
                         help='increase log verbosity level (pass multiple times)')
-    parser.add_argument('msg', help='message to handle')
+    parser.add_argument('msg', help='message to handle', nargs='?')
 
-    group = parser.add_mutually_exclusive_group(required=True)
+    group = parser.add_mutually_exclusive_group()
     group.add_argument('kind', help='kind of message',
                        nargs='?',
                        choices=[k.name for k in Kind])
@@ -347,11 +907,73 @@ def parse_arguments():
     parser.add_argument('--rules',
                         help='rules file to use')
 
+    parser.add_argument('--parser', choices=['pyparsing', 'fast'],
+                        help='rules parser to use')
+    parser.add_argument('--reparse', action='store_true',
+                        help='parse the rules file even if it hasn\'t changed '
+                        'since it was last cached')
+
     parser.add_argument('--print-mimetype', action='store_true',
                         help='detect and print the mimetype of the message data, '
                         'then exit')
 
-    args = parser.parse_args()
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and handle messages sent by '
+                        'mario-client over a unix socket')
+    parser.add_argument('--socket',
+                        help='socket the daemon listens on')
+
+    parser.add_argument('--type-cache', choices=['list', 'purge', 'expire'],
+                        help='list the cached mimetypes, remove all of them '
+                        'or only the expired ones, then exit')
+
+    parser.add_argument('--check', action='store_true',
+                        help='check the rules for patterns that don\'t '
+                        'compile and rules that can never match, then exit')
+
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print how long each start-up step and the '
+                        'imports it needed took to stderr')
+
+    parser.add_argument('--stats', action='store_true',
+                        help='print a JSON summary of where the time went to '
+                        'stderr when done')
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='write the same statistics to FILE in the '
+                        'Prometheus text format')
+
+    parser.add_argument('--record', metavar='FILE',
+                        help='append every message handled, the rule it '
+                        'matched and how long that took to FILE, for '
+                        'replaying with python -m mario.replay')
+
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help='plumb each message read from FILE (default: '
+                        'stdin) and print a JSON result line for each')
+    parser.add_argument('--batch-format', choices=['lines', 'nul', 'ndjson'],
+                        default='lines',
+                        help='how messages are separated in batch mode: by '
+                        'newlines, NUL bytes or as one JSON object per line')
+
+    args = parser.parse_args(argv)
+
+    if args.batch is not None:
+        # the only positional in batch mode is the kind, but argparse fills
+        # msg first
+        if args.msg is not None:
+            if args.kind or args.msg not in Kind.__members__:
+                parser.error('batch mode reads its messages from {}, not '
+                             'from the command line'.format(args.batch))
+            args.kind, args.msg = args.msg, None
+
+        if (not args.kind and not args.guess and
+                args.batch_format != 'ndjson'):
+            parser.error('one of the arguments kind --guess is required')
+    elif not args.daemon and not args.type_cache and not args.check:
+        if args.msg is None:
+            parser.error('the following arguments are required: msg')
+        if not args.kind and not args.guess:
+            parser.error('one of the arguments kind --guess is required')
 
     if args.kind:
         args.kind = Kind[args.kind]
@@ -359,73 +981,259 @@ def parse_arguments():
     return args
 
 
+LOG_FORMAT = '%(levelname)s:\t%(message)s'
+
+
+def log_level(verbosity):
+    log_levels = {
+        1: log.WARNING,
+        2: log.INFO,
+        3: log.DEBUG
+    }
+
+    return log_levels.get(verbosity, log.DEBUG)
+
+
 def setup_logger(verbosity):
     if verbosity:
-        log_levels = {
-            1: log.WARNING,
-            2: log.INFO,
-            3: log.DEBUG
-        }
-        try:
-            verbosity = log_levels[verbosity]
-        except KeyError:
-            verbosity = log.DEBUG
-
-        log.basicConfig(format='%(levelname)s:\t%(message)s', level=verbosity)
+        log.basicConfig(format=LOG_FORMAT, level=log_level(verbosity))
 
     else:
-        log.basicConfig(format='%(levelname)s:\t%(message)s')
-
+        log.basicConfig(format=LOG_FORMAT)
 
-def parse_rules(args, config):
-    parser = make_parser()
 
+def rules_filename(args, config):
     if args.rules:
-        rules_filename = args.rules
+        return args.rules
     else:
-        rules_filename = config['rules file']
+        return config['rules file']
+
+
+def rules_fragments(args, config):
+    """Return the paths of the *.plumb files in the rules dir, in the order
+    their rules are tried in. The rules dir isn't used with --rules."""
+    directory = config.get('rules dir')
+
+    if args.rules or not directory:
+        return []
+
+    directory = os.path.expanduser(directory)
 
     try:
-        with open(rules_filename) as rules_file:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+
+    return [os.path.join(directory, name) for name in names
+            if name.endswith('.plumb') and not name.startswith('.')]
+
+
+def rules_sources(args, config):
+    """Return the paths of all the files rules are loaded from."""
+    return [rules_filename(args, config)] + rules_fragments(args, config)
+
+
+@lru_cache(maxsize=None)
+def pyparsing_parser():
+    from mario.parser import make_parser
+
+    return make_parser()
+
+
+def print_file_parse_error(filename, e):
+    print('Syntax error in {}:'.format(filename))
+    print_parse_error(e)
+
+
+def parse_rules_file(filename, args, config, check_patterns=True):
+    """Parse a single rules file, or return its cached rules if it hasn't
+    changed. Return None if it can't be read, has a syntax error or, if
+    check_patterns is set, a pattern that doesn't compile, which is
+    reported along with the file name."""
+    try:
+        with open(filename) as rules_file:
             log.info('Using rules file {}'.format(rules_file.name))
-            rules = parse_rules_file(parser, rules_file)
+            content = rules_file.read()
+            st = os.fstat(rules_file.fileno())
     except OSError as e:
         log.error('Rules file doesn\'t exist: {}'.format(e.filename))
         return None
 
+    rules = None if args.reparse else rulescache.load(filename, st, content)
+
+    if rules is not None:
+        log.debug('Using cached rules.')
+    else:
+        rules = parse_rules_content(filename, content, args, config)
+
+        if rules:
+            rulescache.store(filename, st, content, rules)
+
+    if rules and check_patterns:
+        problems = check.parsed_pattern_problems(rules)
+
+        # rather than when a message gets to them
+        for problem in problems:
+            log.error('Bad pattern in {}: {}'.format(filename, problem))
+
+        if problems:
+            return None
+
     return rules
 
 
+def parse_rules_content(filename, content, args, config):
+    """Parse the rules read from filename with the configured parser."""
+    handler = partial(print_file_parse_error, filename)
+
+    if all(not line.strip() or line.lstrip().startswith('#')
+           for line in content.splitlines()):
+        # a fragment may well have all of its rules commented out
+        rules = []
+    elif (args.parser or config.get('parser')) == 'fast':
+        from mario.fastparser import parse_rules_string
+
+        rules = parse_rules_string(content.rstrip(), handler)
+    else:
+        # pyparsing is only needed when the rules cache can't be used
+        from mario.parser import (catch_parse_errors, parse_rules_string_exc,
+                                  extract_plain_parse_result)
+
+        parse = catch_parse_errors(parse_rules_string_exc, handler)
+        rules = parse(pyparsing_parser(), content.rstrip(),
+                      extract_plain_parse_result)
+
+    return rules
+
+
+def parse_rules(args, config, check_patterns=True):
+    """Parse the rules file followed by the fragments in the rules dir.
+
+    A fragment that can't be parsed, or has a pattern that doesn't compile
+    if check_patterns is set, is left out after its errors are reported;
+    the rules file has to parse, and exist unless there are fragments.
+    """
+    filename = rules_filename(args, config)
+    fragments = rules_fragments(args, config)
+
+    if fragments and not os.path.exists(filename):
+        log.info('No rules file {}, using only {}'.format(
+            filename, config.get('rules dir')))
+        rules = []
+    else:
+        rules = parse_rules_file(filename, args, config, check_patterns)
+
+        if rules is None:
+            return None
+
+    for fragment in fragments:
+        fragment_rules = parse_rules_file(fragment, args, config,
+                                          check_patterns)
+
+        if fragment_rules is None:
+            log.error('Skipping the rules in {}'.format(fragment))
+        else:
+            rules += fragment_rules
+
+    return rules
+
+
+def load_rules(args, config, actions=None):
+    """Parse and compile the rules, with the configured actions unless
+    others are given."""
+    rules = parse_rules(args, config)
+
+    if not rules:
+        return rules
+
+    if actions is None:
+        actions = configured_actions(config)
+
+    rules = compile_rules(rules, actions)
+
+    if boolean(config.get('prune rules', False)):
+        problems = check.reachability_problems(rules)
+
+        for problem in problems:
+            log.info('Leaving out [{}], it {}'.format(problem.rule,
+                                                       problem.message))
+
+        rules = check.prune(rules, problems)
+
+    order = config.get('clause order', 'cost')
+
+    if order not in ('file', 'cost', 'adaptive'):
+        log.warning('Unknown clause order {!r}, using cost.'.format(order))
+
+    if order != 'file':
+        optimize_rules(rules)
+
+    index = RuleIndex(rules)
+
+    if order == 'adaptive':
+        index.adaptive = AdaptiveOrder(rules)
+
+    if stats.collector is not None:
+        stats.collector.instrument(rules)
+
+    return index
+
+
+def default_config_path():
+    return os.path.join(BaseDirectory.xdg_config_home, 'mario', 'config')
+
+
 def parse_config(args):
     def_rules_dir = os.path.join(BaseDirectory.xdg_config_home, 'mario',
                                  'rules.d')
     def_rules_file = os.path.join(BaseDirectory.xdg_config_home, 'mario',
                                   'mario.plumb')
     defaults = {
-        'strict content lookup': False, # TODO
+        'strict content lookup': False,
+        'content lookup failure': 'guess',
         'notifications': False,         # TODO
         'rules file': def_rules_file,
-        'rules dir': def_rules_dir,     # TODO
+        'rules dir': def_rules_dir,
+        'parser': 'pyparsing',
+        'clause order': 'cost',
+        'prune rules': False,
+        'download cache': default_download_path(),
+        'download cache size': 512,
+        'run mode': 'wait',
+        'launch window': 0.2,
+        'type cache': default_path(),
+        'type cache ttl': 86400,
+        'type cache negative ttl': 300,
+        'type cache size': 10000,
+        'connect timeout': 3.05,
+        'read timeout': 10,
+        'retries': 2,
+        'retry backoff': 0.2,
+        'connections per host': 4,
+        'message deadline': 60,
+        'breaker failures': 3,
+        'breaker cooldown': 60,
+        'metrics file': '',
+        'record file': '',
     }
 
-    config = configparser.ConfigParser(defaults=defaults,
-                                       default_section='mario')
-
     config_file = None
 
     if args.config:
         config_file = args.config
     else:
-        default_config = os.path.join(BaseDirectory.xdg_config_home, 'mario',
-                                      'config')
         try:
-            config_file = open(default_config)
+            config_file = open(default_config_path())
         except OSError as e:
             log.info('Config file doesn\'t exist: {}'.format(e.filename))
             return defaults
 
     log.info('Using config file {}'.format(config_file.name))
 
+    import configparser
+
+    config = configparser.ConfigParser(defaults=defaults,
+                                       default_section='mario')
     config.read_file(config_file)
     config_file.close()
 
@@ -434,68 +1242,206 @@ def parse_config(args):
     return config.defaults()
 
 
-def main():
-    # suppress most log messages from requests
-    log.getLogger("requests").setLevel(log.WARNING)
-
-    args = parse_arguments()
+def guess_kind(args):
+    log.info('Using heuristics to guess kind...')
 
-    setup_logger(args.verbose)
-
-    # initialize Desktop Notifications
-    notify2.init('mario')
+    if isinstance(args.msg, Payload):
+        text = args.msg.text_prefix()
 
-    # Use - to indicate the data part of the message will be read from
-    # stdin.
-    #
-    # XXX: '-' is valid message data, though, so we may want to handle
-    # this differently, but it suffices for now
-    if args.msg == '-':
-        args.msg = sys.stdin.buffer.read()
-
-    if args.guess:
-        log.info('Using heuristics to guess kind...')
-
-        if type(args.msg) is bytes:
-            try:
-                args.msg = args.msg.decode('utf-8')
-            except UnicodeDecodeError:
-                args.kind = Kind.raw
-
-        if type(args.msg) is str:
-            url = urlparse(args.msg)
+        if text is None:
+            args.kind = Kind.raw
+        else:
+            args.msg.decode = True
 
-            if url.scheme:
+            # nothing that doesn't fit in the prefix is a URL
+            if not args.msg.spooled and urlparse(text).scheme:
                 args.kind = Kind.url
             else:
                 args.kind = Kind.text
 
         log.info('\tGuessed kind {}'.format(args.kind))
+        return
 
-    if args.print_mimetype:
-        print(detect_mimetype(args.kind, args.msg))
-        sys.exit(0)
+    if type(args.msg) is bytes:
+        try:
+            args.msg = args.msg.decode('utf-8')
+        except UnicodeDecodeError:
+            args.kind = Kind.raw
+
+    if type(args.msg) is str:
+        url = urlparse(args.msg)
+
+        if url.scheme:
+            args.kind = Kind.url
+        else:
+            args.kind = Kind.text
+
+    log.info('\tGuessed kind {}'.format(args.kind))
 
-    config = parse_config(args)
 
+def make_message(args):
     msg = {'data': args.msg,
            'kind': args.kind
           }
 
+    if isinstance(args.msg, Payload):
+        # read all of the data only if something refers to it
+        msg['data'] = Lazy(args.msg.value, args.msg)
+        msg['datafile'] = DataFile(args.msg)
+
     if args.kind == Kind.url:
-        url = urlparse(args.msg)
+        url = urlparse(args.msg.value() if isinstance(args.msg, Payload)
+                       else args.msg)
         msg['netloc'] = url.netloc
         msg['netpath'] = url.path
 
-    rules = parse_rules(args, config)
+    return msg
+
+
+def plumb(args, config, rules=None, out=sys.stdout, store=None):
+    """Handle the message described by args and return the exit status.
+
+    Rules are parsed from the configured rules file and the type cache is
+    opened unless already loaded ones are passed in.
+    """
+    if args.guess:
+        guess_kind(args)
+
+    net.configure(config)
+
+    if store is None:
+        # opened once a lookup needs it, many messages never do
+        store = LazyTypeCache(config)
+
+    if args.print_mimetype:
+        with startup.step('detect mimetype'):
+            print(detect_mimetype(args.kind, args.msg, store), file=out)
+        return 0
+
+    msg = make_message(args)
+    timings = {}
+
+    if rules is None:
+        start = time.perf_counter()
+
+        with startup.step('load rules'):
+            rules = load_rules(args, config)
+
+        timings['load rules'] = time.perf_counter() - start
 
     if not rules:
         log.info('Syntax error in rules file. Quitting...')
-        sys.exit(1)
+        return 1
     else:
         log.info('Rules parsed.')
 
-    handle_rules(ElasticDict(msg), rules)
+    start = time.perf_counter()
+
+    with startup.step('handle message'):
+        result = handle_rules(Scope(msg), rules, store)
+
+    if replay.recorder is not None:
+        timings['handle'] = time.perf_counter() - start
+        replay.record(args.msg, msg, result, timings)
+
+    return 0
+
+
+def manage_type_cache(action, config, out=sys.stdout):
+    store = open_type_cache(config)
+
+    if store is None:
+        log.error('The type cache is disabled or can\'t be opened.')
+        return 1
+
+    if action == 'list':
+        now = time.time()
+
+        for key, mimetype, expires, _ in store.entries():
+            state = 'expires in {:.0f}s'.format(expires - now) \
+                    if expires >= now else 'expired'
+            print(key, mimetype or '(failed)', state, sep='\t', file=out)
+    else:
+        removed = store.purge(expired_only=(action == 'expire'))
+        print('Removed {} entries.'.format(removed), file=out)
+
+    store.close()
+
+    return 0
+
+
+def plumb_input(args, config):
+    if args.batch is not None:
+        from mario.batch import plumb_batch
+        return plumb_batch(args, config)
+
+    # Use - to indicate the data part of the message will be read from
+    # stdin.
+    #
+    # XXX: '-' is valid message data, though, so we may want to handle
+    # this differently, but it suffices for now
+    if args.msg == '-':
+        args.msg = read_payload(sys.stdin.buffer)
+
+        try:
+            return plumb(args, config)
+        finally:
+            args.msg.close()
+
+    return plumb(args, config)
+
+
+def run(args):
+    setup_logger(args.verbose)
+
+    with startup.step('parse config'):
+        config = parse_config(args)
+
+    if args.type_cache:
+        return manage_type_cache(args.type_cache, config)
+
+    if args.check:
+        return check.run(args, config)
+
+    record_file = args.record or config.get('record file')
+
+    if record_file:
+        replay.start(record_file)
+
+    metrics_file = args.metrics_file or config.get('metrics file')
+
+    if args.stats or metrics_file:
+        stats.enable()
+
+    try:
+        if args.daemon:
+            from mario.daemon import serve
+
+            return serve(args, config, metrics_file)
+
+        return plumb_input(args, config)
+    finally:
+        stats.report(args.stats, metrics_file)
+        replay.stop()
+
+
+def main(argv=None):
+    # suppress most log messages from requests
+    log.getLogger("requests").setLevel(log.WARNING)
+
+    # started before the arguments are parsed so that's timed as well
+    if '--startup-profile' in (sys.argv[1:] if argv is None else argv):
+        startup.start()
+
+    try:
+        with startup.step('parse arguments'):
+            args = parse_arguments(argv)
+
+        status = run(args)
+    finally:
+        startup.stop()
+
+    sys.exit(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# The client half of this module is what gets started for every message when
+# a daemon is running, so only cheap standard library modules are imported
+# here. Everything heavy is pulled in by the daemon through mario.core.
+import contextlib
+import io
+import json
+import logging as log
+import os
+import shutil
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import time
+
+
+# Seconds a client gets to send its request
+CLIENT_TIMEOUT = 5
+
+# The metrics file is written at most this often, in seconds
+METRICS_INTERVAL = 10
+
+
+def socket_path():
+    try:
+        return os.environ['MARIO_SOCKET']
+    except KeyError:
+        pass
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'mario', 'socket')
+    else:
+        return os.path.join(tempfile.gettempdir(),
+                            'mario-{}'.format(os.getuid()), 'socket')
+
+
+def check_socket_dir(path):
+    """Raise PermissionError unless the directory holding the socket path is
+    a real directory only the user can get at. Anyone else able to put a
+    socket there would get the client's environment, stdin, stdout and
+    stderr."""
+    directory = os.path.dirname(os.path.abspath(path))
+    st = os.lstat(directory)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+            or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError('{} is not a directory with mode 0700 owned '
+                              'by the user'.format(directory))
+
+
+def peer_uid(conn):
+    """The uid of the process at the other end of conn, or None if the
+    platform can't tell."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+
+    return uid
+
+
+def client_socket_path(argv):
+    """The socket --socket in argv names, or the default one."""
+    for i, arg in enumerate(argv):
+        if arg == '--socket' and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--socket='):
+            return arg.split('=', 1)[1]
+
+    return socket_path()
+
+
+def send(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+def receive(sock):
+    with sock.makefile('rb') as f:
+        line = f.readline()
+
+    if not line:
+        return None
+
+    return json.loads(line.decode('utf-8'))
+
+
+@contextlib.contextmanager
+def client_log(verbosity, stream):
+    """Copy the log records of a request to stream at the level the
+    client's -v asks for, leaving the daemon's own log as it was."""
+    if not verbosity:
+        yield
+        return
+
+    from mario.core import LOG_FORMAT, log_level
+
+    root = log.getLogger()
+    previous = root.level
+    levels = [(h, h.level) for h in root.handlers]
+
+    for h, level in levels:
+        h.setLevel(max(level, previous))
+
+    handler = log.StreamHandler(stream)
+    handler.setFormatter(log.Formatter(LOG_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(min(previous, log_level(verbosity)))
+
+    try:
+        yield
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(previous)
+
+        for h, level in levels:
+            h.setLevel(level)
+
+
+def file_key(path):
+    """What tells whether the file at path changed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None, None)
+
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+class Daemon:
+    """Handles requests with the rules and the config loaded once, reloading
+    them whenever their files change. config_file is where config was read
+    from, if anywhere."""
+
+    def __init__(self, config, config_file=None):
+        from mario.typecache import open_type_cache
+
+        self.config = config
+        self.config_file = config_file
+        self.config_key = file_key(config_file) if config_file else None
+        self.rules = {}
+        self.store = open_type_cache(config)
+
+    def current_config(self):
+        """Return the daemon's config, read again if its file changed."""
+        import argparse
+
+        from mario.core import parse_config
+        from mario.typecache import open_type_cache
+
+        if self.config_file is None:
+            return self.config
+
+        key = file_key(self.config_file)
+
+        if key == self.config_key:
+            return self.config
+
+        log.info('(Re)loading config from {}'.format(self.config_file))
+
+        try:
+            config_file = open(self.config_file)
+        except OSError:
+            config_file = None     # back to the defaults
+
+        self.config = parse_config(argparse.Namespace(config=config_file))
+        self.config_key = key
+
+        if self.store is not None:
+            self.store.close()
+        self.store = open_type_cache(self.config)
+
+        return self.config
+
+    def actions(self, config):
+        from mario.core import configured_actions
+
+        # requests are handled one at a time, so waiting for a program to
+        # exit would hold up every other client until it does
+        return configured_actions(dict(config, **{'run mode': 'detach'}))
+
+    def rules_for(self, args, config):
+        """Return the rules for a request, loaded again unless the files
+        they come from, the config and the arguments affecting how they're
+        loaded are all the same as last time."""
+        from mario.core import load_rules, rules_sources
+
+        sources = [os.path.abspath(path)
+                   for path in rules_sources(args, config)]
+        files = tuple(file_key(path) for path in sources)
+
+        if all(mtime is None for _, mtime, _ in files):
+            # let load_rules report the missing file
+            return load_rules(args, config, self.actions(config))
+
+        key = (files, tuple(sorted(config.items())), args.parser)
+
+        try:
+            cached_key, rules = self.rules[sources[0]]
+            if cached_key == key and not args.reparse:
+                return rules
+        except KeyError:
+            pass
+
+        log.info('(Re)loading rules from {}'.format(', '.join(sources)))
+        rules = load_rules(args, config, self.actions(config))
+
+        if rules:
+            self.rules[sources[0]] = (key, rules)
+
+        return rules
+
+    def handle(self, request, fds=()):
+        """Handle a request, reading - from the client's stdin and launching
+        programs in the client's environment and with the client's stdout
+        and stderr if fds holds those three."""
+        from mario import core
+        from mario.core import parse_arguments
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+
+        if request.get('env') is not None:
+            core.launch_options['env'] = request['env']
+
+        stdin = None
+
+        if len(fds) == 3:
+            stdin, core.launch_options['stdout'], \
+                core.launch_options['stderr'] = fds
+
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            try:
+                os.chdir(request['cwd'])
+
+                args = parse_arguments(request['argv'])
+
+                with client_log(args.verbose, sys.stderr):
+                    status = self.plumb(args, stdin)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                log.exception('Error while handling message')
+                status = 1
+            finally:
+                core.launch_options.clear()
+
+        return {'status': status,
+                'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue()}
+
+    def plumb(self, args, stdin=None):
+        from mario.core import parse_config
+        from mario.payload import read_payload
+
+        if args.daemon:
+            print('mario: already talking to a daemon', file=sys.stderr)
+            return 1
+
+        if args.batch is not None:
+            print('mario: batch mode doesn\'t go through the daemon',
+                  file=sys.stderr)
+            return 1
+
+        if args.type_cache or args.check:
+            print('mario: --type-cache and --check don\'t go through the '
+                  'daemon', file=sys.stderr)
+            return 1
+
+        if args.config:
+            config = parse_config(args)
+        else:
+            config = self.current_config()
+
+        if args.msg == '-' and stdin is not None:
+            if not stat.S_ISREG(os.fstat(stdin).st_mode):
+                # reading a pipe could keep every other client waiting
+                print('mario: standard input has to be spooled to a file '
+                      'by mario-client', file=sys.stderr)
+                return 1
+
+            # the fd is closed along with the others once the request is done
+            with os.fdopen(stdin, 'rb', closefd=False) as f:
+                args.msg = read_payload(f)
+
+            try:
+                return self.plumb_message(args, config)
+            finally:
+                args.msg.close()
+
+        return self.plumb_message(args, config)
+
+    def plumb_message(self, args, config):
+        from mario.core import plumb
+
+        if args.print_mimetype:
+            return plumb(args, config, out=sys.stdout, store=self.store)
+
+        rules = self.rules_for(args, config)
+
+        return plumb(args, config, rules or [], sys.stdout, self.store)
+
+
+def handle_connection(daemon, conn):
+    """Answer the request sent over conn, with the client's stdin, stdout
+    and stderr passed along with it."""
+    fds = []
+    conn.settimeout(CLIENT_TIMEOUT)
+
+    try:
+        uid = peer_uid(conn)
+
+        if uid is not None and uid != os.getuid():
+            log.warning('Dropped a client of uid {}'.format(uid))
+            return
+
+        _, fds, _, _ = socket.recv_fds(conn, 1, 3)
+        request = receive(conn)
+
+        if request is not None:
+            send(conn, daemon.handle(request, fds))
+    except (OSError, ValueError) as e:
+        # a client that never sends its request doesn't hold up the others
+        log.info('Dropped a client: {}'.format(e))
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def serve(args, config, metrics_file=None):
+    """Handle the requests of clients until interrupted, writing the metrics
+    file, if any, every METRICS_INTERVAL seconds as long as there are
+    some."""
+    from mario import stats
+
+    path = args.socket or socket_path()
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    try:
+        check_socket_dir(path)
+    except OSError as e:
+        log.error('Refusing to listen on {}: {}'.format(path, e))
+        return 1
+
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)     # stale socket from a dead daemon
+            else:
+                log.error('A daemon is already listening on {}'.format(path))
+                return 1
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    log.info('Listening on {}'.format(path))
+
+    if args.config:
+        config_file = args.config.name
+    else:
+        from mario.core import default_config_path
+        config_file = default_config_path()
+
+    daemon = Daemon(config, os.path.abspath(config_file))
+    next_report = 0
+
+    try:
+        while True:
+            conn, _ = server.accept()
+
+            with conn:
+                handle_connection(daemon, conn)
+
+            if metrics_file and time.monotonic() >= next_report:
+                stats.report(metrics_file=metrics_file)
+                next_report = time.monotonic() + METRICS_INTERVAL
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def spool_stdin():
+    """Read all of stdin into an anonymous temporary file unless it's a
+    regular file already, and put that on stdin in its place.
+
+    The daemon handles one client at a time, so it mustn't be left waiting
+    for a slow pipe or a terminal to be done writing.
+    """
+    if stat.S_ISREG(os.fstat(0).st_mode):
+        return
+
+    with os.fdopen(0, 'rb', closefd=False) as stdin, \
+            tempfile.TemporaryFile(prefix='mario-stdin-') as spool:
+        shutil.copyfileobj(stdin, spool)
+        spool.seek(0)
+        os.dup2(spool.fileno(), 0)
+
+
+def client_main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # a batch already runs in a single process, so it's just as well handled
+    # here as by the daemon, statistics and recordings are about a run of
+    # their own and checking the rules or managing the type cache has
+    # nothing to do with the daemon
+    batch = any(a.split('=')[0] in ('--batch', '--stats', '--metrics-file',
+                                    '--record', '--check', '--type-cache')
+                for a in argv)
+
+    if '-' in argv and not batch:
+        spool_stdin()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    path = client_socket_path(argv)
+
+    try:
+        if batch:
+            raise OSError
+
+        check_socket_dir(path)
+        sock.connect(path)
+    except OSError as e:
+        sock.close()
+
+        if isinstance(e, PermissionError):
+            print('mario-client: not using the daemon: {}'.format(e),
+                  file=sys.stderr)
+
+        # no daemon running, plumb in-process instead
+        from mario.core import main
+        main(argv)
+        return
+
+    with sock:
+        # the daemon reads a - message from our stdin itself, spooled by
+        # now, and the programs it launches write to our stdout and stderr
+        socket.send_fds(sock, [b'\0'], [0, 1, 2])
+        send(sock, {'argv': argv, 'cwd': os.getcwd(),
+                    'env': dict(os.environ)})
+        response = receive(sock)
+
+    if response is None:
+        sys.exit('mario-client: the daemon closed the connection')
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+
+    sys.exit(response['status'])
+
+
+if __name__ == '__main__':
+    client_main()
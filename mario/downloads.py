@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Files fetched by 'plumb download' are kept in a cache directory, named by
+# the sha256 of their contents so identical files are only stored once. A
+# small SQLite database maps URLs to those files along with the validators
+# the server sent, so plumbing a URL again only costs a conditional request.
+#
+# The files handed out are the cached ones themselves, shared by every URL
+# with the same contents, so they're read-only, and a file isn't evicted for
+# a while after it was last handed out, giving the program it went to time
+# to open it.
+
+import hashlib
+import logging as log
+import os
+import tempfile
+import threading
+import time
+
+from xdg import BaseDirectory
+
+from mario import net
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Seconds after it was last used that a file may be evicted
+KEEP_FOR = 300
+
+
+def default_path():
+    return os.path.join(BaseDirectory.xdg_cache_home, 'mario', 'downloads')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCache:
+    """Downloaded files by URL, revalidated with ETag and Last-Modified and
+    stored once per distinct content. The least recently used files are
+    removed once they take up more than max_bytes, but only once they
+    haven't been used for keep_for seconds.
+
+    Nothing is touched on disk until the first download.
+    """
+
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024,
+                 keep_for=KEEP_FOR):
+        self.path = path or default_path()
+        self.objects = os.path.join(self.path, 'objects')
+        self.max_bytes = max_bytes
+        self.keep_for = keep_for
+        self.lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+
+            os.makedirs(self.objects, exist_ok=True)
+
+            db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                 timeout=5, check_same_thread=False,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                       'url TEXT PRIMARY KEY, '
+                       'digest TEXT NOT NULL, '
+                       'etag TEXT, '
+                       'last_modified TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                       'digest TEXT PRIMARY KEY, '
+                       'size INTEGER NOT NULL, '
+                       'used REAL NOT NULL)')
+            self._db = db
+
+        return self._db
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def cached(self, url):
+        """Return (digest, etag, last_modified) of the file cached for url,
+        or None if there's none."""
+        with self.lock:
+            row = self.db.execute('SELECT digest, etag, last_modified '
+                                  'FROM urls WHERE url = ?',
+                                  (url,)).fetchone()
+
+        if row is None or not os.path.exists(self.object_path(row[0])):
+            return None
+
+        return row
+
+    def fetch(self, url):
+        """Return the path of an up to date copy of url, downloading it only
+        if the cached one, if any, has changed."""
+        import requests
+        import sqlite3
+
+        try:
+            cached = self.cached(url)
+        except sqlite3.Error as e:
+            raise DownloadError(str(e))
+
+        headers = {}
+
+        if cached is not None:
+            _, etag, last_modified = cached
+
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        try:
+            # the with block hands the connection back to the pool when done
+            with net.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    log.debug('\t\t%s not modified, using cached copy', url)
+                    digest = cached[0]
+                    self.touch(digest)
+                elif response.status_code // 100 == 2:
+                    digest, size = self.store_body(response)
+                    self.add(url, digest, size, response.headers)
+                else:
+                    raise DownloadError('HTTP status {} for {}'.format(
+                        response.status_code, url))
+        except (requests.RequestException, net.Unavailable,
+                sqlite3.Error) as e:
+            raise DownloadError(str(e))
+
+        path = self.object_path(digest)
+
+        # files cached before they were made read-only
+        if os.stat(path).st_mode & 0o222:
+            os.chmod(path, 0o444)
+
+        return path
+
+    def store_body(self, response):
+        sha256 = hashlib.sha256()
+        size = 0
+
+        fd, tmp = tempfile.mkstemp(prefix='.download-', dir=self.objects)
+
+        try:
+            with open(fd, 'wb', buffering=CHUNK_SIZE) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    # the read timeout only bounds the wait for each chunk
+                    net.check_deadline()
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            digest = sha256.hexdigest()
+            final = self.object_path(digest)
+
+            if os.path.exists(final):
+                log.debug('\t\tSame contents as cached %s', digest)
+                os.unlink(tmp)
+            else:
+                # a program changing it would change it for every URL
+                os.chmod(tmp, 0o444)
+                os.replace(tmp, final)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        return digest, size
+
+    def touch(self, digest):
+        with self.lock:
+            self.db.execute('UPDATE objects SET used = ? WHERE digest = ?',
+                            (time.time(), digest))
+
+    def add(self, url, digest, size, headers):
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                            (url, digest, headers.get('ETag'),
+                             headers.get('Last-Modified')))
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                            (digest, size, time.time()))
+            self.evict(keep=digest)
+
+    def evict(self, keep):
+        total, = self.db.execute('SELECT COALESCE(SUM(size), 0) '
+                                 'FROM objects').fetchone()
+        rows = self.db.execute('SELECT digest, size FROM objects '
+                               'WHERE digest != ? AND used < ? ORDER BY used',
+                               (keep, time.time() - self.keep_for)).fetchall()
+
+        for digest, size in rows:
+            if total <= self.max_bytes:
+                break
+
+            log.debug('Evicting cached download %s', digest)
+
+            self.db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+            self.db.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+
+            try:
+                os.unlink(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+            total -= size
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def download_to_temp(url):
+    """Download url to a new temporary file and return its path, for when
+    the cache is disabled."""
+    import requests
+
+    try:
+        with net.get(url, stream=True) as response:
+            if response.status_code // 100 != 2:
+                raise DownloadError('HTTP status {} for {}'.format(
+                    response.status_code, url))
+
+            with tempfile.NamedTemporaryFile(prefix='plumber-',
+                                             delete=False) as f:
+                try:
+                    for chunk in response.iter_content(
+                            chunk_size=CHUNK_SIZE):
+                        net.check_deadline()
+                        f.write(chunk)
+                except BaseException:
+                    f.close()
+                    os.unlink(f.name)
+                    raise
+
+            return f.name
+    except (requests.RequestException, net.Unavailable) as e:
+        raise DownloadError(str(e))
+
+
+def open_download_cache(config):
+    """Return the cache configured in the [mario] section, or None if it's
+    disabled."""
+    path = config.get('download cache')
+
+    if not path:
+        return None
+
+    max_bytes = float(config.get('download cache size', 512)) * 1024 * 1024
+
+    return DownloadCache(os.path.expanduser(path), int(max_bytes))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# A hand-written parser for the rules language. It accepts exactly what the
+# grammar in mario.parser accepts, returns the same rules as
+# extract_plain_parse_result and fails with the same messages and locations,
+# quirks included. It scans the input once and never backtracks further than
+# the current line, so it doesn't slow down on big rules files the way the
+# pyparsing grammar does.
+
+import string
+
+from mario.util import print_parse_error
+
+
+# Same character sets as the pyparsing grammar uses
+printables = ''.join(c for c in string.printable if c not in string.whitespace)
+alphas8bit = ''.join(chr(x) for x in range(0xc0, 0x100)
+                     if x not in (0xd7, 0xf7))
+alphas_extra = ''.join(chr(x) for x in range(0x100, 0x350))
+
+CHARS = frozenset(printables + alphas8bit + alphas_extra)
+NAME_CHARS = CHARS - set('{}[] ')
+IDENT_CHARS = frozenset(string.ascii_letters + string.digits + '_$')
+
+KINDS = ('url', 'raw', 'text')
+MATCH_VERBS = ('is', 'istype', 'matches', 'rewrite')
+ACTION_VERBS = ('run', 'spawn', 'notify', 'download')
+
+
+class ParseError(Exception):
+    """Parse error carrying the same details as pyparsing's exceptions."""
+
+    def __init__(self, pstr, loc, msg):
+        super().__init__(pstr, loc, msg)
+        self.pstr = pstr
+        self.loc = loc
+        self.msg = msg
+
+        start = pstr.rfind('\n', 0, loc) + 1
+        end = pstr.find('\n', loc)
+
+        self.lineno = pstr.count('\n', 0, loc) + 1
+        self.col = self.column = loc - start + 1
+        self.line = pstr[start:end] if end >= 0 else pstr[start:]
+
+    def __str__(self):
+        if self.pstr:
+            if self.loc >= len(self.pstr):
+                foundstr = ', found end of text'
+            else:
+                foundstr = (', found %r' % self.pstr[self.loc:self.loc + 1]
+                            ).replace(r'\\', '\\')
+        else:
+            foundstr = ''
+
+        return ('%s%s  (at char %d), (line:%d, col:%d)' %
+                (self.msg, foundstr, self.loc, self.lineno, self.column))
+
+
+class RulesParser:
+    def __init__(self, text):
+        # pyparsing expands tabs before parsing, so locations in errors refer
+        # to the expanded string and tabs never reach the tokens
+        self.s = text.expandtabs()
+        self.n = len(self.s)
+
+    def error(self, loc, msg):
+        # matching the end of the text moves past it, errors don't
+        return ParseError(self.s, min(loc, self.n), msg)
+
+    def skip_spaces(self, loc):
+        s, n = self.s, self.n
+
+        while loc < n and s[loc] == ' ':
+            loc += 1
+
+        return loc
+
+    def end_of_line(self, loc):
+        p = self.s.find('\n', loc)
+        return p if p >= 0 else self.n
+
+    def skip_comments(self, loc):
+        s, n = self.s, self.n
+
+        while True:
+            p = self.skip_spaces(loc)
+
+            if p >= n or s[p] != '#':
+                return loc
+
+            whole_line = p == 0 or s[p - 1] == '\n'
+            loc = self.end_of_line(p)
+
+            if whole_line:
+                # a comment starting in the first column takes the line
+                # ends and blank lines following it along
+                loc = loc + 1
+                while True:
+                    q = self.skip_spaces(loc)
+                    if q < n and s[q] == '#':
+                        q = self.end_of_line(q)
+                    if q < n and s[q] == '\n':
+                        loc = q + 1
+                    elif q == n:
+                        loc = n + 1
+                    else:
+                        break
+
+    def skip(self, loc):
+        return self.skip_spaces(self.skip_comments(loc))
+
+    def keyword(self, loc, kw):
+        s = self.s
+        end = loc + len(kw)
+
+        return (s.startswith(kw, loc) and
+                (end >= self.n or s[end] not in IDENT_CHARS) and
+                (loc == 0 or s[loc - 1] not in IDENT_CHARS))
+
+    def one_of(self, loc, keywords):
+        for kw in keywords:
+            if self.keyword(loc, kw):
+                return kw
+
+        return None
+
+    def word(self, loc, chars=CHARS):
+        s, n = self.s, self.n
+        end = loc
+
+        while end < n and s[end] in chars:
+            end += 1
+
+        return end
+
+    def line_end(self, loc, skip_spaces=True):
+        p = self.skip_comments(loc)
+
+        if skip_spaces:
+            p = self.skip_spaces(p)
+
+        if p < self.n and self.s[p] == '\n':
+            return p + 1, p
+        elif p == self.n:
+            return p + 1, p
+        else:
+            return None, p
+
+    def eol(self, loc, skip_spaces=True):
+        new, failed_at = self.line_end(loc, skip_spaces)
+
+        if new is None:
+            raise self.error(failed_at, 'Expected end of line')
+
+        while new is not None:
+            loc = new
+            new, _ = self.line_end(loc, skip_spaces)
+
+        return loc
+
+    def expect_keyword(self, loc, kw):
+        p = self.skip(loc)
+
+        if not self.keyword(p, kw):
+            raise self.error(p, 'Expected "{}"'.format(kw))
+
+        return p + len(kw)
+
+    def expect_one_of(self, loc, keywords, name):
+        p = self.skip(loc)
+        kw = self.one_of(p, keywords)
+
+        if kw is None:
+            raise self.error(loc, 'Expected ' + name)
+
+        return p + len(kw), kw
+
+    def pattern(self, loc):
+        s = self.s
+        patterns = []
+
+        while True:
+            p = self.skip_comments(loc)
+
+            if p >= self.n or s[p] != ' ':
+                break
+
+            p = self.skip(p)
+            end = self.word(p)
+
+            if end == p:
+                break
+
+            new, _ = self.line_end(end, skip_spaces=False)
+
+            if new is None:
+                break
+
+            patterns.append(s[p:end])
+            loc = self.eol(end, skip_spaces=False)
+
+        return loc, patterns
+
+    def rule(self, loc):
+        s = self.s
+
+        p = self.skip(loc)
+        if p >= self.n or s[p] != '[':
+            raise self.error(p, 'Expected "["')
+
+        p = self.skip(p + 1)
+        end = self.word(p, NAME_CHARS)
+        if end == p:
+            raise self.error(p, 'Expected rule name')
+        rule_name = s[p:end]
+
+        p = self.skip(end)
+        if p >= self.n or s[p] != ']':
+            raise self.error(p, 'Expected "]"')
+
+        loc = self.eol(p + 1)
+
+        loc = self.expect_keyword(loc, 'kind')
+        loc = self.expect_keyword(loc, 'is')
+        loc, kind = self.expect_one_of(loc, KINDS, 'kind')
+        loc = self.eol(loc)
+
+        match_lines = [['kind', 'is', kind]]
+
+        while True:
+            p = self.skip(loc)
+
+            if self.keyword(p, 'data'):
+                loc, verb = self.expect_one_of(p + 4, MATCH_VERBS, 'verb')
+                var = '{data}'
+            elif self.keyword(p, 'arg'):
+                loc, verb = self.expect_one_of(p + 3, MATCH_VERBS, 'verb')
+
+                p = self.skip(loc)
+                end = self.word(p)
+                if end == p:
+                    raise self.error(p, 'Expected variable')
+                var = s[p:end]
+
+                loc = end
+            else:
+                break
+
+            pattern_loc = self.skip_comments(loc)
+            loc, patterns = self.pattern(loc)
+
+            if not patterns:
+                raise self.error(pattern_loc, 'Expected pattern')
+
+            match_lines.append(['arg', verb, var, patterns])
+
+        action_lines = []
+
+        while True:
+            p = self.skip(loc)
+
+            if not self.keyword(p, 'plumb'):
+                if not action_lines:
+                    raise self.error(p, 'Expected object')
+                break
+
+            loc, verb = self.expect_one_of(p + 5, ACTION_VERBS, 'verb')
+
+            start = p = self.skip(loc)
+            end = self.word(p)
+            if end == p:
+                raise self.error(start, 'Expected action or url')
+
+            while end != p:
+                loc = end
+                p = self.skip(loc)
+                end = self.word(p)
+
+            action_lines.append(['plumb', verb, s[start:loc]])
+            loc = self.eol(loc)
+
+        return loc, [rule_name, (match_lines, action_lines)]
+
+    def parse(self):
+        rules = []
+
+        loc, rule = self.rule(0)
+        rules.append(rule)
+
+        while True:
+            p = self.skip(loc)
+
+            if p >= self.n or self.s[p] != '[':
+                break
+
+            loc, rule = self.rule(loc)
+            rules.append(rule)
+
+        p = self.skip(loc)
+
+        if p < self.n:
+            raise self.error(p, 'Expected end of text')
+
+        return rules
+
+
+def parse_rules_string_exc(rule_string):
+    return RulesParser(rule_string).parse()
+
+
+def parse_rules_file_exc(rules_file):
+    return parse_rules_string_exc(rules_file.read().rstrip())
+
+
+def parse_rules_string(rule_string, handler=print_parse_error):
+    try:
+        return parse_rules_string_exc(rule_string)
+    except ParseError as e:
+        handler(e)
+
+
+def parse_rules_file(rules_file, handler=print_parse_error):
+    try:
+        return parse_rules_file_exc(rules_file)
+    except ParseError as e:
+        handler(e)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import heapq
+import logging as log
+import re
+from collections import Counter
+
+try:
+    from re import _parser as sre_parse
+except ImportError:     # before Python 3.11
+    import sre_parse
+
+from mario import stats
+from mario.payload import Lazy
+
+
+# Variables whose 'arg is' literals are worth indexing on
+INDEXED_VARIABLES = ('netloc', 'data')
+
+# Literals needed by a 'data matches' pattern are looked up by their first
+# KEY_SIZE characters, so shorter ones can't be used
+KEY_SIZE = 3
+# Collecting the substrings of the data costs about as much per character
+# as a pattern search does per rule for this many characters, so the data is
+# only scanned if it's shorter than this times the number of rules filtered,
+# and never if it's longer than MAX_SCAN
+SCAN_PER_RULE = 16
+MAX_SCAN = 64 * 1024
+
+
+def literal_constraint(rule):
+    """Return (variable, literals) for the first 'arg is' clause of the rule
+    that checks an indexed variable before anything could rewrite it, or
+    None if there's no such clause."""
+    rewritten = set()
+
+    for clause in rule.match_clauses[1:]:
+        template = clause.arguments[0]
+
+        if clause.name == 'arg rewrite':
+            rewritten.add(str(template).strip('{}'))
+        elif clause.name == 'arg is':
+            var = str(template)[1:-1]
+
+            if (str(template) == '{' + var + '}' and
+                    var in INDEXED_VARIABLES and var not in rewritten):
+                return var, clause.arguments[1]
+
+    return None
+
+
+def required_literals(items):
+    """Yield strings that every match of the parsed regex items contains."""
+    run = []
+
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+
+        if run:
+            yield ''.join(run)
+            run = []
+
+        if op == sre_parse.SUBPATTERN:
+            _, add_flags, _, p = av
+
+            if not add_flags & re.IGNORECASE:
+                yield from required_literals(p)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, _, p = av
+
+            if low >= 1:
+                yield from required_literals(p)
+
+    if run:
+        yield ''.join(run)
+
+
+def pattern_literals(pattern):
+    """Return the literals of at least KEY_SIZE characters that every match
+    of the compiled pattern contains."""
+    if not isinstance(pattern, re.Pattern) or \
+            not isinstance(pattern.pattern, str) or \
+            pattern.flags & re.IGNORECASE:
+        return []
+
+    parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+
+    return [l for l in required_literals(parsed) if len(l) >= KEY_SIZE]
+
+
+def substring_constraint(rule):
+    """Return, for every pattern of a 'data matches' clause of the rule, the
+    literals any match of it contains, or None if some pattern has none. A
+    clause after a rewrite of the data doesn't count."""
+    for clause in rule.match_clauses[1:]:
+        template = str(clause.arguments[0])
+
+        if template != '{data}':
+            continue
+        elif clause.name == 'arg rewrite':
+            return None
+        elif clause.name == 'arg matches':
+            literals = [pattern_literals(p) for p in clause.arguments[1]]
+
+            if literals and all(literals):
+                return literals
+
+    return None
+
+
+class SubstringFilter:
+    """Rules by the literals their 'data matches' clause needs, so only the
+    rules that have one of them in the data are tried.
+
+    One pass over the data collects all of its KEY_SIZE long substrings and
+    only literals starting with one of those are searched for. Binary data
+    is searched for the UTF-8 encoded literals, which are in it exactly when
+    they're in the data decoded. Data too long for that to pay off gets all
+    of the rules.
+    """
+
+    def __init__(self, constrained):
+        # the literal needed by the fewest rules rules the most out
+        counts = Counter(literal for _, patterns in constrained
+                         for literals in patterns for literal in set(literals))
+
+        self.positions = []
+        self.max_scan = min(MAX_SCAN, SCAN_PER_RULE * len(constrained))
+        by_literal = {}
+
+        for i, patterns in constrained:
+            self.positions.append(i)
+
+            for literals in patterns:
+                literal = min(literals, key=lambda l: (counts[l], -len(l)))
+                by_literal.setdefault(literal, []).append(i)
+
+        # type of the data -> literal -> positions
+        self.by_literal = {
+            str: by_literal,
+            bytes: {literal.encode('utf-8'): positions
+                    for literal, positions in by_literal.items()},
+        }
+        # type of the data -> first KEY_SIZE characters -> literals
+        self.by_key = {}
+
+        for data_type, literals in self.by_literal.items():
+            by_key = self.by_key[data_type] = {}
+
+            for literal in literals:
+                by_key.setdefault(literal[:KEY_SIZE], []).append(literal)
+
+    def candidate_positions(self, data):
+        by_key = self.by_key.get(type(data))
+
+        if by_key is None or len(data) > self.max_scan:
+            return self.positions
+
+        by_literal = self.by_literal[type(data)]
+        keys = by_key.keys() & {data[i:i + KEY_SIZE]
+                                for i in range(len(data) - KEY_SIZE + 1)}
+        found = set()
+
+        for key in keys:
+            for literal in by_key[key]:
+                if literal in data:
+                    found.update(by_literal[literal])
+
+        return sorted(found)
+
+
+class RuleIndex:
+    """Compiled rules indexed by kind, by the literals of 'arg is' clauses
+    on well-known variables and by the literals their 'data matches'
+    patterns need.
+
+    candidates() yields, in their original order, only those rules that can
+    possibly match a message; the rest would fail on their kind clause, an
+    indexed 'arg is' clause or a 'data matches' clause anyway.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.pruned = 0
+        # set to an AdaptiveOrder to have the clauses reordered by timings
+        self.adaptive = None
+
+        # kind -> positions of rules without an indexed constraint
+        self.unconstrained = {}
+        # kind -> variable -> literal -> positions
+        self.literals = {}
+        # kind -> variable -> positions of all rules constrained on it
+        self.constrained = {}
+        # kind -> SubstringFilter
+        self.substrings = {}
+
+        substring_constrained = {}
+
+        for i, rule in enumerate(rules):
+            kind = rule.match_clauses[0].arguments[0]
+            constraint = literal_constraint(rule)
+
+            if constraint is None:
+                literals = substring_constraint(rule)
+
+                if literals is None:
+                    self.unconstrained.setdefault(kind, []).append(i)
+                else:
+                    substring_constrained.setdefault(kind, []).append(
+                        (i, literals))
+            else:
+                var, literals = constraint
+                by_literal = self.literals.setdefault(kind, {}) \
+                                          .setdefault(var, {})
+
+                for literal in literals:
+                    by_literal.setdefault(literal, []).append(i)
+
+                self.constrained.setdefault(kind, {}) \
+                                .setdefault(var, []).append(i)
+
+        for kind, constrained in substring_constrained.items():
+            self.substrings[kind] = SubstringFilter(constrained)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidate_positions(self, msg):
+        kind = msg['kind'].name
+        lists = [self.unconstrained.get(kind, [])]
+
+        for var, by_literal in self.literals.get(kind, {}).items():
+            value = msg.get(var)
+
+            if value is None or isinstance(value, Lazy):
+                # let the clause itself deal with the missing variable, or
+                # read the data if it comes to that
+                lists.append(self.constrained[kind][var])
+                continue
+
+            value = format(value)
+
+            lists.append(by_literal.get(value, []))
+
+        if kind in self.substrings:
+            # anything but str or bytes gets all of the rules
+            lists.append(self.substrings[kind].candidate_positions(
+                msg.get('data')))
+
+        return list(heapq.merge(*lists))
+
+    def candidates(self, msg):
+        positions = self.candidate_positions(msg)
+        pruned = len(self.rules) - len(positions)
+
+        self.pruned += pruned
+        stats.count('rules pruned', pruned)
+        log.debug('Index pruned %d of %d rules.', pruned, len(self.rules))
+
+        return [self.rules[i] for i in positions]
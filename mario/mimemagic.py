@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Opening a libmagic handle loads and parses the whole magic database, so
+# handles are kept for as long as the process lives. A handle mustn't be used
+# by two threads at once, and type lookups run on background threads too, so
+# every thread gets its own.
+
+import logging as log
+import threading
+
+
+UNSUPPORTED = ('Your \'magic\' module is unsupported. '
+               'Install either https://github.com/ahupp/python-magic '
+               'or https://github.com/file/file/tree/master/python '
+               '(official \'file\' python bindings, available as the '
+               'python-magic package on many distros)')
+
+
+class PythonMagicHandle:
+    """A handle from https://github.com/ahupp/python-magic."""
+
+    def __init__(self, magic):
+        self.magic = magic.Magic(mime=True)
+
+    def buffer(self, buf):
+        return self.magic.from_buffer(buf)
+
+    def descriptor(self, fd):
+        return self.magic.from_descriptor(fd)
+
+
+class FileMagicHandle:
+    """A handle from the python bindings that come with file."""
+
+    def __init__(self, magic):
+        self.magic = magic.open(magic.MIME_TYPE)
+        self.magic.load()
+
+    def buffer(self, buf):
+        return self.magic.buffer(buf)
+
+    def descriptor(self, fd):
+        return self.magic.descriptor(fd)
+
+
+def handle_class(magic):
+    if hasattr(magic, 'Magic') and hasattr(magic.Magic, 'from_buffer'):
+        return PythonMagicHandle
+    elif hasattr(magic, 'open'):
+        return FileMagicHandle
+    else:
+        return None
+
+
+class MagicDetector:
+    """Finds mimetypes with libmagic, through a handle of its own for every
+    thread using it. Handles are only opened when first needed."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.handle_class = None
+
+    def handle(self):
+        try:
+            return self.local.handle
+        except AttributeError:
+            pass
+
+        import magic
+
+        if self.handle_class is None:
+            self.handle_class = handle_class(magic)
+
+            if self.handle_class is None:
+                log.error(UNSUPPORTED)
+                raise SystemExit
+
+        log.debug('Loading the magic database for thread %s',
+                  threading.current_thread().name)
+        self.local.handle = self.handle_class(magic)
+
+        return self.local.handle
+
+    def from_buffer(self, buf):
+        """Return the mimetype of buf, which may be a str, bytes or any
+        other buffer."""
+        if isinstance(buf, str):
+            # a message from the command line, undecodable bytes included
+            buf = buf.encode('utf-8', 'surrogateescape')
+        elif not isinstance(buf, bytes):
+            # the bindings hand buffers to ctypes, which only takes bytes
+            buf = bytes(buf)
+
+        return self.handle().buffer(buf)
+
+    def from_descriptor(self, fd):
+        """Return the mimetype of what can be read from the file descriptor
+        fd, without reading it into memory here."""
+        return self.handle().descriptor(fd)
+
+
+detector = MagicDetector()
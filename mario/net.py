@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# All HTTP requests go through one requests.Session, so connections to a host
+# are kept alive and reused for as long as the process runs (the daemon,
+# batch mode), and every request gets timeouts and retries from the config.
+# requests takes longer to import than the rest of mario, so that only
+# happens once the first request is made.
+#
+# Requests made while handling a message share its deadline: the attempts
+# still to be made at a request split the time left between them and a retry
+# that couldn't be made in time isn't, so an unreachable host can't hold up a
+# plumb for longer than that. Hosts that keep failing are skipped for a while
+# altogether.
+
+import concurrent.futures
+import logging as log
+import threading
+import time
+from urllib.parse import urlsplit
+
+from mario.util import boolean
+
+
+HEADERS = {'User-agent': 'Mozilla/5.0 (Windows NT 6.3; rv:36.0) '
+                         'Gecko/20100101 Firefox/36.0'}
+
+DEFAULTS = {
+    'connect timeout': 3.05,
+    'read timeout': 10,
+    'retries': 2,
+    'retry backoff': 0.2,
+    'connections per host': 4,
+    'message deadline': 60,
+    'breaker failures': 3,
+    'breaker cooldown': 60,
+}
+
+# what to make of a URL whose Content-Type couldn't be looked up
+LOOKUP_FAILURE_POLICIES = ('guess', 'no match')
+
+# responses worth another try
+RETRY_STATUSES = (502, 503, 504)
+
+# at most this many requests are made in the background at once
+MAX_BACKGROUND = 8
+
+settings = dict(DEFAULTS, **{'strict content lookup': False,
+                            'content lookup failure': 'guess'})
+_session = None
+_background = threading.BoundedSemaphore(MAX_BACKGROUND)
+# the deadline of the message handled on each thread
+_local = threading.local()
+
+
+class Unavailable(OSError):
+    """A request that wasn't made, or was given up on, before the host
+    could answer."""
+
+
+class DeadlineExceeded(Unavailable):
+    pass
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+def configure(config):
+    """Take the HTTP settings from the [mario] config section. The session
+    is only rebuilt if they changed."""
+    global settings, _session
+
+    new = {key: float(config.get(key, default))
+           for key, default in DEFAULTS.items()}
+    new['strict content lookup'] = boolean(
+        config.get('strict content lookup', False))
+    new['content lookup failure'] = config.get('content lookup failure',
+                                               'guess')
+
+    if new['content lookup failure'] not in LOOKUP_FAILURE_POLICIES:
+        log.warning('Unknown content lookup failure policy {!r}, using '
+                    'guess.'.format(new['content lookup failure']))
+        new['content lookup failure'] = 'guess'
+
+    if new != settings:
+        settings = new
+
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def session():
+    global _session
+
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # retries are made by request(), which knows about the deadline
+        adapter = HTTPAdapter(
+            pool_maxsize=int(settings['connections per host']),
+            max_retries=0)
+
+        _session = requests.Session()
+        _session.headers.update(HEADERS)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+
+    return _session
+
+
+class Deadline:
+    """Sets the deadline of the requests made on this thread while it's
+    entered, settings['message deadline'] seconds from then. A deadline of 0
+    means there's none."""
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'deadline', None)
+        seconds = settings['message deadline']
+        _local.deadline = time.monotonic() + seconds if seconds > 0 else None
+
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.deadline = self.previous
+
+
+def remaining():
+    """Return the seconds left until the deadline, or None if there's
+    none."""
+    deadline = getattr(_local, 'deadline', None)
+
+    if deadline is None:
+        return None
+
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    left = remaining()
+
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('Deadline for handling the message passed')
+
+    return left
+
+
+def timeout(attempts=1):
+    """Return the timeout of the next of attempts requests. Under a deadline
+    each one gets an equal share of the time left, connecting and reading
+    together."""
+    connect, read = settings['connect timeout'], settings['read timeout']
+    left = check_deadline()
+
+    if left is None:
+        return (connect, read)
+
+    from urllib3.util import Timeout
+
+    share = left / attempts
+
+    return Timeout(connect=min(connect, share), read=min(read, share),
+                   total=share)
+
+
+def backoff(retry):
+    """Return the seconds to wait before the given retry, or None if it
+    would only be made after the deadline."""
+    delay = settings['retry backoff'] * 2 ** (retry - 1)
+    left = remaining()
+
+    if left is not None and delay >= left:
+        return None
+
+    return delay
+
+
+class CircuitBreaker:
+    """Counts the consecutive failed connections to each host. After
+    settings['breaker failures'] of them the host isn't tried again until
+    settings['breaker cooldown'] seconds have passed, then once more, and
+    one more failure opens the circuit again."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # host -> (consecutive failures, when it may be tried again)
+        self.hosts = {}
+
+    def check(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+
+        if state is not None and state[1] > time.monotonic():
+            raise CircuitOpen('{} failed recently, not trying it for another '
+                              '{:.0f}s'.format(host,
+                                               state[1] - time.monotonic()))
+
+    def failure(self, host):
+        limit = settings['breaker failures']
+
+        with self.lock:
+            failures = self.hosts.get(host, (0, 0))[0] + 1
+            until = 0
+
+            if limit > 0 and failures >= limit:
+                until = time.monotonic() + settings['breaker cooldown']
+                log.info('{} failed {} times in a row, skipping it for '
+                         '{:.0f}s'.format(host, failures,
+                                          settings['breaker cooldown']))
+
+            self.hosts[host] = (failures, until)
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def reset(self):
+        with self.lock:
+            self.hosts.clear()
+
+
+breaker = CircuitBreaker()
+
+
+def request(method, url, **kwargs):
+    """Make a request, retrying failed connections and RETRY_STATUSES
+    responses up to settings['retries'] times, all of it within the
+    deadline."""
+    import requests
+
+    host = urlsplit(url).netloc
+    breaker.check(host)
+    retries = int(settings['retries'])
+
+    for retry in range(retries + 1):
+        try:
+            response = session().request(
+                method, url, timeout=timeout(retries + 1 - retry), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response, error = None, e
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                break
+
+        delay = backoff(retry + 1) if retry < retries else None
+
+        if delay is None:
+            break
+
+        if response is not None:
+            response.close()
+
+        time.sleep(delay)
+
+    if response is None:
+        breaker.failure(host)
+        raise error
+
+    breaker.success(host)
+
+    return response
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', False)
+
+    return request('HEAD', url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def in_background(func, *args):
+    """Call func(*args) on a daemon thread and return a Future of its result,
+    or None if too many calls are already running.
+
+    Daemon threads don't keep mario from exiting once it's done, even if the
+    result was never needed. The call has the same deadline as the caller.
+    """
+    if not _background.acquire(blocking=False):
+        return None
+
+    future = concurrent.futures.Future()
+    deadline = getattr(_local, 'deadline', None)
+
+    def run():
+        _local.deadline = deadline
+
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            _background.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+    return future
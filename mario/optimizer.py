@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Match clauses other than rewrites only read the message (save for setting
+# capture group variables), so a rule matches the same messages whatever
+# order they're evaluated in. Running the cheap clauses that are likely to
+# fail first means e.g. no HEAD request is made for a rule that fails on its
+# netloc anyway.
+
+import logging as log
+
+
+# Rough seconds per evaluation, used until a clause has been timed
+COSTS = {
+    'kind is': 1e-7,
+    'arg is': 5e-7,
+    'arg matches': 2e-6,
+    'arg istype': 1e-1,     # may need libmagic or a HEAD request
+}
+
+# Variables every message of a kind has
+GUARANTEED = {
+    'url': ('data', 'kind', 'netloc', 'netpath'),
+    'raw': ('data', 'kind'),
+    'text': ('data', 'kind'),
+}
+
+# Timings are trusted once a clause has been evaluated this many times
+MIN_SAMPLES = 20
+# Rules are reordered by their timings every this many messages
+REORDER_EVERY = 1000
+
+
+def produces_captures(clause):
+    if clause.name not in ('arg matches', 'arg istype'):
+        return False
+
+    # a pattern that didn't compile is still a string, assume the worst
+    return any(getattr(p, 'groups', 1) for p in clause.arguments[1])
+
+
+def reads_captures(variables):
+    return any(v.lstrip('\\').isdigit() for v in variables)
+
+
+def rank(clause):
+    """Expected cost of evaluating the clause per rule it rules out."""
+    if clause.calls >= MIN_SAMPLES:
+        cost = clause.seconds / clause.calls
+        failure = 1 - clause.passes / clause.calls
+    else:
+        cost, failure = COSTS[clause.name], 0.5
+
+    return cost / max(failure, 0.01)
+
+
+def schedule(segment):
+    # clauses setting capture group variables keep their order, as a later
+    # one overwrites what an earlier one set
+    producers = [c for c in segment if produces_captures(c)]
+    others = sorted((c for c in segment if not produces_captures(c)),
+                    key=rank)
+    ordered = []
+
+    while producers or others:
+        if others and (not producers or rank(others[0]) <= rank(producers[0])):
+            ordered.append(others.pop(0))
+        else:
+            ordered.append(producers.pop(0))
+
+    return ordered
+
+
+def order_clauses(clauses):
+    """Return the match clauses of a rule in the order they're best
+    evaluated in.
+
+    Only clauses whose variables every message that gets to them is
+    guaranteed to have are moved, so a clause can't fail on a missing
+    variable that a clause originally before it would have kept it from
+    seeing. Rewrites and clauses referring to other variables stay where
+    they are and nothing is moved across them. That includes every clause
+    reading a capture group, as the clause setting it may be any of the
+    ones before it.
+    """
+    kind = clauses[0].arguments[0]
+    available = set(GUARANTEED.get(kind, ('data', 'kind')))
+    ordered, segment = clauses[:1], []
+
+    for clause in clauses[1:]:
+        variables = clause.arguments[0].variables
+
+        if (clause.name in COSTS and not reads_captures(variables) and
+                available.issuperset(variables)):
+            segment.append(clause)
+        else:
+            ordered += schedule(segment) + [clause]
+            segment = []
+
+            # passing the clause means its variables exist, a rewrite's
+            # target included
+            available.update(variables)
+
+    return ordered + schedule(segment)
+
+
+def optimize_rules(rules):
+    for rule in rules:
+        ordered = order_clauses(rule.match_clauses)
+
+        if ordered != rule.match_clauses:
+            log.debug('Reordered the clauses of rule [%s].', rule.name)
+            rule.match_clauses = ordered
+
+    return rules
+
+
+class AdaptiveOrder:
+    """Times the match clauses of the rules and reorders them by their
+    measured costs and failure rates every so many messages."""
+
+    def __init__(self, rules, every=REORDER_EVERY):
+        self.every = every
+        self.messages = 0
+
+        for rule in rules:
+            for clause in rule.match_clauses[1:]:
+                clause.time()
+
+    def message_handled(self, rules):
+        self.messages += 1
+
+        if self.messages % self.every == 0:
+            optimize_rules(rules)
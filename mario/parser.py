@@ -10,6 +10,8 @@ from pyparsing import (ParserElement, Word, Group, Keyword,
                        originalTextFor, restOfLine, printables, alphas8bit)
 from functools import wraps
 
+from mario.util import print_parse_error
+
 
 class Named(ParseElementEnhance):
     def parseImpl(self, instring, loc, doActions=True):
@@ -58,6 +60,7 @@ def make_parser():
 
     ActionObject = Keyword('plumb')('object')
     ActionVerb   = Named(Keyword('run')    |
+                         Keyword('spawn')  |
                          Keyword('notify') |
                          Keyword('download'))('verb')
     Action       = Named(originalTextFor(OneOrMore(Argument)))('arg')
@@ -134,11 +137,13 @@ def extract_parse_result_as_list(result):
     return rules
 
 
-def print_parse_error(e):
-    print(e, ':\n\t', e.line, sep="")
-    error_indicator = '\t' + ' ' * (e.col - 1) + '^'
+def extract_plain_parse_result(result):
+    rules = []
+
+    for rule_name, (match_lines, action_lines) in extract_parse_result(result):
+        rules += [[rule_name, (match_lines.asList(), action_lines.asList())]]
 
-    print(error_indicator)
+    return rules
 
 
 def catch_parse_errors(f, handler=print_parse_error):
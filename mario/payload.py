@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Message data read from stdin can be arbitrarily big. Only a bounded prefix
+# of it is kept in memory, which is all guessing the kind and libmagic need;
+# anything beyond that is spooled to a memory-mapped temporary file and only
+# read back in full if a clause or action refers to {data}.
+
+import codecs
+import mmap
+import os
+import shutil
+import tempfile
+
+
+# libmagic doesn't look past its default bytes_max either
+PREFIX_SIZE = 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Lazy:
+    """A message variable whose value is only worked out when it's formatted.
+
+    payload is the Payload the value comes from, if any, so its prefix can
+    be used where the whole value isn't needed.
+    """
+
+    def __init__(self, func, payload=None):
+        self.func = func
+        self.payload = payload
+        self.computed = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self.computed:
+            self._value = self.func()
+            self.computed = True
+
+        return self._value
+
+    def __format__(self, spec):
+        return format(self.value, spec)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return 'Lazy({!r})'.format(self.func)
+
+
+class DataFile(Lazy):
+    """The {datafile} of a Payload, only written once it's used."""
+
+    def __init__(self, payload):
+        super().__init__(payload.path)
+        self.owner = payload
+
+
+class Payload:
+    """Data read from a stream: the first PREFIX_SIZE bytes in memory and,
+    if there's more, all of it spooled to a memory-mapped temporary file."""
+
+    def __init__(self, prefix, spool=None):
+        self.prefix = prefix
+        self.spool = spool
+        self.map = None
+        # whether the data is text and should be decoded
+        self.decode = False
+        # the file written for {datafile} if the data is only in memory
+        self.datafile = None
+        # whether a program outliving the message was handed {datafile}
+        self.kept = False
+
+        if spool is not None and os.fstat(spool.fileno()).st_size:
+            self.map = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def spooled(self):
+        return self.spool is not None
+
+    @property
+    def size(self):
+        return len(self.map) if self.map is not None else len(self.prefix)
+
+    def text_prefix(self):
+        """Return the prefix decoded as UTF-8, or None if it isn't UTF-8. A
+        character cut in two by the end of the prefix is fine."""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+        try:
+            return decoder.decode(self.prefix, final=not self.spooled)
+        except UnicodeDecodeError:
+            return None
+
+    def buffer(self):
+        """All of the data without copying it, as bytes or an mmap."""
+        if self.map is not None:
+            return self.map
+
+        return self.prefix
+
+    def bytes(self):
+        return self.buffer()[:]
+
+    def value(self):
+        """All of the data, as the message would have had it if it had been
+        read into memory at once."""
+        data = self.bytes()
+
+        if self.decode:
+            try:
+                return data.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+
+        return data
+
+    def path(self):
+        """Return the name of a file holding the data, writing it first if
+        the data is only in memory. The file is removed on close() unless
+        keep() was called."""
+        if self.spool is not None:
+            return self.spool.name
+
+        if self.datafile is None:
+            with tempfile.NamedTemporaryFile(prefix='mario-data-',
+                                             delete=False) as f:
+                self.datafile = f.name
+                f.write(self.prefix)
+
+        return self.datafile
+
+    def keep(self):
+        """Leave the {datafile} file behind on close(), for a program still
+        using it. Removing it is then up to that program."""
+        self.kept = True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        if self.spool is not None:
+            self.spool.close()
+
+            if not self.kept:
+                os.unlink(self.spool.name)
+
+            self.spool = None
+
+        if self.datafile is not None:
+            if not self.kept:
+                os.unlink(self.datafile)
+
+            self.datafile = None
+
+
+def read_payload(f, prefix_size=PREFIX_SIZE):
+    """Read all of the binary stream f into a Payload."""
+    prefix = f.read(prefix_size)
+    more = f.read(CHUNK_SIZE)
+
+    if not more:
+        return Payload(prefix)
+
+    spool = tempfile.NamedTemporaryFile(prefix='mario-data-', delete=False)
+
+    try:
+        spool.write(prefix)
+        spool.write(more)
+        shutil.copyfileobj(f, spool, CHUNK_SIZE)
+        spool.flush()
+
+        return Payload(prefix, spool)
+    except BaseException:
+        spool.close()
+        os.unlink(spool.name)
+        raise
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Recording plumbed messages and replaying them against a rules file. With
+# --record (or the record file option) every message handled is appended to
+# a log as a line of JSON: its kind, its data, the variables derived from it,
+# the rule that matched and how long each stage took. Data too big to keep
+# is recorded as a digest only, and such messages can't be replayed.
+#
+# Replaying runs the messages of a log through the rules with the actions
+# doing nothing:
+#
+#     python -m mario.replay LOG [LOG ...] [--rules FILE]
+#
+# and reports the throughput, latency percentiles and every message that's
+# now matched by a different rule than when it was recorded.
+
+import argparse
+import base64
+import hashlib
+import json
+import sys
+import threading
+import time
+
+from mario.payload import Payload
+
+
+# Messages with more data than this are recorded by digest only
+DATA_LIMIT = 64 * 1024
+
+# Latency percentiles to report
+PERCENTILES = (50, 90, 99)
+
+# How much of the data of a changed message to print
+PREVIEW_SIZE = 60
+
+
+recorder = None
+
+
+def data_fields(data):
+    """Return the fields recording data takes: the data itself if it's text
+    and small enough, base64 encoded if it's binary and its digest if it's
+    too big."""
+    if isinstance(data, Payload):
+        if data.size <= DATA_LIMIT:
+            data = data.value()
+        else:
+            digest = hashlib.sha256(data.buffer())
+            return {'sha256': digest.hexdigest(), 'size': data.size}
+
+    if len(data) > DATA_LIMIT:
+        if isinstance(data, str):
+            data = data.encode('utf-8', 'surrogateescape')
+
+        return {'sha256': hashlib.sha256(data).hexdigest(),
+                'size': len(data)}
+
+    if isinstance(data, str):
+        try:
+            # undecodable bytes from the command line can't go into JSON
+            data.encode('utf-8')
+            return {'data': data}
+        except UnicodeEncodeError:
+            data = data.encode('utf-8', 'surrogateescape')
+
+    return {'data_b64': base64.b64encode(data).decode('ascii')}
+
+
+def status(rule, ok):
+    if rule is None:
+        return 'no match'
+
+    return 'ok' if ok else 'failed'
+
+
+class Recorder:
+    """Appends records of plumbed messages to a log file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+
+    def record(self, data, msg, result, timings):
+        """Record a message with data, handled as msg with the result
+        handle_rules returned, taking timings (a dict of stage names to
+        seconds)."""
+        rule, ok = result
+        entry = {'time': round(time.time(), 3), 'kind': msg['kind'].name}
+        entry.update(data_fields(data))
+        entry['variables'] = {k: v for k, v in msg.items()
+                              if k not in ('data', 'kind')
+                              and isinstance(v, str)}
+        entry['rule'] = rule
+        entry['status'] = status(rule, ok)
+        entry['timings'] = {k: round(v, 6) for k, v in timings.items()}
+
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def start(path):
+    global recorder
+
+    recorder = Recorder(path)
+
+    return recorder
+
+
+def stop():
+    global recorder
+
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+def record(data, msg, result, timings):
+    if recorder is not None:
+        recorder.record(data, msg, result, timings)
+
+
+# REPLAY
+
+def read_log(f):
+    """Yield the line numbers and records of a log. Lines that aren't
+    records are warned about and skipped."""
+    for lineno, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            print('{}:{}: not a record'.format(f.name, lineno),
+                  file=sys.stderr)
+            continue
+
+        if not isinstance(entry, dict) or 'kind' not in entry:
+            print('{}:{}: not a record'.format(f.name, lineno),
+                  file=sys.stderr)
+            continue
+
+        yield lineno, entry
+
+
+def record_data(entry):
+    """Return the data of a record, or None if only its digest was kept."""
+    if 'data' in entry:
+        return entry['data']
+
+    if 'data_b64' in entry:
+        return base64.b64decode(entry['data_b64'])
+
+    return None
+
+
+def preview(data):
+    text = data if isinstance(data, str) else repr(data)
+
+    if len(text) > PREVIEW_SIZE:
+        text = text[:PREVIEW_SIZE - 3] + '...'
+
+    return text
+
+
+def percentile(values, p):
+    """The p-th percentile of the sorted values, by nearest rank."""
+    if not values:
+        return 0.0
+
+    rank = max(1, -(-len(values) * p // 100))
+
+    return values[int(rank) - 1]
+
+
+class Report:
+    def __init__(self):
+        self.replayed = 0
+        self.skipped = 0
+        self.matched = 0
+        self.seconds = 0.0
+        self.latencies = []
+        self.changed = []
+
+    def add(self, entry, name, data, rule, seconds):
+        self.replayed += 1
+        self.seconds += seconds
+        self.latencies.append(seconds)
+
+        if rule is not None:
+            self.matched += 1
+
+        if rule != entry.get('rule'):
+            self.changed.append({
+                'log': name[0],
+                'line': name[1],
+                'kind': entry['kind'],
+                'data': preview(data),
+                'recorded': entry.get('rule'),
+                'replayed': rule,
+            })
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        return {
+            'replayed': self.replayed,
+            'skipped': self.skipped,
+            'matched': self.matched,
+            'seconds': self.seconds,
+            'throughput': (self.replayed / self.seconds
+                           if self.seconds else 0.0),
+            'latency': dict(
+                [('p{}'.format(p), percentile(latencies, p))
+                 for p in PERCENTILES] +
+                [('max', latencies[-1] if latencies else 0.0)]),
+            'changed': self.changed,
+        }
+
+
+def replay(logs, rules, store=None):
+    """Handle the messages of the logs, an iterable of open files, with
+    rules and return a Report of how it went."""
+    from mario.core import Kind, handle_rules, make_message
+    from mario.util import Scope
+
+    report = Report()
+
+    for f in logs:
+        for lineno, entry in read_log(f):
+            data = record_data(entry)
+
+            if data is None or entry['kind'] not in Kind.__members__:
+                report.skipped += 1
+                continue
+
+            msg = make_message(argparse.Namespace(msg=data,
+                                                  kind=Kind[entry['kind']]))
+
+            start = time.perf_counter()
+            rule, _ = handle_rules(Scope(msg), rules, store)
+            seconds = time.perf_counter() - start
+
+            report.add(entry, (f.name, lineno), data, rule, seconds)
+
+    return report
+
+
+def print_report(summary, out=sys.stdout):
+    print('{} messages replayed, {} skipped, {} matched'.format(
+        summary['replayed'], summary['skipped'], summary['matched']),
+        file=out)
+    print('{:.0f} messages/s'.format(summary['throughput']), file=out)
+    print('latency ' + '  '.join(
+        '{} {:.1f} us'.format(k, v * 1e6)
+        for k, v in summary['latency'].items()), file=out)
+
+    if not summary['changed']:
+        return
+
+    print('\n{} messages matched a different rule:'.format(
+        len(summary['changed'])), file=out)
+
+    for c in summary['changed']:
+        print('{}:{}: {} {!r}: {} -> {}'.format(
+            c['log'], c['line'], c['kind'], c['data'],
+            c['recorded'] or '(none)', c['replayed'] or '(none)'),
+            file=out)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mario.replay')
+    parser.add_argument('logs', nargs='+', type=argparse.FileType('r'),
+                        metavar='LOG',
+                        help='logs written by mario --record')
+    parser.add_argument('--config', type=argparse.FileType('r'),
+                        help='config file to use')
+    parser.add_argument('--rules',
+                        help='rules file to replay against (default: the '
+                        'configured one)')
+    parser.add_argument('--parser', choices=['pyparsing', 'fast'],
+                        help='rules parser to use')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+
+    args = parser.parse_args(argv)
+    # the rules are parsed the way mario would
+    args.reparse = False
+
+    return args
+
+
+def main(argv=None, out=sys.stdout):
+    from mario.core import (STUB_ACTIONS, LazyTypeCache, load_rules,
+                            parse_config)
+    from mario import net
+
+    args = parse_arguments(argv)
+    config = parse_config(args)
+
+    net.configure(config)
+
+    rules = load_rules(args, config, STUB_ACTIONS)
+
+    if not rules:
+        print('No rules to replay against.', file=sys.stderr)
+        return 1
+
+    try:
+        report = replay(args.logs, rules, LazyTypeCache(config))
+    finally:
+        for f in args.logs:
+            f.close()
+
+    summary = report.summary()
+
+    if args.json:
+        json.dump(summary, out, indent=2)
+        out.write('\n')
+    else:
+        print_report(summary, out)
+
+    return 1 if summary['changed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Parsed rules are stored as JSON next to nothing but a fingerprint of the
+# rules file they came from. Loading them back must not need pyparsing, so
+# only plain lists are ever written here.
+
+import hashlib
+import json
+import logging as log
+import os
+import tempfile
+
+from xdg import BaseDirectory
+
+from mario import __version__
+
+
+def cache_dir():
+    return os.path.join(BaseDirectory.xdg_cache_home, 'mario', 'rules')
+
+
+def fingerprint(filename, st, content):
+    return {
+        'version': __version__,
+        'path': os.path.abspath(filename),
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'hash': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+    }
+
+
+def entry_path(filename, directory=None):
+    key = hashlib.sha256(os.path.abspath(filename).encode('utf-8'))
+    return os.path.join(directory or cache_dir(), key.hexdigest() + '.json')
+
+
+def load(filename, st, content, directory=None):
+    path = entry_path(filename, directory)
+
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+
+        if entry['fingerprint'] != fingerprint(filename, st, content):
+            log.debug('Cached rules for {} are stale.'.format(filename))
+            return None
+
+        return [[name, (match_lines, action_lines)]
+                for name, (match_lines, action_lines) in entry['rules']]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError):
+        log.debug('Ignoring corrupt rules cache entry {}'.format(path))
+        return None
+
+
+def store(filename, st, content, rules, directory=None):
+    path = entry_path(filename, directory)
+    entry = {
+        'fingerprint': fingerprint(filename, st, content),
+        'rules': rules,
+    }
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                         delete=False) as f:
+            json.dump(entry, f)
+
+        os.replace(f.name, path)
+    except OSError as e:
+        log.debug('Couldn\'t write rules cache: {}'.format(e))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Timing of mario's start-up for --startup-profile. Heavy modules are only
+# imported by the clause or action needing them, so the report shows both how
+# long every step took and which imports happened during it.
+
+import builtins
+import contextlib
+import sys
+import time
+
+
+_profile = None
+
+
+class StartupProfile:
+    def __init__(self):
+        # CPU time spent starting the interpreter and importing mario.core
+        self.before_main = time.process_time()
+        self.started = time.perf_counter()
+        self.steps = []
+        self.current = None
+        self.level = 0
+        self.depth = 0
+        self.original_import = builtins.__import__
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(),
+                     level=0):
+        new = level == 0 and name not in sys.modules
+
+        if not new:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+
+        start = time.perf_counter()
+        self.depth += 1
+
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        finally:
+            self.depth -= 1
+
+            # nested imports are part of the one that caused them
+            if self.depth == 0 and self.current is not None:
+                self.current[2].append((name, time.perf_counter() - start))
+
+    def install(self):
+        builtins.__import__ = self.timed_import
+
+    def uninstall(self):
+        builtins.__import__ = self.original_import
+
+    @contextlib.contextmanager
+    def step(self, name):
+        outer = self.current
+        self.current = [name, None, [], self.level]
+        self.steps.append(self.current)
+        self.level += 1
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.current[1] = time.perf_counter() - start
+            self.current = outer
+            self.level -= 1
+
+    def report(self, out=sys.stderr):
+        total = time.perf_counter() - self.started
+
+        print('mario start-up profile (ms)', file=out)
+        print('{:10.1f}  interpreter and mario.core (CPU time)'.format(
+            self.before_main * 1000), file=out)
+
+        for name, seconds, imports, level in self.steps:
+            indent = '  ' * level
+            print('{:10.1f}  {}{}'.format(seconds * 1000, indent, name),
+                  file=out)
+
+            for module, import_seconds in imports:
+                print('{:10.1f}  {}  import {}'.format(import_seconds * 1000,
+                                                       indent, module),
+                      file=out)
+
+        print('{:10.1f}  total since main()'.format(total * 1000), file=out)
+
+
+def start():
+    global _profile
+
+    _profile = StartupProfile()
+    _profile.install()
+
+    return _profile
+
+
+def stop(out=sys.stderr):
+    global _profile
+
+    if _profile is not None:
+        _profile.uninstall()
+        _profile.report(out)
+        _profile = None
+
+
+@contextlib.contextmanager
+def step(name):
+    """Time what runs in the with block as a step of the start-up profile,
+    if one is being taken."""
+    if _profile is None:
+        yield
+    else:
+        with _profile.step(name):
+            yield
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Where the time goes while plumbing, for --stats and the metrics file. The
+# clauses of the rules are only timed once collecting is enabled, so
+# otherwise all it costs is checking collector for None once per message.
+# Rules are told apart by their position, names needn't be unique.
+#
+# The metrics file holds running totals across runs: every write adds what
+# was counted since the last one to the samples already in the file, with
+# the file locked so concurrent runs don't lose each other's counts.
+
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import threading
+
+
+collector = None
+
+
+def clause_text(clause):
+    if clause.text is not None:
+        return '{} {}'.format(clause.name, clause.text)
+
+    if clause.name == 'kind is':
+        return 'kind is ' + ' '.join(clause.arguments)
+
+    return '{} {}'.format(clause.name, clause.arguments[0])
+
+
+def clause_summary(clause, key='clause'):
+    return {key: clause_text(clause), 'calls': clause.calls,
+            'passes': clause.passes, 'seconds': clause.seconds}
+
+
+class RuleStats:
+    def __init__(self, rule, position):
+        self.name = rule.name
+        self.position = position
+        self.matches = 0
+        # the clauses count for themselves once timed, in the order they
+        # were written even if the optimizer reorders them later
+        self.clauses = list(rule.match_clauses)
+        self.actions = list(rule.action_clauses)
+
+    @property
+    def evaluations(self):
+        # every evaluation of a rule starts with its first clause
+        return self.clauses[0].calls if self.clauses else 0
+
+    @property
+    def seconds(self):
+        return sum(c.seconds for c in self.clauses + self.actions)
+
+    def labels(self):
+        return {'rule': self.name, 'position': str(self.position)}
+
+    def texts(self):
+        return [clause_text(c) for c in self.clauses + self.actions]
+
+    def summary(self):
+        return {
+            'rule': self.name,
+            'position': self.position,
+            'evaluations': self.evaluations,
+            'matches': self.matches,
+            'seconds': self.seconds,
+            'clauses': [clause_summary(c) for c in self.clauses],
+            'actions': [clause_summary(c, 'action') for c in self.actions],
+        }
+
+
+class TypeMemo(dict):
+    """The per-message mimetype cache, counting its hits and misses."""
+
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats
+
+    def __contains__(self, key):
+        found = super().__contains__(key)
+        self.stats.count('type cache hits' if found else 'type cache misses')
+        return found
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.matched = 0
+        self.seconds = 0.0
+        self.counts = {
+            'type cache hits': 0,
+            'type cache misses': 0,
+            'network lookups': 0,
+            'rules pruned': 0,
+        }
+        # rules -> their RuleStats, in the order of the rules
+        self.rules = {}
+        # the samples as of the last write of the metrics file
+        self.reported = {}
+
+    def instrument(self, rules):
+        """Have the clauses of the rules timed. A rule reloaded with the same
+        name, position and clauses keeps counting where the one it replaces
+        left off."""
+        loaded = {(s.name, s.position): rule for rule, s in self.rules.items()}
+
+        for position, rule in enumerate(rules):
+            stats = RuleStats(rule, position)
+            previous = loaded.get((rule.name, position))
+            counts = [(0, 0, 0.0)] * len(stats.texts())
+
+            if previous is not None:
+                old = self.rules.pop(previous)
+
+                if old.texts() == stats.texts():
+                    stats.matches = old.matches
+                    counts = [(c.calls, c.passes, c.seconds)
+                              for c in old.clauses + old.actions]
+
+            self.rules[rule] = stats
+
+            for clause, (calls, passes, seconds) in zip(
+                    stats.clauses + stats.actions, counts):
+                clause.calls, clause.passes, clause.seconds = \
+                    calls, passes, seconds
+                clause.time()
+
+    def count(self, name, n=1):
+        # network lookups are counted on background threads
+        with self.lock:
+            self.counts[name] += n
+
+    def type_memo(self):
+        return TypeMemo(self)
+
+    def message_handled(self, rule_name, seconds):
+        self.messages += 1
+        self.seconds += seconds
+
+        if rule_name is not None:
+            self.matched += 1
+
+    def rule_matched(self, rule):
+        if rule in self.rules:
+            self.rules[rule].matches += 1
+
+    def summary(self):
+        return {
+            'messages': self.messages,
+            'matched': self.matched,
+            'seconds': self.seconds,
+            'type cache': {'hits': self.counts['type cache hits'],
+                           'misses': self.counts['type cache misses']},
+            'network lookups': self.counts['network lookups'],
+            'rules pruned': self.counts['rules pruned'],
+            'rules': [r.summary() for r in self.rules.values()],
+        }
+
+    def metrics(self, base=None):
+        """Return the stats in the Prometheus text exposition format, each
+        sample added to the value base has for its name and labels. The
+        samples have no timestamps, the textfile collector refuses those."""
+        base = base or {}
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append('# HELP mario_{} {}'.format(name, help))
+            lines.append('# TYPE mario_{} counter'.format(name))
+
+            for labels, value in samples:
+                key = 'mario_{}{}'.format(name, format_labels(labels))
+                lines.append('{} {}'.format(key, base.get(key, 0) + value))
+
+        metric('messages_total', 'Messages handled.',
+               [({}, self.messages)])
+        metric('messages_matched_total', 'Messages some rule matched.',
+               [({}, self.matched)])
+        metric('message_seconds_total', 'Time spent handling messages.',
+               [({}, self.seconds)])
+        metric('type_cache_hits_total',
+               'Mimetypes found in the per-message cache.',
+               [({}, self.counts['type cache hits'])])
+        metric('type_cache_misses_total',
+               'Mimetypes not found in the per-message cache.',
+               [({}, self.counts['type cache misses'])])
+        metric('network_lookups_total',
+               'HEAD requests made to look up a Content-Type.',
+               [({}, self.counts['network lookups'])])
+        metric('rules_pruned_total',
+               'Rules the index skipped without evaluating any clause.',
+               [({}, self.counts['rules pruned'])])
+
+        rules = self.rules.values()
+
+        metric('rule_evaluations_total', 'Times a rule was tried.',
+               [(r.labels(), r.evaluations) for r in rules])
+        metric('rule_matches_total', 'Times a rule matched.',
+               [(r.labels(), r.matches) for r in rules])
+        metric('rule_seconds_total', 'Time spent in the clauses of a rule.',
+               [(r.labels(), r.seconds) for r in rules])
+
+        for kind, attribute in (('clause', 'clauses'), ('action', 'actions')):
+            counters = [(dict(r.labels(), **{kind: clause_text(c)}), c)
+                        for r in rules for c in getattr(r, attribute)]
+
+            metric(kind + '_calls_total',
+                   'Times a {} was evaluated.'.format(kind),
+                   [(labels, c.calls) for labels, c in counters])
+            metric(kind + '_passes_total',
+                   'Times a {} succeeded.'.format(kind),
+                   [(labels, c.passes) for labels, c in counters])
+            metric(kind + '_seconds_total',
+                   'Time spent evaluating a {}.'.format(kind),
+                   [(labels, c.seconds) for labels, c in counters])
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, escape_label(v))
+                          for k, v in labels.items()) + '}'
+
+
+def enable():
+    global collector
+
+    collector = Stats()
+
+    return collector
+
+
+def disable():
+    global collector
+
+    collector = None
+
+
+def count(name, n=1):
+    if collector is not None:
+        collector.count(name, n)
+
+
+def rule_matched(rule):
+    if collector is not None:
+        collector.rule_matched(rule)
+
+
+def parse_samples(lines):
+    """Return the values of the samples in the lines of a metrics file, by
+    their name and labels."""
+    samples = {}
+
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+
+        key, _, value = line.rstrip('\n').rpartition(' ')
+
+        try:
+            samples[key] = int(value)
+        except ValueError:
+            try:
+                samples[key] = float(value)
+            except ValueError:
+                pass
+
+    return samples
+
+
+def write_metrics(path, stats):
+    """Add what stats counted since the last write to the totals in the
+    metrics file at path. The file is replaced rather than written to, so
+    whatever reads it never sees half of the samples."""
+    directory = os.path.dirname(path) or '.'
+    lock_path = os.path.join(directory,
+                             '.{}.lock'.format(os.path.basename(path)))
+
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(path) as f:
+                written = parse_samples(f)
+        except FileNotFoundError:
+            written = {}
+
+        current = parse_samples(stats.metrics().splitlines())
+        base = {}
+
+        for key, value in current.items():
+            reported = stats.reported.get(key, 0)
+
+            # a counter that went down was reset by reloading its rule
+            base[key] = written.get(key, 0) - \
+                (reported if value >= reported else 0)
+
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         prefix='.metrics-',
+                                         delete=False) as f:
+            f.write(stats.metrics(base))
+
+        os.replace(f.name, path)
+        stats.reported = current
+
+
+def report(summary=False, metrics_file=None, out=sys.stderr):
+    """Print the JSON summary to out if summary is set and write the
+    metrics to metrics_file, if any."""
+    if collector is None:
+        return
+
+    if summary:
+        json.dump(collector.summary(), out, indent=2)
+        out.write('\n')
+
+    if metrics_file:
+        write_metrics(metrics_file, collector)
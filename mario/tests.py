@@ -2,16 +2,75 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from xdg import BaseDirectory
+
 from mario.core import (get_var_references,
                         arg_matches_func,
                         arg_rewrite_func,
-                        Kind)
+                        bytes_pattern,
+                        compile_match_clause,
+                        compile_rules,
+                        configured_actions,
+                        detect_mimetype,
+                        guess_kind,
+                        make_message,
+                        handle_rules,
+                        load_rules,
+                        lookup_content_type,
+                        prefetch_mimetype,
+                        parse_arguments,
+                        parse_rules,
+                        Kind,
+                        STUB_ACTIONS,
+                        Template)
 from mario.parser import (make_parser,
                           parse_rules_string_exc,
-                          extract_parse_result_as_list)
-from mario.util import ElasticDict
+                          extract_parse_result_as_list,
+                          extract_plain_parse_result)
+from mario import (bench, check, fastparser, mimemagic, net, replay,
+                   rulescache, stats)
+from mario.batch import plumb_batch
+from mario.downloads import DownloadCache, DownloadError
+from mario import index
+from mario.index import RuleIndex
+from mario.optimizer import AdaptiveOrder, optimize_rules
+from mario.payload import read_payload
+from mario.startup import StartupProfile
+from mario.typecache import LazyTypeCache, TypeCache, cached_lookup
+from mario import daemon
+from mario.daemon import Daemon
+from mario.util import ElasticDict, Scope
+
+
+cache_home = None
+
+
+def setUpModule():
+    # loading rules caches them, keep that out of the user's cache
+    global cache_home
+
+    cache_home = tempfile.TemporaryDirectory()
+    BaseDirectory.xdg_cache_home, cache_home.previous = \
+        cache_home.name, BaseDirectory.xdg_cache_home
+
+
+def tearDownModule():
+    BaseDirectory.xdg_cache_home = cache_home.previous
+    cache_home.cleanup()
 
 # PARSER TESTS
 
@@ -307,6 +366,70 @@ class ParserTest(unittest.TestCase):
     def test_verb_istype(self):
         self.parser_test_helper(verb_istype, verb_istype_res)
 
+    def test_verb_spawn(self):
+        self.parser_test_helper(spawn_rule, spawn_res)
+
+
+spawn_rule = '''[test]
+kind is url
+plumb spawn firefox {data}
+plumb notify opened'''
+
+spawn_res = [
+    ['test', (
+        ['kind', 'is', 'url'],
+        [],
+        [
+            ['plumb', 'spawn', 'firefox {data}'],
+            ['plumb', 'notify', 'opened']
+        ]
+    )]
+]
+
+class FastParserTest(unittest.TestCase):
+    """Runs the hand-written parser against the pyparsing grammar."""
+
+    corpus = [v for v in globals().values()
+              if isinstance(v, str) and v.startswith(('[', '#'))]
+
+    errors = [
+        '',
+        'kind is raw',
+        '[t]\nkind is raw',
+        '[a b]\nkind is raw\nplumb run x',
+        '[t]\nkind is rawx\nplumb run x',
+        '[t]\nkind is raw\narg foo {data} x\nplumb run x',
+        '[t]\nkind is raw\narg is {a} #foo\nplumb run x',
+        '[t]\nkind is raw\narg matches {data} foo   \nplumb run x',
+        '[t]\nkind is raw\narg matches {data} foo\n   \nplumb run x',
+        '[t]\nkind is raw\nplumb run  #c\nplumb run x',
+        '[t]\nkind is raw\nplumb run x\n\t[u]x',
+        '[t]\nkind is raw\nplumb notify a ∀',
+    ]
+
+    def test_corpus(self):
+        self.assertGreater(len(self.corpus), 10)
+
+        for rule in self.corpus:
+            with self.subTest(rule=rule):
+                self.assertEqual(
+                    fastparser.parse_rules_string_exc(rule),
+                    parse_rules_string_exc(make_parser(), rule,
+                                           extract_plain_parse_result))
+
+    def test_errors(self):
+        for rule in self.errors:
+            with self.subTest(rule=rule):
+                with self.assertRaises(Exception) as expected:
+                    parse_rules_string_exc(make_parser(), rule)
+
+                with self.assertRaises(fastparser.ParseError) as got:
+                    fastparser.parse_rules_string_exc(rule)
+
+                e, g = expected.exception, got.exception
+                self.assertEqual((str(g), g.line, g.lineno, g.col),
+                                 (str(e), e.line, e.lineno, e.col))
+
 
 # UTIL TESTS
 
@@ -352,6 +475,49 @@ class TestElasticDict(unittest.TestCase):
         self.assertListEqual(list(d), ['a', 'b', 'c'])
 
 
+class TestScope(unittest.TestCase):
+    def test_rollback_to_savepoint(self):
+        d = Scope({'spam': 'eggs'})
+        d['spam'] = 'bacon'
+        savepoint = d.savepoint()
+        d['spam'] = 'ham'
+        d['tea'] = 'oolong'
+        d.rollback(savepoint)
+        self.assertDictEqual(dict(d), {'spam': 'bacon'})
+
+    def test_reverse_resets_changes(self):
+        d = Scope({'spam': 'eggs'})
+        d['spam'] = 'bacon'
+        d['tea'] = 'oolong'
+        del d['spam']
+        d.reverse()
+        self.assertDictEqual(dict(d), {'spam': 'eggs'})
+
+    def test_original_is_not_modified(self):
+        original = {'spam': 'eggs'}
+        d = Scope(original)
+        d['spam'] = 'bacon'
+        self.assertDictEqual(original, {'spam': 'eggs'})
+
+    def test_nonexistent_raises_keyerror(self):
+        d = Scope()
+        with self.assertRaises(KeyError):
+            d['bar']
+        with self.assertRaises(KeyError):
+            del d['bar']
+
+    def test_format_map(self):
+        d = Scope({'spam': 'eggs'})
+        d['tea'] = 'oolong'
+        self.assertEqual('{spam} {tea}'.format_map(d), 'eggs oolong')
+
+    def test_iter(self):
+        d = Scope({'a': 1, 'b': 2})
+        d['b'] = 42
+        d['c'] = 3
+        self.assertListEqual(list(d), ['a', 'b', 'c'])
+
+
 # CORE TESTS
 
 class CoreTest(unittest.TestCase):
@@ -374,6 +540,119 @@ class CoreTest(unittest.TestCase):
             (True, {'data': 'long jing', 'kind': Kind['raw']}, {})
         )
 
+    def test_arg_matches_bytes(self):
+        msg = {'data': b'spam \xff eggs 42'}
+        res, msg, _ = arg_matches_func(
+            msg,
+            compile_match_clause(['arg', 'matches', '{data}',
+                                  ['nothing', r'(\S+) (\d+)$']]).arguments,
+            {})
+
+        self.assertTrue(res)
+        self.assertEqual((format(msg['\\0']), format(msg['\\1'])),
+                         ('eggs', '42'))
+
+    def test_arg_matches_bytes_non_ascii(self):
+        clause = compile_match_clause(['arg', 'matches', '{data}',
+                                       ['caf\u00e9', r'(\w+)\xe9']])
+        self.assertEqual(clause.arguments[2], [None, None])
+
+        for data, expected in ((b'hello\xff', False),
+                               ('café'.encode('utf-8'), True)):
+            res, msg, _ = arg_matches_func({'data': data},
+                                           clause.arguments, {})
+            self.assertEqual(res, expected)
+
+        res, msg, _ = arg_matches_func(
+            {'data': 'crème brûlée'.encode('utf-8')},
+            compile_match_clause(['arg', 'matches', '{data}',
+                                  [r'(\w+)\xe9']]).arguments, {})
+        self.assertTrue(res)
+        self.assertEqual(format(msg['\\0']), 'brûl')
+
+    def test_bytes_pattern(self):
+        for pattern in (r'^(spam|eggs)[0-9]+\.$', r'^%PDF-(\d\.\d)',
+                        r'[\w\s-]+'):
+            self.assertIsNotNone(bytes_pattern(pattern), pattern)
+
+        for pattern in (r'\S+', r'[^\d]', '.', r'\bx', 'é', r'é\d', '[^a]',
+                        '(?i)a', '('):
+            self.assertIsNone(bytes_pattern(pattern), pattern)
+
+        # the data isn't decoded for a pattern using \d
+        clause = compile_match_clause(['arg', 'matches', '{data}',
+                                       [r'^%PDF-(\d\.\d)']])
+        cache = {}
+        res, msg, _ = arg_matches_func({'data': b'%PDF-1.4\n\xff'},
+                                       clause.arguments, cache)
+        self.assertTrue(res)
+        self.assertEqual(format(msg['\\0']), '1.4')
+        self.assertNotIn('decoded', cache)
+
+    def test_arg_rewrite_bytes(self):
+        self.assertEqual(
+            arg_rewrite_func({'data': b'oolong'},
+                             ['{data}', ['oo,', 'g,g jing']],
+                             {})[1],
+            {'data': b'long jing'})
+
+    def test_arg_rewrite_unchanged(self):
+        msg = ElasticDict({'data': 'oolong'})
+        arg_rewrite_func(msg, ['{data}', ['spam,eggs']], {})
+        self.assertEqual(msg.strain, {})
+
+    def test_template(self):
+        msg = {'data': 'spam', 'kind': Kind.text, '\\0': 'eggs'}
+
+        self.assertEqual(Template('{data}').variable, 'data')
+        self.assertEqual(Template('{data}').format_map(msg), 'spam')
+        self.assertEqual(Template('{{data}}').variables, ())
+        self.assertEqual(Template('{{data}}').format_map(msg), '{data}')
+        self.assertEqual(Template('{kind.name}-{\\0}').variables,
+                         ('kind', '\\0'))
+        self.assertEqual(Template('{kind.name}-{\\0}').format_map(msg),
+                         'text-eggs')
+        self.assertIsNone(Template('{data:>5}').variable)
+        self.assertEqual(Template('{data:>5}').format_map(msg), ' spam')
+
+    def test_missing_variable_fails_clause(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc('''[missing]
+kind is text
+arg is {nope} spam
+plumb run true
+
+[group]
+kind is text
+plumb run true {1}
+
+[fallback]
+kind is text
+plumb run true'''))
+        index = RuleIndex(rules)
+
+        self.assertEqual(handle_rules(Scope({'data': 'spam',
+                                             'kind': Kind.text}), index),
+                         ('group', False))
+
+    def test_failed_rule_is_rolled_back(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc('''[first]
+kind is text
+data rewrite spam,eggs
+data matches (e+)(gs)
+data is never
+plumb run true
+
+[second]
+kind is text
+data is spam
+plumb run true'''))
+        msg = Scope({'data': 'spam', 'kind': Kind.text})
+
+        self.assertEqual(handle_rules(msg, RuleIndex(rules)),
+                         ('second', True))
+        self.assertEqual(msg['data'], 'spam')
+        self.assertNotIn('\\1', msg)
+
     def test_get_var_references_basic(self):
         self.assertListEqual(
             list(get_var_references('{0}')),
@@ -393,5 +672,1731 @@ class CoreTest(unittest.TestCase):
         )
 
 
+# RULES CACHE TESTS
+
+class RulesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.rules = os.path.join(self.dir.name, 'mario.plumb')
+
+        with open(self.rules, 'w') as f:
+            f.write(multiple_rules)
+
+        self.st = os.stat(self.rules)
+        self.parsed = parse_rules_string_exc(make_parser(), multiple_rules,
+                                             extract_plain_parse_result)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_roundtrip(self):
+        rulescache.store(self.rules, self.st, multiple_rules, self.parsed,
+                         self.dir.name)
+        self.assertEqual(rulescache.load(self.rules, self.st, multiple_rules,
+                                         self.dir.name),
+                         self.parsed)
+
+    def test_changed_content_is_stale(self):
+        rulescache.store(self.rules, self.st, multiple_rules, self.parsed,
+                         self.dir.name)
+        self.assertIsNone(rulescache.load(self.rules, self.st, simple_rule,
+                                          self.dir.name))
+
+    def test_corrupt_entry_is_ignored(self):
+        with open(rulescache.entry_path(self.rules, self.dir.name), 'w') as f:
+            f.write('{"fingerprint": ')
+
+        self.assertIsNone(rulescache.load(self.rules, self.st, multiple_rules,
+                                          self.dir.name))
+
+
+class RulesDirTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.rules_dir = os.path.join(self.dir.name, 'rules.d')
+        os.mkdir(self.rules_dir)
+
+        self.write('mario.plumb', '[main]\nkind is raw\nplumb run true')
+        self.write('rules.d/20-b.plumb', '[b]\nkind is url\nplumb run true')
+        self.write('rules.d/10-a.plumb', '[a]\nkind is text\nplumb run true')
+        self.write('rules.d/15-broken.plumb', '[broken]\nkind was text')
+        self.write('rules.d/30-off.plumb', '# [off]\n# kind is text\n')
+        self.write('rules.d/.hidden.plumb', '[x]\nkind is raw\nplumb run x')
+        self.write('rules.d/README', 'not rules')
+
+        self.config = {'rules file': os.path.join(self.dir.name,
+                                                  'mario.plumb'),
+                       'rules dir': self.rules_dir,
+                       'parser': 'fast'}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir.name, name), 'w') as f:
+            f.write(content)
+
+    def names(self, *argv):
+        args = parse_arguments(list(argv) or ['spam', 'text'])
+
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            rules = parse_rules(args, self.config)
+
+        return rules and [name for name, _ in rules]
+
+    def test_fragments_follow_rules_file_in_order(self):
+        self.assertEqual(self.names(), ['main', 'a', 'b'])
+
+    def test_errors_name_the_fragment(self):
+        out = io.StringIO()
+        args = parse_arguments(['spam', 'text'])
+
+        with contextlib.redirect_stdout(out):
+            parse_rules(args, self.config)
+
+        self.assertIn('Syntax error in ' +
+                      os.path.join(self.rules_dir, '15-broken.plumb'),
+                      out.getvalue())
+
+    def test_fragment_with_a_bad_pattern_is_left_out(self):
+        self.write('rules.d/12-bad.plumb',
+                   '[team]\nkind is text\ndata matches (unclosed\n'
+                   'plumb run true')
+
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertEqual(self.names(), ['main', 'a', 'b'])
+
+        self.assertIn('ERROR:root:Bad pattern in {}: [team] arg matches '
+                      '{{data}} (unclosed: missing ), unterminated subpattern '
+                      'at position 0'.format(
+                          os.path.join(self.rules_dir, '12-bad.plumb')),
+                      logs.output)
+
+        # --check still gets to see it
+        args = parse_arguments(['spam', 'text'])
+
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            rules = parse_rules(args, self.config, check_patterns=False)
+
+        self.assertIn('team', [name for name, _ in rules])
+
+    def test_fragments_are_cached_separately(self):
+        self.names()
+        self.write('rules.d/20-b.plumb', '[c]\nkind is url\nplumb run true')
+
+        path = os.path.join(self.rules_dir, '10-a.plumb')
+        with open(path) as f:
+            self.assertIsNotNone(rulescache.load(path, os.stat(path),
+                                                 f.read()))
+
+        self.assertEqual(self.names(), ['main', 'a', 'c'])
+
+    def test_rules_file_is_optional_with_fragments(self):
+        os.unlink(self.config['rules file'])
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_explicit_rules_file_only(self):
+        self.assertEqual(self.names('--rules', self.config['rules file'],
+                                    'spam', 'text'), ['main'])
+
+
+class CheckTest(unittest.TestCase):
+    rules = r"""[pdf]
+kind is url
+arg matches {netpath} \.pdf$
+plumb run true {data}
+
+[url-fallback]
+kind is url
+plumb run true {data}
+
+[pdf-again]
+kind is url
+arg matches {netpath} \.pdf$
+plumb run echo {data}
+
+[host]
+kind is url
+arg is {netloc} example.com
+plumb run true
+
+[text]
+kind is text
+plumb run true"""
+
+    def problems(self, text):
+        rules = compile_rules(fastparser.parse_rules_string_exc(text))
+        return [(p.rule, p.dead) for p in check.check_rules(rules)]
+
+    def test_dead_rules(self):
+        self.assertEqual(self.problems(self.rules),
+                         [('pdf-again', True), ('host', True)])
+
+    def test_clause_order_does_not_matter(self):
+        self.assertEqual(self.problems(r"""[a]
+kind is url
+arg is {netloc} example.com
+arg matches {netpath} ^/a
+plumb run true
+
+[b]
+kind is url
+arg matches {netpath} ^/a
+arg is {netloc} example.com
+plumb run true"""), [('b', True)])
+
+    def test_dependent_clauses_are_not_compared(self):
+        # the rewrite makes [b] match urls [a] doesn't
+        self.assertEqual(self.problems(r"""[a]
+kind is url
+arg is {netloc} example.com
+plumb run true
+
+[b]
+kind is url
+arg rewrite {netloc} www.,
+arg is {netloc} example.com
+plumb run true
+
+[c]
+kind is text
+data matches (\w+)
+arg is {0} spam
+plumb run true
+
+[d]
+kind is text
+data matches (\w+)\s(\w+)
+data matches (\w+)
+arg is {0} spam
+plumb run true"""), [])
+
+    def test_invalid_pattern(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            '[broken]\nkind is text\ndata matches ^(unclosed\nplumb run true'))
+        problem, = check.check_rules(rules)
+
+        self.assertTrue(problem.error)
+        self.assertIn('^(unclosed: missing )', str(problem))
+
+    def load(self, text, **config):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mario.plumb')
+
+            with open(path, 'w') as f:
+                f.write(text)
+
+            args = parse_arguments(['--rules', path, '--reparse', 'spam',
+                                    'text'])
+            config = dict(config, parser='fast')
+
+            with self.assertLogs(level='INFO') as logs:
+                rules = load_rules(args, config)
+
+            return rules, logs.output
+
+    def test_load_fails_fast_on_invalid_pattern(self):
+        rules, logs = self.load(self.rules + '\n\n[broken]\nkind is text\n'
+                                'data matches ^(unclosed\nplumb run true')
+
+        self.assertIsNone(rules)
+        self.assertTrue(any(
+            line.startswith('ERROR:root:Bad pattern in ') and
+            line.endswith('mario.plumb: [broken] arg matches {data} '
+                          '^(unclosed: missing ), unterminated subpattern '
+                          'at position 1')
+            for line in logs), logs)
+
+    def test_prune(self):
+        rules, _ = self.load(self.rules)
+        self.assertEqual(len(rules.rules), 5)
+
+        rules, logs = self.load(self.rules, **{'prune rules': 'yes'})
+        self.assertEqual([r.name for r in rules.rules],
+                         ['pdf', 'url-fallback', 'text'])
+        self.assertEqual(handle_rules(Scope({'data': 'http://example.com/',
+                                             'netloc': 'example.com',
+                                             'netpath': '/',
+                                             'kind': Kind.url}),
+                                      rules)[0], 'url-fallback')
+
+    def test_check_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mario.plumb')
+
+            with open(path, 'w') as f:
+                f.write(self.rules)
+
+            args = parse_arguments(['--check', '--rules', path])
+            out = io.StringIO()
+
+            self.assertEqual(check.run(args, {'parser': 'fast'}, out), 1)
+            self.assertEqual(out.getvalue().splitlines()[1],
+                             'warning: [host] can never match: '
+                             '[url-fallback] comes first and matches '
+                             'whenever it would')
+
+
+class RulePlanTest(unittest.TestCase):
+    rules = """[first]
+kind is raw
+data matches ^(spam)
+arg rewrite {data} spam,eggs
+plumb run echo {0} {data}
+[second]
+kind is raw
+data is something
+plumb run echo {data}
+plumb notify {rule_name}"""
+
+    def setUp(self):
+        self.calls = []
+
+        def record(name):
+            def action(msg, arguments):
+                if isinstance(arguments, list):
+                    arguments = [a.format(**msg) for a in arguments]
+                else:
+                    arguments = arguments.format(**msg)
+                self.calls.append((name, arguments))
+                return True, msg
+            return action
+
+        actions = {'plumb run': record('run'),
+                   'plumb notify': record('notify'),
+                   'plumb download': record('download')}
+
+        self.compiled = compile_rules(
+            fastparser.parse_rules_string_exc(self.rules), actions)
+
+    def plumb(self, data):
+        handle_rules(Scope({'data': data, 'kind': Kind.raw}),
+                     RuleIndex(self.compiled))
+
+    def test_compiled_arguments(self):
+        run = self.compiled[0].action_clauses[0]
+        self.assertEqual([str(a) for a in run.arguments],
+                         ['echo', '{\\0}', '{data}'])
+        self.assertEqual(run.arguments[1].variables, ('\\0',))
+
+        pattern = self.compiled[0].match_clauses[1].arguments[1][0]
+        self.assertEqual(pattern.pattern, '^(spam)')
+
+    def test_first_match(self):
+        self.plumb('spam and ham')
+        self.assertEqual(self.calls, [('run', ['echo', 'spam', 'eggs and ham'])])
+
+    def test_changes_are_reset_between_rules(self):
+        self.plumb('something')
+        self.assertEqual(self.calls, [('run', ['echo', 'something']),
+                                      ('notify', 'second')])
+
+    def test_no_match(self):
+        self.plumb('nothing')
+        self.assertEqual(self.calls, [])
+
+
+class RuleIndexTest(unittest.TestCase):
+    rules = """[github]
+kind is url
+arg is {netloc} github.com
+                gitlab.com
+plumb run firefox {data}
+[raw]
+kind is raw
+plumb run echo {data}
+[rewritten]
+kind is url
+arg rewrite {netloc} www.,
+arg is {netloc} example.org
+plumb run firefox {data}
+[example]
+kind is url
+data is http://example.org/
+plumb run firefox {data}
+[url-fallback]
+kind is url
+plumb run firefox {data}"""
+
+    def setUp(self):
+        self.index = RuleIndex(compile_rules(
+            fastparser.parse_rules_string_exc(self.rules)))
+
+    def names(self, msg):
+        return [rule.name for rule in self.index.candidates(msg)]
+
+    def test_prunes_by_kind_and_literal(self):
+        self.assertEqual(
+            self.names({'kind': Kind.url, 'data': 'http://gitlab.com/',
+                        'netloc': 'gitlab.com'}),
+            ['github', 'rewritten', 'url-fallback'])
+        self.assertEqual(self.index.pruned, 2)
+
+    def test_keeps_original_order(self):
+        self.assertEqual(
+            self.names({'kind': Kind.url, 'data': 'http://example.org/',
+                        'netloc': 'example.org'}),
+            ['rewritten', 'example', 'url-fallback'])
+
+    def test_missing_variable_is_not_pruned(self):
+        self.assertEqual(self.names({'kind': Kind.url, 'data': 'spam'}),
+                         ['github', 'rewritten', 'url-fallback'])
+
+    def test_other_kind(self):
+        self.assertEqual(self.names({'kind': Kind.raw, 'data': b'spam'}),
+                         ['raw'])
+
+
+class SubstringFilterTest(unittest.TestCase):
+    rules = """[isbn]
+kind is text
+data matches isbn:([0-9]+)
+             ISBN\\s([0-9]+)
+plumb run true {0}
+[ticket]
+kind is text
+data matches ^ticket\\s#?([0-9]+)
+plumb run true {0}
+[ignorecase]
+kind is text
+data matches (?i)spam
+plumb run true
+[rewritten]
+kind is text
+arg rewrite {data} eggs,spam
+data matches spam\\sand\\sham
+plumb run true
+[later]
+kind is text
+arg is {kind} text
+data matches (?:spam)?\\sand\\seggs
+plumb run true
+[fallback]
+kind is text
+plumb run true"""
+
+    def setUp(self):
+        self.index = RuleIndex(compile_rules(
+            fastparser.parse_rules_string_exc(self.rules)))
+
+    def names(self, data):
+        return [rule.name for rule in
+                self.index.candidates({'kind': Kind.text, 'data': data})]
+
+    def test_prunes_by_needed_literals(self):
+        self.assertEqual(self.names('see ISBN 12345'),
+                         ['isbn', 'ignorecase', 'rewritten', 'fallback'])
+        self.assertEqual(self.names('bread and eggs'),
+                         ['ignorecase', 'rewritten', 'later', 'fallback'])
+        self.assertEqual(self.names('isbn:1 and eggs'),
+                         ['isbn', 'ignorecase', 'rewritten', 'later',
+                          'fallback'])
+
+    def test_bytes(self):
+        self.assertEqual(self.names(b'\xffISBN 1'),
+                         ['isbn', 'ignorecase', 'rewritten', 'fallback'])
+
+    def test_unprefiltered_data(self):
+        self.assertEqual(len(self.names(bytearray(b'ISBN 1'))), 6)
+        self.assertEqual(len(self.names('x' * (index.MAX_SCAN + 1))), 6)
+
+    def test_same_results_as_without_index(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            bench.generate_rules(80)), STUB_ACTIONS)
+        indexed = RuleIndex(rules)
+
+        def unindexed(msg):
+            for rule in rules:
+                result = handle_rules(Scope(msg), RuleIndex([rule]))
+
+                if result[0] is not None:
+                    return result
+
+            return None, False
+
+        for kind in Kind:
+            for msg in bench.generate_messages(kind, 50, 80):
+                self.assertEqual(handle_rules(Scope(msg), indexed),
+                                 unindexed(msg))
+
+
+# PAYLOAD TESTS
+
+class PayloadTest(unittest.TestCase):
+    def read(self, data, prefix_size=16):
+        payload = read_payload(io.BytesIO(data), prefix_size)
+        self.addCleanup(payload.close)
+        return payload
+
+    def test_small(self):
+        payload = self.read(b'spam')
+        self.assertFalse(payload.spooled)
+        self.assertEqual(payload.value(), b'spam')
+
+    def test_spooled(self):
+        data = 'ä'.encode('utf-8') * 100
+        payload = self.read(data)
+
+        self.assertTrue(payload.spooled)
+        self.assertEqual(payload.size, 200)
+        self.assertEqual(payload.prefix, data[:16])
+        self.assertEqual(payload.bytes(), data)
+
+        # a character cut in two at the end of the prefix is still UTF-8
+        self.assertEqual(self.read(data, 15).text_prefix(), 'ä' * 7)
+
+        path = payload.spool.name
+        payload.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_datafile_is_removed(self):
+        payload = self.read(b'spam')
+        path = payload.path()
+        self.assertIs(payload.path(), path)
+        self.assertFalse(payload.spooled)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'spam')
+
+        payload.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_datafile_is_kept_for_a_detached_program(self):
+        for data in (b'spam', b'spam' * 100):
+            payload = self.read(data)
+            msg = Scope(make_message(argparse.Namespace(msg=payload,
+                                                        kind=Kind.raw)))
+            rules = compile_rules(fastparser.parse_rules_string_exc(
+                '[t]\nkind is raw\nplumb spawn timeout 2 tail -f {datafile}'),
+                configured_actions({'launch window': '0.1'}))
+
+            self.assertEqual(handle_rules(msg, RuleIndex(rules)),
+                             ('t', True))
+            path = format(msg['datafile'])
+            payload.close()
+
+            self.assertTrue(os.path.exists(path))
+            os.unlink(path)
+
+    def test_guess_kind(self):
+        def guess(data):
+            args = argparse.Namespace(msg=self.read(data), kind=None)
+            guess_kind(args)
+            return args.kind
+
+        self.assertEqual(guess(b'http://a.b/'), Kind.url)
+        self.assertEqual(guess(b'http://a.b/' + b'x' * 100),
+                         Kind.text)
+        self.assertEqual(guess(b'\xff' * 100), Kind.raw)
+
+    def test_data_is_read_only_when_needed(self):
+        args = argparse.Namespace(msg=self.read(b'%PDF-1.4\n' * 100),
+                                  kind=Kind.raw)
+        msg = Scope(make_message(args))
+        rules = compile_rules(fastparser.parse_rules_string_exc('''[text]
+kind is text
+data is spam
+plumb run true
+[pdf]
+kind is raw
+data istype application/pdf
+plumb run {datafile}'''), {'plumb run': lambda msg, arguments: (True, msg)})
+
+        self.assertEqual(handle_rules(msg, RuleIndex(rules)), ('pdf', True))
+        self.assertFalse(msg['data'].computed)
+
+        self.assertEqual(format(msg['data']), str(b'%PDF-1.4\n' * 100))
+
+
+# SPAWN TESTS
+
+class SpawnTest(unittest.TestCase):
+    def plumb(self, action, config={'launch window': '0.2'}):
+        calls = []
+
+        def record(msg, arguments):
+            calls.append(msg['data'])
+            return True, msg
+
+        actions = configured_actions(config)
+        actions['plumb notify'] = record
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            '[t]\nkind is text\n' + action + '\nplumb notify done'),
+            actions)
+
+        start = time.monotonic()
+        result = handle_rules(Scope({'data': 'spam',
+                                    'kind': Kind.text}),
+                              RuleIndex(rules))
+
+        return result, calls, time.monotonic() - start
+
+    def test_returns_while_running(self):
+        result, calls, elapsed = self.plumb('plumb spawn sleep 5')
+        self.assertEqual(result, ('t', True))
+        self.assertEqual(calls, ['spam'])
+        self.assertLess(elapsed, 2)
+
+    def test_quick_exit(self):
+        self.assertEqual(self.plumb('plumb spawn true')[:2],
+                         (('t', True), ['spam']))
+        self.assertEqual(self.plumb('plumb spawn false')[:2],
+                         (('t', False), []))
+
+    def test_missing_program(self):
+        self.assertEqual(self.plumb('plumb spawn no-such-program-here')[:2],
+                         (('t', False), []))
+
+    def test_run_mode(self):
+        result, calls, elapsed = self.plumb('plumb run sleep 5',
+                                            {'run mode': 'detach'})
+        self.assertEqual(result, ('t', True))
+        self.assertLess(elapsed, 2)
+
+
+# OPTIMIZER TESTS
+
+class OptimizerTest(unittest.TestCase):
+    def order(self, rule):
+        rules = compile_rules(fastparser.parse_rules_string_exc(rule))
+        optimize_rules(rules)
+        return [c.name + ' ' + str(c.arguments[0])
+                for c in rules[0].match_clauses]
+
+    def test_cheap_clauses_first(self):
+        self.assertEqual(self.order('''[r]
+kind is url
+data istype text/html
+data matches example
+arg is {netloc} github.com
+plumb run true'''), ['kind is url',
+                     'arg is {netloc}',
+                     'arg matches {data}',
+                     'arg istype {data}'])
+
+    def test_rewrite_is_a_barrier(self):
+        self.assertEqual(self.order('''[r]
+kind is raw
+data istype text/plain
+arg rewrite {data} a,b
+data is b
+plumb run true'''), ['kind is raw',
+                     'arg istype {data}',
+                     'arg rewrite {data}',
+                     'arg is {data}'])
+
+    def test_captures_keep_their_order(self):
+        self.assertEqual(self.order('''[r]
+kind is raw
+data istype (text)/plain
+data matches ^(a)
+data is a
+plumb run true'''), ['kind is raw',
+                     'arg is {data}',
+                     'arg istype {data}',
+                     'arg matches {data}'])
+
+    def test_capture_readers_are_barriers(self):
+        rule = r'''[r]
+kind is text
+data matches (a)
+arg is {\0} a
+data matches (b)
+arg is {\0} a
+plumb run true'''
+        self.assertEqual(self.order(rule), ['kind is text',
+                                            'arg matches {data}',
+                                            'arg is {\\0}',
+                                            'arg matches {data}',
+                                            'arg is {\\0}'])
+
+        rules = compile_rules(fastparser.parse_rules_string_exc(rule),
+                              {'plumb run': lambda msg, arguments:
+                               (True, msg)})
+        optimize_rules(rules)
+        self.assertEqual(handle_rules(Scope({'data': 'ab',
+                                             'kind': Kind.text}),
+                                      RuleIndex(rules)), (None, False))
+
+    def test_unknown_variables_stay(self):
+        self.assertEqual(self.order('''[r]
+kind is raw
+data istype text/plain
+arg is {netloc} github.com
+arg matches {netloc} x
+data is a
+plumb run true'''), ['kind is raw',
+                     'arg istype {data}',
+                     'arg is {netloc}',
+                     'arg is {data}',
+                     'arg matches {netloc}'])
+
+    def test_adaptive(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc('''[r]
+kind is text
+data is eggs
+data matches spam
+plumb run true'''), {'plumb run': lambda msg, arguments: (True, msg)})
+        index = RuleIndex(rules)
+        index.adaptive = AdaptiveOrder(rules, every=50)
+
+        for i in range(50):
+            handle_rules(Scope({'data': 'eggs', 'kind': Kind.text}),
+                         index)
+
+        # 'data is eggs' always passes, the regex always fails
+        self.assertEqual([c.name for c in rules[0].match_clauses],
+                         ['kind is', 'arg matches', 'arg is'])
+
+
+# TYPE CACHE TESTS
+
+class TypeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = TypeCache(os.path.join(self.dir.name, 'types.sqlite'),
+                               max_entries=3)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_miss_then_hit(self):
+        self.assertEqual(self.store.get('url:spam'), (False, None))
+        self.store.put('url:spam', 'text/html')
+        self.assertEqual(self.store.get('url:spam'), (True, 'text/html'))
+
+    def test_failures_are_cached(self):
+        lookups = []
+
+        def lookup():
+            lookups.append(1)
+            return None
+
+        self.assertIsNone(cached_lookup(self.store, 'url:eggs', lookup))
+        self.assertIsNone(cached_lookup(self.store, 'url:eggs', lookup))
+        self.assertEqual(len(lookups), 1)
+
+    def test_expired_entries_are_misses(self):
+        self.store.ttl = -1
+        self.store.put('url:spam', 'text/html')
+        self.assertEqual(self.store.get('url:spam'), (False, None))
+
+    def test_least_recently_used_are_evicted(self):
+        for key in ['a', 'b', 'c']:
+            self.store.put(key, 'text/plain')
+
+        self.store.get('a')
+        self.store.put('d', 'text/plain')
+
+        self.assertEqual(sorted(e[0] for e in self.store.entries()),
+                         ['a', 'c', 'd'])
+
+    def test_shared_between_connections(self):
+        self.store.put('url:spam', 'text/html')
+        other = TypeCache(self.store.path)
+        self.assertEqual(other.get('url:spam'), (True, 'text/html'))
+        other.close()
+
+    def test_purge(self):
+        self.store.put('a', 'text/plain')
+        self.assertEqual(self.store.purge(), 1)
+        self.assertEqual(self.store.entries(), [])
+
+    def test_lazy(self):
+        path = os.path.join(self.dir.name, 'lazy.sqlite')
+        store = LazyTypeCache({'type cache': path,
+                               'type cache ttl': 60,
+                               'type cache negative ttl': 60,
+                               'type cache size': 10})
+        self.assertFalse(os.path.exists(path))
+
+        store.put('a', 'text/plain')
+        self.assertEqual(store.get('a'), (True, 'text/plain'))
+        self.assertTrue(os.path.exists(path))
+        store.store.close()
+
+        disabled = LazyTypeCache({'type cache': ''})
+        disabled.put('a', 'text/plain')
+        self.assertEqual(disabled.get('a'), (False, None))
+
+
+# BENCHMARK TESTS
+
+class BenchTest(unittest.TestCase):
+    def test_generated_rules_parse(self):
+        text = bench.generate_rules(12)
+        rules = fastparser.parse_rules_string_exc(text)
+        self.assertEqual(len(rules), 12)
+        self.assertEqual(rules,
+                         parse_rules_string_exc(make_parser(), text,
+                                                extract_plain_parse_result))
+
+    def test_generated_messages_match(self):
+        rules = fastparser.parse_rules_string_exc(bench.generate_rules(40))
+        index = RuleIndex(compile_rules(rules, STUB_ACTIONS))
+
+        for kind in (Kind.url, Kind.text):
+            results = [handle_rules(Scope(msg), index)
+                       for msg in bench.generate_messages(kind, 50, 40)]
+            self.assertTrue(any(rule for rule, _ in results))
+            self.assertTrue(any(rule is None for rule, _ in results))
+
+    def test_compare(self):
+        out = io.StringIO()
+        regressions = bench.compare({'a': 1.2, 'b': 1.0, 'c': 1.0},
+                                    {'a': 1.0, 'b': 1.05}, 0.1, out)
+        self.assertEqual(regressions, ['a'])
+        self.assertIn('REGRESSION', out.getvalue())
+
+
+# MAGIC TESTS
+
+class MagicDetectorTest(unittest.TestCase):
+    pdf = b'%PDF-1.4\n' + b'\0' * 100
+
+    def test_buffers(self):
+        detector = mimemagic.MagicDetector()
+
+        self.assertEqual(detector.from_buffer(self.pdf), 'application/pdf')
+        self.assertEqual(detector.from_buffer(memoryview(self.pdf)),
+                         'application/pdf')
+        self.assertEqual(detector.from_buffer('just some text'),
+                         'text/plain')
+
+    def test_descriptor(self):
+        detector = mimemagic.MagicDetector()
+
+        with tempfile.TemporaryFile() as f:
+            f.write(self.pdf)
+            f.flush()
+            f.seek(0)
+            self.assertEqual(detector.from_descriptor(f.fileno()),
+                             'application/pdf')
+
+    def test_handle_per_thread(self):
+        detector = mimemagic.MagicDetector()
+        handles = []
+
+        def lookup():
+            detector.from_buffer(self.pdf)
+            handles.append(detector.handle())
+
+        threads = [threading.Thread(target=lookup) for _ in range(3)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        lookup()
+        lookup()
+
+        self.assertEqual(len(handles), 5)
+        self.assertIs(handles[3], handles[4])
+        self.assertEqual(len(set(map(id, handles))), 4)
+
+    def test_file_bindings(self):
+        import magic
+
+        if not hasattr(magic, 'open'):
+            self.skipTest('no file style bindings')
+
+        handle = mimemagic.FileMagicHandle(magic)
+        self.assertEqual(handle.buffer(self.pdf), 'application/pdf')
+
+
+# STATS TESTS
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = stats.enable()
+        self.rules = compile_rules(fastparser.parse_rules_string_exc('''[py]
+kind is text
+data istype text/x-python
+plumb run true
+
+[text]
+kind is text
+data istype text/plain
+data matches "(.*)"
+plumb run false {0}'''))
+        self.collector.instrument(self.rules)
+
+    def tearDown(self):
+        stats.disable()
+
+    def test_summary(self):
+        for data in ('"spam"', 'eggs'):
+            handle_rules(Scope({'data': data, 'kind': Kind.text}),
+                         RuleIndex(self.rules))
+
+        summary = self.collector.summary()
+        self.assertEqual((summary['messages'], summary['matched']), (2, 1))
+        # the second rule finds the mimetype the first one looked up
+        self.assertEqual(summary['type cache'], {'hits': 2, 'misses': 2})
+
+        py, text = summary['rules']
+        self.assertEqual((py['evaluations'], py['matches']), (2, 0))
+        self.assertEqual((text['evaluations'], text['matches']), (2, 1))
+        self.assertEqual([(c['clause'], c['calls'], c['passes'])
+                          for c in text['clauses']],
+                         [('kind is text', 2, 2),
+                          ('arg istype {data}', 2, 2),
+                          ('arg matches {data}', 2, 1)])
+        self.assertEqual([(a['action'], a['calls'], a['passes'])
+                          for a in text['actions']],
+                         [('plumb run false {0}', 1, 0)])
+
+    def test_metrics(self):
+        handle_rules(Scope({'data': '"spam"', 'kind': Kind.text}),
+                     RuleIndex(self.rules))
+        metrics = self.collector.metrics().splitlines()
+
+        self.assertIn('# TYPE mario_messages_total counter', metrics)
+        self.assertIn('mario_messages_total 1', metrics)
+        self.assertIn('mario_rule_matches_total{rule="text",position="1"} 1',
+                      metrics)
+        self.assertIn('mario_clause_passes_total{rule="text",position="1",'
+                      'clause="arg matches {data}"} 1', metrics)
+        self.assertEqual(stats.format_labels({'rule': 'a "b"\\'}),
+                         '{rule="a \\"b\\"\\\\"}')
+
+    def test_rules_with_the_same_name(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            '[t]\nkind is text\narg is {data} spam\nplumb run true\n\n'
+            '[t]\nkind is text\nplumb run true'))
+        self.collector.instrument(rules)
+
+        for data in ('spam', 'eggs', 'ham'):
+            handle_rules(Scope({'data': data, 'kind': Kind.text}),
+                         RuleIndex(rules))
+
+        summary = self.collector.summary()['rules'][2:]
+        self.assertEqual([(r['rule'], r['position'], r['matches'])
+                          for r in summary], [('t', 0, 1), ('t', 1, 2)])
+        # eggs and ham can't match the first rule
+        self.assertEqual(self.collector.summary()['rules pruned'], 2)
+        self.assertIn('mario_rules_pruned_total 2',
+                      self.collector.metrics().splitlines())
+
+    def test_adaptive_order_shares_the_timer(self):
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            '[t]\nkind is text\narg is {data} spam\nplumb run true'))
+        AdaptiveOrder(rules)
+        self.collector.instrument(rules)
+
+        handle_rules(Scope({'data': 'spam', 'kind': Kind.text}),
+                     RuleIndex(rules))
+
+        # timed once, so counted once
+        self.assertEqual([c.calls for c in rules[0].match_clauses], [1, 1])
+        self.assertEqual(self.collector.summary()['rules'][2]['evaluations'],
+                         1)
+
+    def test_metrics_file_is_replaced(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mario.prom')
+
+            for _ in range(2):
+                stats.report(metrics_file=path)
+
+            with open(path) as f:
+                metrics = f.read().splitlines()
+
+            self.assertEqual([name for name in os.listdir(tmp)
+                              if not name.endswith('.lock')], ['mario.prom'])
+
+        self.assertEqual(metrics.count('# TYPE mario_messages_total counter'),
+                         1)
+        # the textfile collector skips files with timestamped samples
+        self.assertIn('mario_messages_total 0', metrics)
+
+    def test_metrics_file_keeps_running_totals(self):
+        def plumb(data):
+            handle_rules(Scope({'data': data, 'kind': Kind.text}),
+                         RuleIndex(self.rules))
+
+        def samples():
+            with open(path) as f:
+                return stats.parse_samples(f)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mario.prom')
+
+            # one run, then another one
+            plumb('"spam"')
+            stats.report(metrics_file=path)
+            self.collector = stats.enable()
+            self.collector.instrument(self.rules)
+            plumb('"eggs"')
+            stats.report(metrics_file=path)
+            self.assertEqual(samples()['mario_messages_total'], 2)
+
+            # a long running process adds only what's new every time
+            stats.report(metrics_file=path)
+            plumb('ham')
+            stats.report(metrics_file=path)
+            self.assertEqual(samples()['mario_messages_total'], 3)
+
+            # reloaded rules keep counting if they're the same
+            key = 'mario_rule_evaluations_total{rule="text",position="1"}'
+            self.assertEqual(samples()[key], 3)
+            self.collector.instrument(compile_rules(
+                fastparser.parse_rules_string_exc(
+                    '[py]\nkind is text\nplumb run true\n\n'
+                    '[text]\nkind is text\nplumb run true')))
+            stats.report(metrics_file=path)
+            self.assertEqual(samples()[key], 3)
+
+    def test_disabled(self):
+        stats.disable()
+        rules = compile_rules(fastparser.parse_rules_string_exc(
+            '[t]\nkind is text\nplumb run true'))
+        self.assertEqual(handle_rules(Scope({'data': 'spam',
+                                             'kind': Kind.text}),
+                                      RuleIndex(rules)), ('t', True))
+        self.assertEqual(self.collector.messages, 0)
+
+
+# REPLAY TESTS
+
+class ReplayTest(unittest.TestCase):
+    rules = """[note]
+kind is text
+data matches ^note\\s(.*)$
+plumb run true {0}
+
+[host]
+kind is url
+arg is {netloc} example.com
+plumb run true {data}"""
+
+    def compile(self, text):
+        return RuleIndex(compile_rules(fastparser.parse_rules_string_exc(text),
+                                       STUB_ACTIONS))
+
+    def record(self, messages, rules):
+        log = io.StringIO()
+        log.name = 'log'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'log')
+            replay.start(path)
+
+            try:
+                for data, kind in messages:
+                    msg = make_message(argparse.Namespace(msg=data,
+                                                          kind=kind))
+                    result = handle_rules(Scope(msg), rules)
+                    replay.record(data, msg, result, {'handle': 0.001})
+            finally:
+                replay.stop()
+
+            with open(path) as f:
+                log.write(f.read())
+
+        log.seek(0)
+        return log
+
+    def test_record(self):
+        log = self.record([('note hi', Kind.text),
+                           ('http://example.com/a', Kind.url),
+                           (b'\xff\x00', Kind.raw),
+                           ('x' * (replay.DATA_LIMIT + 1), Kind.text)],
+                          self.compile(self.rules))
+        text, url, raw, big = [json.loads(l) for l in log]
+
+        self.assertEqual((text['data'], text['rule'], text['status']),
+                         ('note hi', 'note', 'ok'))
+        self.assertEqual(url['variables'], {'netloc': 'example.com',
+                                            'netpath': '/a'})
+        self.assertEqual(raw['data_b64'], '/wA=')
+        self.assertEqual(raw['status'], 'no match')
+        self.assertNotIn('data', big)
+        self.assertEqual(big['size'], replay.DATA_LIMIT + 1)
+        self.assertEqual(text['timings'], {'handle': 0.001})
+
+    def test_replay(self):
+        messages = [('note hi', Kind.text), ('http://example.com/a', Kind.url),
+                    (b'\xff\x00', Kind.raw),
+                    ('x' * (replay.DATA_LIMIT + 1), Kind.text)]
+        log = self.record(messages, self.compile(self.rules))
+        report = replay.replay([log], self.compile(self.rules)).summary()
+
+        self.assertEqual((report['replayed'], report['skipped'],
+                          report['matched']), (3, 1, 2))
+        self.assertEqual(report['changed'], [])
+        self.assertLessEqual(report['latency']['p50'],
+                             report['latency']['max'])
+
+        log.seek(0)
+        changed = self.rules.replace('example.com', 'example.org')
+        report = replay.replay([log], self.compile(changed)).summary()
+
+        self.assertEqual(report['changed'], [{
+            'log': 'log', 'line': 2, 'kind': 'url',
+            'data': 'http://example.com/a', 'recorded': 'host',
+            'replayed': None}])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(replay.percentile(values, 50), 50)
+        self.assertEqual(replay.percentile(values, 99), 99)
+        self.assertEqual(replay.percentile([7], 90), 7)
+        self.assertEqual(replay.percentile([], 50), 0.0)
+
+
+# STARTUP PROFILE TESTS
+
+class StartupProfileTest(unittest.TestCase):
+    def test_steps_and_imports(self):
+        new = 'colorsys' not in sys.modules
+        profile = StartupProfile()
+        profile.install()
+
+        try:
+            with profile.step('outer'):
+                with profile.step('inner'):
+                    import colorsys
+        finally:
+            profile.uninstall()
+
+        self.assertEqual([(s[0], s[3]) for s in profile.steps],
+                         [('outer', 0), ('inner', 1)])
+        self.assertEqual([m for m, _ in profile.steps[1][2]],
+                         ['colorsys'] if new else [])
+
+        out = io.StringIO()
+        profile.report(out)
+        self.assertIn('    inner', out.getvalue())
+
+
+# DAEMON TESTS
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.rules = os.path.join(self.dir.name, 'mario.plumb')
+
+        with open(self.rules, 'w') as f:
+            f.write(simple_rule)
+
+        self.daemon = Daemon({'rules file': self.rules})
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def request(self, *argv):
+        return self.daemon.handle({'argv': list(argv),
+                                   'cwd': os.getcwd()})
+
+    def test_print_mimetype(self):
+        response = self.request('spam', 'text', '--print-mimetype')
+        self.assertEqual(response['status'], 0)
+        self.assertEqual(response['stdout'], 'text/plain\n')
+
+    def test_bad_arguments(self):
+        response = self.request('spam')
+        self.assertEqual(response['status'], 2)
+        self.assertIn('kind --guess', response['stderr'])
+
+    def test_rules_are_kept_until_changed(self):
+        args = parse_arguments(['spam', 'raw'])
+        rules = self.daemon.rules_for(args, self.daemon.config)
+        self.assertIs(self.daemon.rules_for(args, self.daemon.config), rules)
+
+        with open(self.rules, 'w') as f:
+            f.write(multiple_rules)
+
+        os.utime(self.rules, ns=(0, 0))
+        self.assertEqual(len(self.daemon.rules_for(args, self.daemon.config)),
+                         2)
+
+    def test_rules_are_reloaded_for_other_settings(self):
+        args = parse_arguments(['spam', 'raw'])
+        rules = self.daemon.rules_for(args, self.daemon.config)
+
+        config = dict(self.daemon.config, **{'clause order': 'file'})
+        self.assertIsNot(self.daemon.rules_for(args, config), rules)
+
+        for argv in (['--parser', 'fast', 'spam', 'raw'],
+                     ['--reparse', 'spam', 'raw']):
+            rules = self.daemon.rules_for(args, self.daemon.config)
+            self.assertIsNot(self.daemon.rules_for(parse_arguments(argv),
+                                                   self.daemon.config),
+                             rules)
+
+    def test_config_is_reloaded_when_changed(self):
+        path = os.path.join(self.dir.name, 'config')
+
+        with open(path, 'w') as f:
+            f.write('[mario]\nrules file = {}\n'.format(self.rules))
+
+        self.daemon = Daemon({'rules file': self.rules}, path)
+        self.assertIs(self.daemon.current_config(), self.daemon.config)
+
+        with open(path, 'w') as f:
+            f.write('[mario]\nrules file = {}\nclause order = file\n'
+                    .format(self.rules))
+        os.utime(path, ns=(0, 0))
+
+        self.assertEqual(self.daemon.current_config()['clause order'], 'file')
+
+    def test_programs_run_detached_in_the_client_environment(self):
+        with open(self.rules, 'w') as f:
+            f.write('[slow]\nkind is text\narg is {data} slow\n'
+                    'plumb run sleep 2\n\n'
+                    '[env]\nkind is text\narg is {data} env\n'
+                    'plumb run printenv MARIO_TEST')
+
+        start = time.monotonic()
+        self.assertEqual(self.request('slow', 'text')['status'], 0)
+        self.assertLess(time.monotonic() - start, 1)
+
+        output = os.path.join(self.dir.name, 'output')
+
+        with open(os.devnull, 'rb') as stdin, open(output, 'w') as f:
+            self.daemon.handle({'argv': ['env', 'text'], 'cwd': os.getcwd(),
+                                'env': {'MARIO_TEST': 'client',
+                                        'PATH': os.environ['PATH']}},
+                               (stdin.fileno(), f.fileno(), f.fileno()))
+
+        for _ in range(50):
+            with open(output) as f:
+                if f.read() == 'client\n':
+                    break
+            time.sleep(0.05)
+        else:
+            self.fail('the program didn\'t write to the client\'s stdout')
+
+    @contextlib.contextmanager
+    def serving(self, clients=1):
+        """Answer that many clients on a socket, whose path is yielded."""
+        path = os.path.join(self.dir.name, 'socket')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.settimeout(5)
+        server.bind(path)
+        server.listen()
+
+        def serve():
+            for _ in range(clients):
+                conn, _ = server.accept()
+
+                with conn:
+                    daemon.handle_connection(self.daemon, conn)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        try:
+            yield path
+        finally:
+            thread.join()
+            server.close()
+
+    def client(self, path, *argv, **kwargs):
+        return subprocess.Popen(
+            [sys.executable, '-m', 'mario.daemon', '--socket', path] +
+            list(argv), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__)))),
+            **kwargs)
+
+    def test_datafile_through_the_client(self):
+        output = os.path.join(self.dir.name, 'output')
+
+        with open(self.rules, 'w') as f:
+            f.write('[file]\nkind is text\n'
+                    'plumb run cp {{datafile}} {}'.format(output))
+
+        with self.serving() as path:
+            client = self.client(path, '-', 'text', stdin=subprocess.PIPE)
+            _, stderr = client.communicate(b'spam\n', timeout=10)
+
+        self.assertEqual(client.returncode, 0)
+        self.assertNotIn(b'No such variable', stderr)
+
+        for _ in range(50):
+            if os.path.exists(output):
+                with open(output, 'rb') as f:
+                    if f.read() == b'spam\n':
+                        break
+            time.sleep(0.05)
+        else:
+            self.fail('the program didn\'t get the data in {datafile}')
+
+    def test_slow_stdin_holds_up_no_one(self):
+        with self.serving(clients=2) as path:
+            slow = self.client(path, '-', 'text', stdin=subprocess.PIPE)
+
+            try:
+                quick = self.client(path, 'spam', 'raw')
+                quick.communicate(timeout=10)
+                self.assertEqual(quick.returncode, 0)
+                # still waiting for the end of its stdin
+                self.assertIsNone(slow.poll())
+            finally:
+                slow.communicate(b'spam\n', timeout=10)
+
+        self.assertEqual(slow.returncode, 0)
+
+    def test_stdin_has_to_be_spooled(self):
+        r, w = os.pipe()
+
+        with os.fdopen(r, 'rb') as stdin, os.fdopen(w, 'wb'), \
+                open(os.devnull, 'w') as out:
+            response = self.daemon.handle(
+                {'argv': ['-', 'text'], 'cwd': os.getcwd()},
+                (stdin.fileno(), out.fileno(), out.fileno()))
+
+        self.assertEqual(response['status'], 1)
+        self.assertIn('spooled', response['stderr'])
+
+    def test_type_cache_is_not_managed_by_the_daemon(self):
+        response = self.request('--type-cache', 'list')
+        self.assertEqual(response['status'], 1)
+        self.assertIn('don\'t go through the daemon', response['stderr'])
+
+    def test_client_verbosity(self):
+        response = self.request('-vv', 'spam', 'raw')
+        self.assertIn('INFO:\tMatching message against rules.',
+                      response['stderr'])
+        self.assertNotIn('INFO', self.request('spam', 'raw')['stderr'])
+
+    def test_silent_client_is_dropped(self):
+        server, client = socket.socketpair()
+        timeout, daemon.CLIENT_TIMEOUT = daemon.CLIENT_TIMEOUT, 0.1
+
+        try:
+            with server, client:
+                start = time.monotonic()
+                daemon.handle_connection(self.daemon, server)
+                self.assertLess(time.monotonic() - start, 1)
+        finally:
+            daemon.CLIENT_TIMEOUT = timeout
+
+    def test_socket_dir_must_be_private(self):
+        path = os.path.join(self.dir.name, 'run', 'socket')
+        args = parse_arguments(['--daemon', '--socket', path])
+
+        os.mkdir(os.path.dirname(path), 0o755)
+        os.chmod(os.path.dirname(path), 0o755)
+        self.assertEqual(daemon.serve(args, self.daemon.config), 1)
+        self.assertFalse(os.path.exists(path))
+
+        with self.assertRaises(PermissionError):
+            daemon.check_socket_dir(path)
+
+        os.chmod(os.path.dirname(path), 0o700)
+        daemon.check_socket_dir(path)
+
+        link = os.path.join(self.dir.name, 'link')
+        os.symlink(os.path.dirname(path), link)
+
+        with self.assertRaises(PermissionError):
+            daemon.check_socket_dir(os.path.join(link, 'socket'))
+
+    def test_other_users_are_dropped(self):
+        server, client = socket.socketpair()
+        self.assertEqual(daemon.peer_uid(server), os.getuid())
+
+        peer_uid = daemon.peer_uid
+        daemon.peer_uid = lambda conn: os.getuid() + 1
+
+        try:
+            with server, client:
+                daemon.handle_connection(self.daemon, server)
+                server.close()
+                self.assertIsNone(daemon.receive(client))
+        finally:
+            daemon.peer_uid = peer_uid
+
+    def test_client_socket_path(self):
+        self.assertEqual(daemon.client_socket_path(['--socket', '/s', 'x']),
+                         '/s')
+        self.assertEqual(daemon.client_socket_path(['--socket=/t', 'x']),
+                         '/t')
+
+
+# BATCH TESTS
+
+batch_rules = '''[local]
+kind is url
+arg is {netloc} localhost
+plumb run true
+
+[spam]
+kind is text
+arg matches {data} ^spam
+plumb run false
+'''
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {'rules file': os.path.join(self.dir.name,
+                                                  'mario.plumb')}
+
+        with open(self.config['rules file'], 'w') as f:
+            f.write(batch_rules)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_batch(self, argv, data):
+        out = io.StringIO()
+        status = plumb_batch(parse_arguments(['--batch'] + argv), self.config,
+                             out=out, infile=io.BytesIO(data))
+
+        self.assertEqual(status, 0)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_lines(self):
+        results = self.run_batch(['--guess'],
+                                 b'http://localhost/a\r\n\nspam eggs\nham\n')
+        self.assertEqual(results, [
+            {'message': 1, 'kind': 'url', 'rule': 'local', 'status': 'ok'},
+            {'message': 2, 'kind': 'text', 'rule': 'spam',
+             'status': 'failed'},
+            {'message': 3, 'kind': 'text', 'rule': None,
+             'status': 'no match'},
+        ])
+
+    def test_nul_with_kind(self):
+        results = self.run_batch(['--batch-format', 'nul', 'text'],
+                                 b'spam\neggs\0http://localhost/')
+        self.assertEqual([(r['kind'], r['rule']) for r in results],
+                         [('text', 'spam'), ('text', None)])
+
+    def test_ndjson(self):
+        records = [{'data': 'http://localhost/', 'kind': 'url', 'id': 7},
+                   {'data': 'spam', 'kind': 'text'},
+                   {'data': 'spam', 'kind': 'pigeon'},
+                   ['spam']]
+        data = b'\n'.join(json.dumps(r).encode() for r in records) + b'\n{'
+        results = self.run_batch(['--batch-format', 'ndjson'], data)
+
+        self.assertEqual(results[0], {'message': 1, 'id': 7, 'kind': 'url',
+                                      'rule': 'local', 'status': 'ok'})
+        self.assertEqual(results[1]['rule'], 'spam')
+        self.assertEqual([r['status'] for r in results[2:]],
+                         ['error'] * 3)
+
+    def test_arguments(self):
+        args = parse_arguments(['--batch', 'urls.txt', 'url'])
+        self.assertEqual((args.batch, args.msg, args.kind),
+                         ('urls.txt', None, Kind.url))
+
+        with self.assertRaises(SystemExit):
+            parse_arguments(['--batch', '-', 'spam', 'url'])
+
+
+# NET TESTS
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    peers = []
+    asked = []
+    answered = []
+    delay = 0
+    statuses = []
+
+    def do_HEAD(self):
+        # a request given up on may only be answered once the next test runs
+        peers, answered = self.peers, self.answered
+        self.asked.append(time.monotonic())
+        time.sleep(self.delay)
+        peers.append(self.client_address)
+        answered.append(time.monotonic())
+        self.send_response(self.statuses.pop(0) if self.statuses else 200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class NetTest(unittest.TestCase):
+    def setUp(self):
+        KeepAliveHandler.peers = []
+        KeepAliveHandler.asked = []
+        KeepAliveHandler.answered = []
+        KeepAliveHandler.delay = 0
+        KeepAliveHandler.statuses = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+
+        net.configure({})
+        net.breaker.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        net.configure({})
+        net.breaker.reset()
+
+    def test_connection_is_reused(self):
+        for path in ('a', 'b', 'c'):
+            self.assertEqual(lookup_content_type(self.url + path),
+                             ('text/html', 'charset=utf-8'))
+
+        self.assertEqual(len(KeepAliveHandler.peers), 3)
+        self.assertEqual(len(set(KeepAliveHandler.peers)), 1)
+
+    def test_configure(self):
+        session = net.session()
+        net.configure({'read timeout': '2'})
+        self.assertEqual(net.timeout(), (3.05, 2))
+        self.assertIsNot(net.session(), session)
+
+        session = net.session()
+        net.configure({'read timeout': '2'})
+        self.assertIs(net.session(), session)
+
+    def test_unreachable_host(self):
+        self.server.shutdown()
+        self.server.server_close()
+        net.configure({'retries': '0'})
+        self.assertEqual(lookup_content_type(self.url), (None, None))
+
+    def test_deadline(self):
+        KeepAliveHandler.delay = 5
+        net.configure({'message deadline': '0.2', 'retries': '0'})
+        start = time.monotonic()
+
+        with net.Deadline():
+            self.assertEqual(lookup_content_type(self.url), (None, None))
+            # given up on long before the server answers
+            self.assertLess(time.monotonic() - start, 2)
+
+            time.sleep(0.2)
+            with self.assertRaises(net.DeadlineExceeded):
+                net.head(self.url)
+
+        # outside of handling a message there's no deadline
+        self.assertIsNone(net.remaining())
+        self.assertEqual(net.timeout(), (3.05, 10))
+
+    def test_retries_share_the_deadline(self):
+        KeepAliveHandler.delay = 5
+        net.configure({'message deadline': '0.6', 'retries': '3',
+                       'retry backoff': '0.05'})
+        start = time.monotonic()
+
+        with net.Deadline():
+            self.assertEqual(lookup_content_type(self.url), (None, None))
+
+        # retried within the deadline rather than waiting on the first try
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIn(len(KeepAliveHandler.asked), range(2, 5))
+
+    def test_bad_status_is_retried(self):
+        KeepAliveHandler.statuses = [503, 503]
+        net.configure({'retries': '2', 'retry backoff': '0'})
+        self.assertEqual(net.head(self.url).status_code, 200)
+        self.assertEqual(len(KeepAliveHandler.peers), 3)
+
+    def test_circuit_breaker(self):
+        self.server.shutdown()
+        self.server.server_close()
+        net.configure({'retries': '0', 'breaker failures': '2'})
+        host = self.url.split('/')[2]
+
+        for _ in range(2):
+            self.assertEqual(lookup_content_type(self.url), (None, None))
+
+        with self.assertRaises(net.CircuitOpen):
+            net.breaker.check(host)
+
+        # once the cooldown is over the host is tried again
+        net.configure({'retries': '0', 'breaker failures': '2',
+                       'breaker cooldown': '0'})
+        net.breaker.failure(host)
+        net.breaker.check(host)
+        net.breaker.success(host)
+        self.assertEqual(net.breaker.hosts, {})
+
+    def test_content_lookup_failure(self):
+        self.server.shutdown()
+        self.server.server_close()
+        url = self.url + 'paper.pdf'
+
+        net.configure({'retries': '0', 'strict content lookup': 'yes'})
+        self.assertEqual(detect_mimetype(Kind.url, url), 'application/pdf')
+
+        net.configure({'retries': '0', 'strict content lookup': 'yes',
+                       'content lookup failure': 'no match'})
+        self.assertIsNone(detect_mimetype(Kind.url, url))
+
+    def test_strict_content_lookup(self):
+        url = self.url + 'image.png'
+        self.assertEqual(detect_mimetype(Kind.url, url), 'image/png')
+
+        net.configure({'strict content lookup': 'yes'})
+        self.assertEqual(detect_mimetype(Kind.url, url), 'text/html')
+
+    def test_prefetch(self):
+        cache = {'pending': {}}
+        prefetch_mimetype(self.url + 'image.png', cache)
+        self.assertEqual(cache['pending'], {})
+
+        prefetch_mimetype(self.url + 'page', cache)
+        self.assertEqual(cache['pending'][self.url + 'page'].result(),
+                         'text/html')
+
+    def test_prefetch_overlaps_matching(self):
+        KeepAliveHandler.delay = 0.3
+        matched = []
+
+        def record(msg, arguments):
+            matched.append(msg['rule_name'])
+            return True, msg
+
+        rules = compile_rules(fastparser.parse_rules_string_exc('''[slow]
+kind is url
+arg matches {netpath} ^/nothing
+plumb run slow
+[typed]
+kind is url
+data istype ^text/html$
+plumb run typed'''), {'plumb run': record})
+
+        slow_done = []
+        clause = rules[0].match_clauses[1]
+        func = clause.func
+
+        def slow(msg, arguments, cache):
+            time.sleep(0.1)
+            result = func(msg, arguments, cache)
+            slow_done.append(time.monotonic())
+            return result
+
+        clause.func = slow
+
+        rule, ok = handle_rules(Scope({'data': self.url + 'page',
+                                      'netpath': '/page',
+                                      'kind': Kind.url}),
+                                RuleIndex(rules))
+
+        self.assertEqual((rule, ok), ('typed', True))
+        self.assertEqual(matched, ['typed'])
+        self.assertEqual(len(KeepAliveHandler.peers), 1)
+        # [slow] was ruled out while the HEAD request was under way
+        self.assertEqual(len(slow_done), 1)
+        self.assertLess(KeepAliveHandler.asked[0], slow_done[0])
+        self.assertLess(slow_done[0], KeepAliveHandler.answered[0])
+
+
+# DOWNLOAD CACHE TESTS
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    headers_seen = []
+
+    def do_GET(self):
+        self.headers_seen.append(self.headers.get('If-None-Match'))
+
+        try:
+            body = self.files[self.path]
+        except KeyError:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        etag = '"{}"'.format(len(body))
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        FileHandler.files = {'/a': b'spam' * 100, '/b': b'spam' * 100,
+                             '/c': b'eggs' * 200}
+        FileHandler.headers_seen = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      FileHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+        net.configure({})
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = DownloadCache(self.dir.name, max_bytes=1000)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_revalidation(self):
+        path = self.cache.fetch(self.url + '/a')
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'spam' * 100)
+
+        self.assertEqual(self.cache.fetch(self.url + '/a'), path)
+        self.assertEqual(FileHandler.headers_seen, [None, '"400"'])
+
+        FileHandler.files['/a'] = b'ham'
+        self.assertNotEqual(self.cache.fetch(self.url + '/a'), path)
+
+    def test_deduplication(self):
+        self.assertEqual(self.cache.fetch(self.url + '/a'),
+                         self.cache.fetch(self.url + '/b'))
+        self.assertEqual(len(os.listdir(self.cache.objects)), 1)
+
+    def test_eviction(self):
+        a = self.cache.fetch(self.url + '/a')
+        self.cache.fetch(self.url + '/c')
+
+        # a program may not have opened it yet
+        self.assertTrue(os.path.exists(a))
+
+        self.cache.keep_for = 0
+        FileHandler.files['/c'] = b'ham' * 200
+        self.cache.fetch(self.url + '/c')
+
+        self.assertFalse(os.path.exists(a))
+        self.assertIsNone(self.cache.cached(self.url + '/a'))
+
+    def test_files_are_read_only(self):
+        path = self.cache.fetch(self.url + '/a')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o444)
+
+        os.chmod(path, 0o644)
+        self.assertEqual(self.cache.fetch(self.url + '/a'), path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o444)
+
+    def test_http_error(self):
+        with self.assertRaises(DownloadError):
+            self.cache.fetch(self.url + '/missing')
+
+
 if __name__ == '__main__':
         unittest.main()
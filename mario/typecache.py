@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Damir Jelić, Denis Kasak
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+# Mimetypes that are expensive to find out (a HEAD request for URLs, libmagic
+# for raw data) are remembered across mario processes in a small SQLite
+# database. SQLite does the locking, so any number of processes can share it.
+
+import hashlib
+import logging as log
+import os
+import threading
+import time
+
+from xdg import BaseDirectory
+
+
+def default_path():
+    return os.path.join(BaseDirectory.xdg_cache_home, 'mario', 'types.sqlite')
+
+
+def url_key(url):
+    return 'url:' + url
+
+
+def buffer_key(buf):
+    if isinstance(buf, str):
+        buf = buf.encode('utf-8', 'surrogatepass')
+
+    return 'magic:' + hashlib.sha256(buf).hexdigest()
+
+
+class TypeCache:
+    """Persistent key to mimetype cache with per-entry expiry and a cap on
+    the number of entries, evicting the least recently used ones.
+
+    Failed lookups are cached as well (with their own, usually shorter, time
+    to live) so a broken host isn't asked again on every plumb.
+    """
+
+    def __init__(self, path=None, ttl=86400, negative_ttl=300,
+                 max_entries=10000):
+        self.path = path or default_path()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        import sqlite3
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.db = sqlite3.connect(self.path, timeout=5,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS types ('
+                        'key TEXT PRIMARY KEY, '
+                        'mimetype TEXT, '
+                        'expires REAL NOT NULL, '
+                        'used REAL NOT NULL)')
+
+    def get(self, key):
+        """Return (True, mimetype) for a live entry, (False, None) otherwise.
+        The mimetype of a cached failure is None."""
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute('SELECT mimetype, expires FROM types '
+                                  'WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                return False, None
+
+            mimetype, expires = row
+
+            if expires < now:
+                self.db.execute('DELETE FROM types WHERE key = ?', (key,))
+                return False, None
+
+            self.db.execute('UPDATE types SET used = ? WHERE key = ?',
+                            (now, key))
+
+        return True, mimetype
+
+    def put(self, key, mimetype):
+        now = time.time()
+        ttl = self.ttl if mimetype else self.negative_ttl
+
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('INSERT OR REPLACE INTO types '
+                            'VALUES (?, ?, ?, ?)',
+                            (key, mimetype, now + ttl, now))
+            self.db.execute('DELETE FROM types WHERE key IN ('
+                            'SELECT key FROM types ORDER BY used DESC '
+                            'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def entries(self):
+        with self.lock:
+            return self.db.execute('SELECT key, mimetype, expires, used '
+                                   'FROM types ORDER BY used DESC').fetchall()
+
+    def purge(self, expired_only=False):
+        with self.lock:
+            if expired_only:
+                cursor = self.db.execute('DELETE FROM types '
+                                         'WHERE expires < ?', (time.time(),))
+            else:
+                cursor = self.db.execute('DELETE FROM types')
+
+        return cursor.rowcount
+
+    def close(self):
+        self.db.close()
+
+
+def open_type_cache(config):
+    """Open the cache configured in the [mario] section, or return None if
+    it's disabled or unusable."""
+    path = config.get('type cache')
+
+    if not path:
+        return None
+
+    import sqlite3
+
+    try:
+        return TypeCache(os.path.expanduser(path),
+                         ttl=float(config.get('type cache ttl')),
+                         negative_ttl=float(
+                             config.get('type cache negative ttl')),
+                         max_entries=int(config.get('type cache size')))
+    except (OSError, sqlite3.Error) as e:
+        log.info('Not using the type cache: {}'.format(e))
+        return None
+
+
+class LazyTypeCache:
+    """Stands in for the cache configured in the [mario] section and opens
+    it the first time it's used, so messages that never need a lookup don't
+    pay for opening it."""
+
+    def __init__(self, config):
+        self.config = config
+        self.opened = False
+        self.store = None
+
+    def open(self):
+        if not self.opened:
+            self.opened = True
+            self.store = open_type_cache(self.config)
+
+        return self.store
+
+    def get(self, key):
+        store = self.open()
+        return store.get(key) if store else (False, None)
+
+    def put(self, key, mimetype):
+        store = self.open()
+
+        if store:
+            store.put(key, mimetype)
+
+
+def cached_lookup(store, key, lookup):
+    """Return the cached result for key, calling lookup() and caching what it
+    returns on a miss. Database errors only cost the caching."""
+    if store is None:
+        return lookup()
+
+    import sqlite3
+
+    try:
+        hit, mimetype = store.get(key)
+    except sqlite3.Error as e:
+        log.debug('Type cache error: {}'.format(e))
+        return lookup()
+
+    if hit:
+        log.debug('Type cache hit for {}: {}'.format(key, mimetype))
+        return mimetype
+
+    mimetype = lookup()
+
+    try:
+        store.put(key, mimetype)
+    except sqlite3.Error as e:
+        log.debug('Type cache error: {}'.format(e))
+
+    return mimetype
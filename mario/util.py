@@ -1,7 +1,7 @@
-import collections
+import collections.abc
 from itertools import chain
 
-class ElasticDict(collections.MutableMapping):
+class ElasticDict(collections.abc.MutableMapping):
     def __init__(self, d={}):
         self.original = d
         self.strain = {}
@@ -34,3 +34,84 @@ class ElasticDict(collections.MutableMapping):
 
     def reverse(self):
         self.strain.clear()
+
+
+_MISSING = object()
+
+
+class Scope(collections.abc.MutableMapping):
+    """The variables of a message being matched.
+
+    The variables live in a single dict, so lookups, iteration and
+    str.format_map() never have to look in more than one place or copy
+    anything. Every change is journaled with the value it replaced, so the
+    message can be rolled back to any earlier savepoint.
+    """
+
+    def __init__(self, d={}):
+        self.values = dict(d)
+        self.journal = []
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.journal.append((key, self.values.get(key, _MISSING)))
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        value = self.values.pop(key)
+        self.journal.append((key, value))
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __str__(self):
+        return str(self.values)
+
+    def __repr__(self):
+        return 'Scope({!r})'.format(self.values)
+
+    def savepoint(self):
+        return len(self.journal)
+
+    def rollback(self, savepoint=0):
+        """Undo the changes made since savepoint was taken."""
+        journal, values = self.journal, self.values
+
+        while len(journal) > savepoint:
+            key, value = journal.pop()
+
+            if value is _MISSING:
+                values.pop(key, None)
+            else:
+                values[key] = value
+
+    def reverse(self):
+        """Undo all changes, like ElasticDict.reverse()."""
+        self.rollback()
+
+
+def print_parse_error(e):
+    print(e, ':\n\t', e.line, sep="")
+    error_indicator = '\t' + ' ' * (e.col - 1) + '^'
+
+    print(error_indicator)
+
+
+def boolean(value):
+    """Read a yes/no config option, which is a string unless it's the
+    default."""
+    if isinstance(value, bool):
+        return value
+
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
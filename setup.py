@@ -19,6 +19,7 @@ setup(name = 'mario',
       install_requires = [magic_module, 'pyxdg', 'requests', 'pyparsing', 'notify2', 'dbus-python'],
       license = 'ISC',
       entry_points = {
-          "console_scripts" : ['mario = mario.core:main']
+          "console_scripts" : ['mario = mario.core:main',
+                               'mario-client = mario.daemon:client_main']
       }
 )